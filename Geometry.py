@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 2026
+"""
+
+'''
+Geometry backends used by the PLSM and Septic classes. Every spatial step (clip, intersect, erase, dissolve, area,
+buffer, attribute selection, counts) goes through one of these so the same classes run with or without ArcGIS.
+
+1. arcpyBackend:
+    Runs the geoprocessing through arcpy. Default on ArcGIS Pro desktops.
+2. shapelyBackend:
+    Vectorized shapely 2 operations with an STRtree spatial index, reads and writes layers through geopandas.
+    Runs headless (Linux compute nodes) and inside process pools.
+
+sourceVersion() and MASTERLIST_CACHE are the layer versions and local cache folder the PLSM and Septic caches share.
+'''
+import os
+import sys
+import hashlib
+import numpy as np
+import pandas as pd
+
+try:
+    import arcpy
+except ImportError:
+    # arcpy only ships with ArcGIS Pro, the shapely backend is used without it
+    arcpy = None
+
+try:
+    import geopandas as gpd
+    import shapely
+except ImportError:
+    gpd = None
+    shapely = None
+
+def addMessage(message):
+    if arcpy is not None:
+        arcpy.AddMessage(message)
+    else:
+        print(message)
+
+def addWarning(message):
+    if arcpy is not None:
+        arcpy.AddWarning(message)
+    else:
+        print(message)
+
+def addError(message):
+    if arcpy is not None:
+        arcpy.AddError(message)
+    else:
+        print(message, file=sys.stderr)
+
+# local cache folder shared by the masterlist, dissolve, landuse hierarchy and septic tank caches
+MASTERLIST_CACHE = os.path.join(os.path.expanduser('~'), '.plsm_cache')
+
+def sourceVersion(path):
+    '''
+    Path, modified time and size of the file or geodatabase a layer is stored in. Used to tell landuse and NHD
+    releases apart without reading them.
+    '''
+    path = str(path)
+    # walk up from a feature class to the .gdb folder (or shapefile) that holds it
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if not parent or parent == path:
+            return path
+        path = parent
+    if os.path.isdir(path):
+        stats = [os.stat(os.path.join(path, f)) for f in os.listdir(path)]
+        return '%s|%d|%d' % (path, max([st.st_mtime_ns for st in stats], default=0), sum(st.st_size for st in stats))
+    st = os.stat(path)
+    return '%s|%d|%d' % (path, st.st_mtime_ns, st.st_size)
+
+def geometryBackend(backend = None):
+    '''
+    Returns a backend instance from 'arcpy', 'shapely' or an existing backend. Without a choice arcpy is used when it
+    is installed and shapely otherwise.
+    '''
+    if backend is None:
+        backend = 'arcpy' if arcpy is not None else 'shapely'
+    if backend == 'arcpy':
+        return arcpyBackend()
+    if backend == 'shapely':
+        return shapelyBackend()
+    if isinstance(backend, str):
+        raise ValueError("Unknown geometry backend '" + backend + "', use 'arcpy' or 'shapely'.")
+    return backend
+
+class arcpyBackend:
+    name = 'arcpy'
+
+    def __init__(self):
+        if arcpy is None:
+            raise ImportError("arcpy is not available, use the 'shapely' geometry backend instead.")
+        arcpy.env.overwriteOutput = True
+
+    def clip(self, in_features, clip_features, out_features):
+        arcpy.Clip_analysis(in_features, clip_features, out_features)
+        return out_features
+
+    def intersect(self, in_features, out_features):
+        arcpy.analysis.Intersect(in_features, out_features)
+        return out_features
+
+    def erase(self, in_features, erase_features, out_features):
+        arcpy.analysis.Erase(in_features, erase_features, out_features)
+        return out_features
+
+    def dissolve(self, in_features, out_features, fields):
+        arcpy.Dissolve_management(in_features, out_features, fields)
+        return out_features
+
+    def area(self, in_features, field):
+        arcpy.AddField_management(in_features, field, "DOUBLE")
+        arcpy.CalculateField_management(in_features, field, "!SHAPE.AREA@SQUAREMETERS!", "PYTHON")
+
+    def buffer(self, in_features, out_features, distance):
+        arcpy.Buffer_analysis(in_features, out_features, str(distance) + " meters")
+        return out_features
+
+    def selectValues(self, in_features, out_features, field, values):
+        query = ' OR '.join(field + " = '%s'" % v if isinstance(v, str) else field + ' = %s' % v for v in values)
+        arcpy.MakeFeatureLayer_management(in_features, "select_lyr")
+        selection = arcpy.SelectLayerByAttribute_management("select_lyr", "NEW_SELECTION", query)
+        return arcpy.CopyFeatures_management(selection, out_features)
+
+    def count(self, in_features):
+        return int(arcpy.GetCount_management(in_features).getOutput(0))
+
+    def values(self, in_features, field):
+        with arcpy.da.SearchCursor(in_features, [field]) as cursor:
+            return [row[0] for row in cursor]
+
+    def table(self, in_features, fields):
+        '''
+        Attribute table of fields as a dataframe, without the geometry.
+        '''
+        return pd.DataFrame(arcpy.da.TableToNumPyArray(in_features, fields))
+
+    def tableToCSV(self, in_features, folder, name):
+        arcpy.TableToTable_conversion(in_features, folder, name)
+
+    def points(self, in_features, field):
+        '''
+        Coordinates and one attribute of a point layer as arrays (x, y, values) plus the layer's spatial reference (wkt).
+        '''
+        array = arcpy.da.FeatureClassToNumPyArray(in_features, ['SHAPE@X', 'SHAPE@Y', field])
+        # exportToString() appends the xy/z/m domains after a ';', the wkt before it is also readable by pyproj
+        crs = arcpy.Describe(in_features).spatialReference.exportToString().split(';')[0]
+        return array['SHAPE@X'], array['SHAPE@Y'], array[field], crs
+
+    def writePoints(self, x, y, table, crs, out_features):
+        '''
+        Writes points at x, y with the columns of a dataframe as attributes.
+        '''
+        sr = arcpy.SpatialReference()
+        sr.loadFromString(crs)
+        table = table.assign(SHAPE_X=x, SHAPE_Y=y)
+        text = {c: 'U254' for c in table.columns if table[c].dtype == object}
+        arcpy.da.NumPyArrayToFeatureClass(table.to_records(index=False, column_dtypes=text), out_features,
+                                          ('SHAPE_X', 'SHAPE_Y'), sr)
+        return out_features
+
+    def joinFields(self, in_features, table, key, folder, name):
+        '''
+        Copies in_features to folder\\name.gdb\\name and joins the columns of a dataframe to it on key in one pass.
+        '''
+        gdb = os.path.join(folder, name + '.gdb')
+        if not arcpy.Exists(gdb):
+            arcpy.management.CreateFileGDB(folder, name + '.gdb')
+        out_features = os.path.join(gdb, name)
+        arcpy.management.CopyFeatures(in_features, out_features)
+
+        table = table.drop(columns=[c for c in table.columns if c != key and c in
+                                    [f.name for f in arcpy.ListFields(out_features)]])
+        text = {c: 'U254' for c in table.columns if table[c].dtype == object}
+        arcpy.da.ExtendTable(out_features, key, table.to_records(index=False, column_dtypes=text), key)
+        return out_features
+
+    def shapes(self, layer, crs = None):
+        '''
+        Geometries of a layer as shapely geometries, projected to crs (wkt) when given.
+        '''
+        sr = None
+        if crs is not None:
+            sr = arcpy.SpatialReference()
+            sr.loadFromString(crs)
+        with arcpy.da.SearchCursor(layer, ['SHAPE@'], spatial_reference=sr) as cursor:
+            return list(shapely.from_wkb([bytes(row[0].WKB) for row in cursor]))
+
+    def geometryHash(self, layer):
+        '''
+        Hash of every geometry in a layer plus its spatial reference, independent of feature order.
+        '''
+        h = hashlib.sha1(str(arcpy.Describe(layer).spatialReference.factoryCode).encode())
+        with arcpy.da.SearchCursor(layer, ['SHAPE@WKB']) as cursor:
+            for wkb in sorted(bytes(row[0]) for row in cursor):
+                h.update(wkb)
+        return h.hexdigest()
+
+class shapelyBackend:
+    name = 'shapely'
+
+    def __init__(self):
+        if gpd is None:
+            raise ImportError("The 'shapely' geometry backend needs geopandas and shapely 2 installed.")
+        # layers written by this backend, kept so the next step does not read them back from disk
+        self.layers = {}
+
+    def outPath(self, path):
+        # arcpy writes a shapefile when an output in a folder has no extension
+        path = str(path)
+        if not os.path.splitext(path)[1] and '.gdb' not in path.lower():
+            path = path + '.shp'
+        return path
+
+    def read(self, layer, bbox = None, columns = None):
+        '''
+        Reads a shapefile, GeoPackage or file geodatabase feature class (including ones inside a feature dataset).
+        bbox limits the read to features touching the bounds of another GeoDataFrame through the source's spatial index.
+        columns reads only those attributes and skips the geometry.
+        '''
+        attributes = {} if columns is None else {'columns': columns, 'ignore_geometry': True}
+        layer = str(layer)
+        for key in (layer, self.outPath(layer)):
+            if key in self.layers:
+                return self.layers[key]
+
+        gdb = layer.lower().find('.gdb')
+        if gdb > -1:
+            return gpd.read_file(layer[:gdb + 4], layer=os.path.basename(layer), bbox=bbox, **attributes)
+        if not os.path.exists(layer):
+            layer = self.outPath(layer)
+        return gpd.read_file(layer, bbox=bbox, **attributes)
+
+    def shapefileColumns(self, columns, geometry):
+        '''
+        Truncates field names to the 10 characters a shapefile allows, same as arcpy/GDAL (LEVEL2_LANDUSE_CODE and
+        LEVEL2_LANDUSE_DESC become LEVEL2_LAN and LEVEL2_L_1).
+        '''
+        names = []
+        for c in columns:
+            name = c if c == geometry else str(c)[:10]
+            n = 1
+            while name in names:
+                name = str(c)[:8] + '_' + str(n)
+                n += 1
+            names.append(name)
+        return names
+
+    def write(self, gdf, out_features):
+        path = self.outPath(out_features)
+        gdf = gdf.reset_index(drop=True)
+        if path.lower().endswith('.shp'):
+            gdf.columns = self.shapefileColumns(gdf.columns, gdf.geometry.name)
+        gdf.to_file(path)
+        self.layers[path] = gdf
+        return path
+
+    def metric(self, gdf, area = False):
+        '''
+        Returns the layer in a projected crs and the size of one crs unit in meters. Geographic layers are projected to
+        the local UTM zone for distances (buffers) and to the EPSG:6933 equal area projection for areas.
+        '''
+        if gdf.crs is None:
+            return gdf, 1.0
+        if gdf.crs.is_geographic:
+            return gdf.to_crs(6933 if area else gdf.estimate_utm_crs()), 1.0
+        return gdf, gdf.crs.axis_info[0].unit_conversion_factor
+
+    def mask(self, gdf, crs):
+        # union of every feature of a clip/erase layer in the crs of the layer being cut
+        if crs is not None and gdf.crs is not None and gdf.crs != crs:
+            gdf = gdf.to_crs(crs)
+        geom = shapely.union_all(np.asarray(gdf.geometry.values))
+        shapely.prepare(geom)
+        return geom
+
+    def polygonal(self, geoms):
+        '''
+        Keeps only the polygon parts of intersection/difference results of polygon layers. Geometry collections are
+        reduced to their polygons and results of features that only touch (points, lines) come back empty.
+        '''
+        types = shapely.get_type_id(geoms)
+        for i in np.flatnonzero(types == 7):
+            parts = shapely.get_parts(geoms[i])
+            geoms[i] = shapely.union_all(parts[np.isin(shapely.get_type_id(parts), [3, 6])])
+        for i in np.flatnonzero(np.isin(types, [0, 1, 2, 4, 5])):
+            geoms[i] = shapely.Polygon()
+        return geoms
+
+    def clip(self, in_features, clip_features, out_features):
+        '''
+        Keeps the parts of in_features inside clip_features. Candidates come from an STRtree query against the clip
+        area, features fully covered are kept as is and only the ones crossing the boundary are intersected. For point
+        layers this is a point in polygon selection.
+        '''
+        clip_gdf = self.read(clip_features)
+        gdf = self.read(in_features, bbox=clip_gdf)
+        clip_geom = self.mask(clip_gdf, gdf.crs)
+
+        geoms = np.asarray(gdf.geometry.values)
+        idx = np.sort(shapely.STRtree(geoms).query(clip_geom, predicate='intersects'))
+        out = gdf.iloc[idx]
+
+        geoms = geoms[idx].copy()
+        crossing = ~shapely.covered_by(geoms, clip_geom)
+        if crossing.any():
+            polygons = crossing & np.isin(shapely.get_type_id(geoms), [3, 6])
+            geoms[crossing] = shapely.intersection(geoms[crossing], clip_geom)
+            geoms[polygons] = self.polygonal(geoms[polygons])
+        out = out.set_geometry(geoms, crs=gdf.crs)
+        return self.write(out[~shapely.is_empty(geoms)], out_features)
+
+    def intersect(self, in_features, out_features):
+        '''
+        Pairwise intersection of two layers, attributes of both are kept.
+        '''
+        a = self.read(in_features[0])
+        b = self.read(in_features[1], bbox=a)
+        if b.crs is not None and a.crs is not None and b.crs != a.crs:
+            b = b.to_crs(a.crs)
+
+        a_geoms = np.asarray(a.geometry.values)
+        b_geoms = np.asarray(b.geometry.values)
+        ib, ia = shapely.STRtree(a_geoms).query(b_geoms, predicate='intersects')
+        geoms = shapely.intersection(a_geoms[ia], b_geoms[ib])
+        polygons = np.isin(shapely.get_type_id(a_geoms[ia]), [3, 6]) & np.isin(shapely.get_type_id(b_geoms[ib]), [3, 6])
+        geoms[polygons] = self.polygonal(geoms[polygons])
+
+        attributes = a.drop(columns=a.geometry.name).iloc[ia].reset_index(drop=True)
+        b_attributes = b.drop(columns=b.geometry.name).iloc[ib].reset_index(drop=True)
+        b_attributes.columns = [c + '_1' if c in attributes.columns else c for c in b_attributes.columns]
+        out = gpd.GeoDataFrame(pd.concat([attributes, b_attributes], axis=1), geometry=geoms, crs=a.crs)
+        return self.write(out[~shapely.is_empty(geoms)], out_features)
+
+    def erase(self, in_features, erase_features, out_features):
+        gdf = self.read(in_features)
+        erase_geom = self.mask(self.read(erase_features), gdf.crs)
+
+        geoms = np.asarray(gdf.geometry.values).copy()
+        idx = shapely.STRtree(geoms).query(erase_geom, predicate='intersects')
+        polygons = idx[np.isin(shapely.get_type_id(geoms[idx]), [3, 6])]
+        geoms[idx] = shapely.difference(geoms[idx], erase_geom)
+        geoms[polygons] = self.polygonal(geoms[polygons])
+        out = gdf.set_geometry(geoms, crs=gdf.crs)
+        return self.write(out[~shapely.is_empty(geoms)], out_features)
+
+    def dissolve(self, in_features, out_features, fields):
+        gdf = self.read(in_features)
+        out = gdf[fields + [gdf.geometry.name]].dissolve(by=fields, as_index=False, dropna=False)
+        return self.write(out, out_features)
+
+    def area(self, in_features, field):
+        # area in square meters, whatever units the layer is stored in
+        gdf = self.read(in_features).copy()
+        projected, factor = self.metric(gdf, area=True)
+        gdf[field] = shapely.area(np.asarray(projected.geometry.values))*factor**2
+        self.write(gdf, in_features)
+
+    def buffer(self, in_features, out_features, distance):
+        gdf, factor = self.metric(self.read(in_features))
+        out = gdf.set_geometry(shapely.buffer(np.asarray(gdf.geometry.values), distance/factor), crs=gdf.crs)
+        return self.write(out, out_features)
+
+    def selectValues(self, in_features, out_features, field, values):
+        gdf = self.read(in_features)
+        return self.write(gdf[gdf[field].isin(values)], out_features)
+
+    def count(self, in_features):
+        return len(self.read(in_features))
+
+    def values(self, in_features, field):
+        return self.read(in_features)[field].tolist()
+
+    def table(self, in_features, fields):
+        return pd.DataFrame(self.read(in_features, columns=fields)[fields])
+
+    def tableToCSV(self, in_features, folder, name):
+        gdf = self.read(in_features)
+        gdf.drop(columns=gdf.geometry.name).to_csv(os.path.join(folder, name), index=False)
+
+    def points(self, in_features, field):
+        gdf = self.read(in_features)
+        crs = gdf.crs.to_wkt() if gdf.crs is not None else None
+        return (shapely.get_x(np.asarray(gdf.geometry.values)), shapely.get_y(np.asarray(gdf.geometry.values)),
+                gdf[field].to_numpy(), crs)
+
+    def writePoints(self, x, y, table, crs, out_features):
+        return self.write(gpd.GeoDataFrame(table.reset_index(drop=True), geometry=gpd.points_from_xy(x, y), crs=crs), out_features)
+
+    def joinFields(self, in_features, table, key, folder, name):
+        '''
+        Joins the columns of a dataframe to in_features on key and writes them to layer name of folder/name.gpkg.
+        '''
+        gdf = self.read(in_features)
+        table = table.drop(columns=[c for c in table.columns if c != key and c in gdf.columns])
+        out = gdf.merge(table, on=key, how='left')
+        out_features = os.path.join(folder, name + '.gpkg')
+        out.to_file(out_features, layer=name)
+        return out_features
+
+    def shapes(self, layer, crs = None):
+        '''
+        Geometries of a layer as shapely geometries, projected to crs (wkt) when given.
+        '''
+        gdf = self.read(layer)
+        if crs is not None and gdf.crs is not None:
+            gdf = gdf.to_crs(crs)
+        return list(np.asarray(gdf.geometry.values))
+
+    def geometryHash(self, layer):
+        '''
+        Hash of every geometry in a layer plus its crs, independent of feature order.
+        '''
+        gdf = self.read(layer)
+        h = hashlib.sha1(str(gdf.crs.to_epsg() if gdf.crs is not None else None).encode())
+        for wkb in sorted(shapely.to_wkb(np.asarray(gdf.geometry.values))):
+            h.update(wkb)
+        return h.hexdigest()
@@ -16,6 +16,12 @@ import numpy as np
 import os
 import shutil
 import sqlite3
+import pickle
+import hashlib
+import time
+import threading
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import xlsxwriter
 import openpyxl
 
@@ -36,6 +42,407 @@ from statistics import mean, median, mode, stdev
 from scipy.stats.mstats import gmean
 from bokeh.io import curdoc
 
+IWR_DB = r'C:\sqlite\IWR62.sqlite'
+COLOR_DB = r'C:\sqlite\Lake_Color_Classification_IWR_62.sqlite'
+NNC_DATA = r'C:\development_2\NNC_data.csv'
+AGM_CACHE = os.path.join(os.path.expanduser('~'), '.plsm_cache', 'agm_cache.sqlite')
+# bump whenever the qaAGM() rules change so cached results are recalculated
+QA_VERSION = 1
+
+# opens sqlite databases on demand and keeps one handle per database
+class connectionManager:
+    def __init__(self):
+        self.connections = {}
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        '''
+        Returns the connection for the database at path, opening it read-only the first time it is asked for.
+        The same handle is shared by every caller and thread.
+        '''
+        path = os.path.abspath(str(path))
+        with self.lock:
+            if path not in self.connections:
+                # pathname2url keeps UNC shares as file:////server/share/..., Path.as_uri() gives file://server/...
+                # which sqlite reads as a host name and rejects
+                uri = 'file:' + urllib.request.pathname2url(path) + '?mode=ro'
+                self.connections[path] = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            return self.connections[path]
+
+    def close(self):
+        with self.lock:
+            for con in self.connections.values():
+                con.close()
+            self.connections = {}
+
+sqliteConnections = connectionManager()
+
+# NNC derivation tables already read, keyed by csv path
+_derivationData = {}
+
+# RawData columns used by dataPull.qaFiltered()
+# alkalinity (mg/L CaCO3) column of Lake_CLassification that splits clear lakes into NNC type 2 and 3
+ALKALINITY_COLUMN = 'Alkalinity'
+QA_COLUMNS = ['wbid', 'STA', 'year', 'month', 'day', 'mastercode', 'result', 'rcode', 'mdl']
+IWR_INDEX = ['wbid', 'mastercode', 'year']
+
+# databases already checked for the (wbid, mastercode, year) index, and whether they have it
+_iwrIndexed = {}
+
+def sqlValues(values):
+    '''
+    Normalizes a wbid/mastercode argument to a list of values. Takes a single value, a list of values or the quoted
+    SQL list used so far ("'TN', 'TP', 'CHLAC'").
+    '''
+    if isinstance(values, str):
+        return [v.strip().strip('\'"') for v in values.split(',') if v.strip().strip('\'"')]
+    if np.isscalar(values):
+        return [values]
+    return list(values)
+
+def iwrIndex(database):
+    '''
+    Checks that RawData has an index leading with (wbid, mastercode, year) so per WBID pulls are index seeks instead of
+    scans of the multi-GB table. Only checks: the IWR release stays read-only, a missing index is reported once and the
+    queries still run (as scans). Returns True when the index exists.
+    '''
+    key = database if isinstance(database, sqlite3.Connection) else os.path.abspath(str(database))
+    if key in _iwrIndexed:
+        return _iwrIndexed[key]
+
+    con = database if isinstance(database, sqlite3.Connection) else sqliteConnections.get(database)
+    indexed = False
+    for index in con.execute('PRAGMA index_list(RawData)').fetchall():
+        columns = [row[2].lower() for row in con.execute('PRAGMA index_info("%s")' % index[1]).fetchall()]
+        if columns[:len(IWR_INDEX)] == IWR_INDEX:
+            indexed = True
+            break
+    if not indexed:
+        print('WARNING: RawData of ' + str(key) + ' has no (wbid, mastercode, year) index, IWR queries will scan the '
+              'whole table. createIwrIndex() can add it to a local copy of the database.')
+    _iwrIndexed[key] = indexed
+    return indexed
+
+def createIwrIndex(database):
+    '''
+    Adds the (wbid, mastercode, year) index to RawData. This opens the database writable and changes the file (and its
+    modified time, so cached AGMs and catalogs of it are rebuilt), run it on a local copy rather than the shared release.
+    '''
+    if isinstance(database, sqlite3.Connection):
+        con = database
+    else:
+        con = sqlite3.connect(str(database))
+    try:
+        print('Indexing RawData on (wbid, mastercode, year)')
+        con.execute('CREATE INDEX IF NOT EXISTS idx_RawData_wbid_mastercode_year ON RawData (wbid, mastercode, year)')
+        con.commit()
+    finally:
+        if con is not database:
+            con.close()
+    key = database if isinstance(database, sqlite3.Connection) else os.path.abspath(str(database))
+    _iwrIndexed[key] = True
+
+def qaAGM(nutrients_df):
+    '''
+    QA filtering and annual geometric means of RawData records (QA_COLUMNS), for one or many WBIDs:
+        - drops 21FLKWAT stations, results <= 0 and G/V qualified results, U/T qualified results become mdl/sqrt(2)
+        - daily median of the results of every WBID, date and mastercode
+        - a WBID/year/mastercode needs >= 4 daily values with at least one in May-September and one outside it
+        - geometric mean (exp of the mean log) of what is left, one column per mastercode
+    Every rule is a built in group aggregation on integer keys, no per row or per group Python callbacks.
+    '''
+    nutrients_df = nutrients_df[~nutrients_df['STA'].str.contains('21FLKWAT', na=True).astype(bool)]
+    nutrients_df = nutrients_df[nutrients_df['result'] > 0]
+    # Filter qualifier codes
+    rcode = nutrients_df['rcode']
+    result = np.where(rcode.isin(['U', 'T']), pd.to_numeric(nutrients_df['mdl'])/sqrt(2), nutrients_df['result'])
+    keep = ~rcode.isin(['G', 'V']).to_numpy()
+
+    date = pd.to_datetime(nutrients_df[['year', 'month', 'day']])
+    df = pd.DataFrame({'wbid': nutrients_df['wbid'].to_numpy()[keep],
+                       'year': nutrients_df['year'].to_numpy()[keep],
+                       'month': nutrients_df['month'].to_numpy()[keep],
+                       'mastercode': pd.Categorical(nutrients_df['mastercode'].to_numpy()[keep]),
+                       'date': date.to_numpy()[keep].astype('int64'),
+                       'result': np.asarray(result, dtype=float)[keep]})
+
+    # Median of results with the same WBID, date and mastercode, kept on the first record of each
+    daily = ['wbid', 'date', 'mastercode']
+    df['result'] = df.groupby(daily, sort=False, observed=True)['result'].transform('median')
+    df = df[~df.duplicated(daily)]
+
+    # >= 4 samples per year and at least 1 sample in wet season (May-Sep) and at least 1 sample in dry
+    df['wet'] = df['month'].between(5, 9)
+    annual = df.groupby(['wbid', 'year', 'mastercode'], sort=False, observed=True)['wet']
+    size = annual.transform('size')
+    count_G = annual.transform('sum')
+    count_N = size - count_G
+    df = df[(size >= 4) & (count_G > 0) & (count_N > 0)].dropna(subset=['result'])
+
+    # Calculate geometric means
+    df = df.assign(result=np.log(df['result']))
+    agm = np.exp(df.groupby(['wbid', 'year', 'mastercode'], observed=True)['result'].mean()).unstack('mastercode')
+    agm = agm.reset_index().rename(columns={'wbid': 'WBID', 'year': 'YEAR'})
+    return agm
+
+def databaseVersion(database):
+    '''
+    Path, modified time and size of an IWR database or of the file behind an open connection, None for an in-memory
+    connection.
+    '''
+    if isinstance(database, sqlite3.Connection):
+        database = next((row[2] for row in database.execute('PRAGMA database_list') if row[1] == 'main'), '')
+        if not database:
+            return None
+    path = os.path.abspath(str(database))
+    st = os.stat(path)
+    return path, '%d|%d' % (st.st_mtime_ns, st.st_size)
+
+# persistent store of qaFiltered() results keyed by WBID, analytes, start year, IWR release and QA rule version
+class agmCache:
+    def __init__(self, path = AGM_CACHE, max_mb = 256):
+        self.path = path
+        self.max_bytes = max_mb*1024*1024
+        self.hits = 0
+        self.misses = 0
+
+    def connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        con = sqlite3.connect(self.path, timeout=60)
+        con.execute('''CREATE TABLE IF NOT EXISTS agm (key TEXT PRIMARY KEY, database TEXT, release TEXT,
+                       last_used REAL, bytes INTEGER, data BLOB)''')
+        return con
+
+    def key(self, database, wbid, analyte, start_yr):
+        '''
+        Cache key of a qaFiltered() call, None when the database has no file identity (an in-memory connection).
+        '''
+        version = databaseVersion(database)
+        if version is None:
+            return None
+        parts = [version[0], version[1], str(QA_VERSION), '|'.join(str(w) for w in sqlValues(wbid)),
+                 '|'.join(sorted(str(a) for a in sqlValues(analyte))), str(int(start_yr))]
+        return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        con = self.connect()
+        try:
+            row = con.execute('SELECT data FROM agm WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            con.execute('UPDATE agm SET last_used = ? WHERE key = ?', (time.time(), key))
+            con.commit()
+        finally:
+            con.close()
+        self.hits += 1
+        return pickle.loads(row[0])
+
+    def put(self, key, database, agm):
+        path, release = databaseVersion(database)
+        data = pickle.dumps(agm, protocol=pickle.HIGHEST_PROTOCOL)
+        con = self.connect()
+        try:
+            # results of an earlier release of the same database are never asked for again
+            con.execute('DELETE FROM agm WHERE database = ? AND release != ?', (path, release))
+            con.execute('INSERT OR REPLACE INTO agm VALUES (?, ?, ?, ?, ?, ?)',
+                        (key, path, release, time.time(), len(data), data))
+            self.evict(con)
+            con.commit()
+        finally:
+            con.close()
+
+    def evict(self, con):
+        '''
+        Removes the least recently used results until the cache fits in max_mb.
+        '''
+        total = con.execute('SELECT COALESCE(SUM(bytes), 0) FROM agm').fetchone()[0]
+        for key, size in con.execute('SELECT key, bytes FROM agm ORDER BY last_used').fetchall():
+            if total <= self.max_bytes:
+                break
+            con.execute('DELETE FROM agm WHERE key = ?', (key,))
+            total -= size
+
+    def clear(self):
+        con = self.connect()
+        try:
+            con.execute('DELETE FROM agm')
+            con.commit()
+        finally:
+            con.close()
+
+NNC_TABLE = pd.DataFrame.from_dict({'Type': [1, 2, 3], 'Color_&_Alk': ['> 40 Platinum Colbalt Units',
+                                     '≤ 40 Platinum Cobalt Units and > 20 mg/L CaCO3',
+                                     '≤ 40 Platinum Cobalt Units and ≤ 20 mg/L CaCO3' ],
+                                     'Min_TP_NNC_(mg/L)': [0.05, 0.03, 0.01],
+                                     'Min_TN_NNC_(mg/L)': [1.27, 1.05, 0.51]}).set_index('Type')
+
+# WBID lookup tables of one IWR/color classification release
+class wbidCatalog:
+    '''
+    Set of the WBIDs in RawData with the Lake_CLassification color class (and ALKALINITY_COLUMN when the table has it) of
+    each, so wbidCheck(), colorClass() and the NNC type/thresholds of a lake are dict lookups. Built by loadCatalog().
+    NNC type is 1 for high color lakes, 2 or 3 for clear lakes by alkalinity (> 20 mg/L CaCO3 is 2), None for
+    clear lakes without an alkalinity.
+    '''
+    def __init__(self, wbids, colors, alkalinity = None):
+        self.wbids = frozenset(wbids)
+        self.colors = colors
+        self.alkalinity = alkalinity or {}
+
+    def __contains__(self, wbid):
+        return wbid in self.wbids
+
+    def color(self, wbid):
+        '''
+        Lake_CLassification color class of a WBID (1 for high color lakes), None when it is not classified.
+        '''
+        return self.colors.get(wbid)
+
+    def nncType(self, wbid):
+        color = self.colors.get(wbid)
+        if color is None:
+            return None
+        if color == 1:
+            return 1
+        alkalinity = self.alkalinity.get(wbid)
+        if alkalinity is None or pd.isna(alkalinity):
+            return None
+        return 2 if alkalinity > 20 else 3
+
+    def lookup(self, wbids):
+        '''
+        Bulk lookup: one row per WBID with whether it is in RawData, its color class and its NNC type and thresholds.
+        '''
+        wbids = sqlValues(wbids)
+        catalog = pd.DataFrame({'WBID': wbids,
+                                'EXISTS': [w in self.wbids for w in wbids],
+                                'COLOR': [self.colors.get(w) for w in wbids],
+                                'Type': [self.nncType(w) for w in wbids]})
+        catalog['clr_type'] = np.where(catalog['COLOR'] == 1, 'color', np.where(catalog['COLOR'].isna(), None, 'clear'))
+        # an all None Type column is object dtype and cannot be joined to the integer NNC_TABLE index
+        catalog['Type'] = catalog['Type'].astype('Int64')
+        return catalog.join(NNC_TABLE, on='Type')
+
+# catalogs already loaded this session, keyed by the paths and releases of the two databases
+_catalogs = {}
+
+def loadCatalog(sqlite_current = IWR_DB, color_sqlite = COLOR_DB, cache_folder = os.path.dirname(AGM_CACHE),
+                alkalinity_column = ALKALINITY_COLUMN):
+    '''
+    wbidCatalog of an IWR database and color classification database. Loaded once per release of the two: kept in
+    memory for the session and pickled to cache_folder for later sessions, rebuilt when either database changes.
+    Catalogs of in-memory connections have no release and are rebuilt every call.
+    '''
+    versions = (databaseVersion(sqlite_current), databaseVersion(color_sqlite))
+    key = (versions, alkalinity_column) if None not in versions else None
+    if key in _catalogs:
+        return _catalogs[key]
+
+    cache_file = None
+    if key is not None:
+        cache_file = os.path.join(cache_folder, 'wbid_catalog_' + hashlib.md5(repr(key).encode()).hexdigest() + '.pkl')
+        if os.path.exists(cache_file):
+            try:
+                _catalogs[key] = pd.read_pickle(cache_file)
+                return _catalogs[key]
+            except Exception:
+                pass
+
+    print('Building WBID catalog')
+    iwr = sqlite_current if isinstance(sqlite_current, sqlite3.Connection) else sqliteConnections.get(sqlite_current)
+    color = color_sqlite if isinstance(color_sqlite, sqlite3.Connection) else sqliteConnections.get(color_sqlite)
+    iwrIndex(sqlite_current)
+    wbids = [row[0] for row in iwr.execute('SELECT DISTINCT wbid FROM RawData')]
+
+    # first two columns are the WBID and color class, same as colorClass() always read them
+    color_df = pd.read_sql_query('SELECT * FROM Lake_CLassification', color)
+    color_df = color_df.drop_duplicates(subset=color_df.columns[0])
+    colors = dict(zip(color_df.iloc[:, 0], color_df.iloc[:, 1]))
+    alkalinity = None
+    if alkalinity_column in color_df.columns:
+        alkalinity = dict(zip(color_df.iloc[:, 0], pd.to_numeric(color_df[alkalinity_column], errors='coerce')))
+    else:
+        print('WARNING: Lake_CLassification has no ' + alkalinity_column + ' column, clear lakes have no NNC type')
+
+    catalog = wbidCatalog(wbids, colors, alkalinity)
+    if key is not None:
+        _catalogs[key] = catalog
+    if cache_file is not None:
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            pd.to_pickle(catalog, cache_file)
+        except OSError:
+            print('WARNING: Could not write the WBID catalog cache to ' + str(cache_folder))
+    return catalog
+
+# agmCache shared by dataPull instances created with cache = True
+_agmCache = None
+
+def _agmInit():
+    '''
+    Process pool initializer for statewideAGM(). Workers open their own read-only handles instead of the parent's.
+    '''
+    global sqliteConnections
+    sqliteConnections = connectionManager()
+
+def _agmPartition(database, wbids, analytes, start_yr):
+    '''
+    QA filtered annual geometric means of one partition of WBIDs, with a column for every analyte.
+    '''
+    nutrients_df = sourceData(wbids, start_yr, analytes, sqlite_current=database).dataExtraction(QA_COLUMNS)
+    agm = qaAGM(nutrients_df)
+    return agm.reindex(columns=['WBID', 'YEAR'] + analytes)
+
+def statewideAGM(analyte, start_yr, sqlite_current = IWR_DB, store = None, partition = 200, processes = None):
+    '''
+    QA filtered annual geometric means of every WBID in RawData. The WBIDs are split into partitions of partition
+    WBIDs that the worker processes pull through the (wbid, mastercode, year) index and run through qaAGM(). At most
+    two partitions per worker are in flight, so memory stays bounded by the records of a few partitions whatever the
+    size of the database. Partitions are appended to the 'iwr_agm' table of store (a Results.resultsStore) as they
+    finish, when one is given, one row per WBID, YEAR and mastercode.
+    Returns the AGM table of all WBIDs (WBID, YEAR and one column per analyte).
+    '''
+    analytes = sqlValues(analyte)
+    iwrIndex(sqlite_current)
+    con = sqlite_current if isinstance(sqlite_current, sqlite3.Connection) else sqliteConnections.get(sqlite_current)
+    wbids = [row[0] for row in con.execute('SELECT DISTINCT wbid FROM RawData ORDER BY wbid')]
+    partitions = [wbids[i:i + partition] for i in range(0, len(wbids), partition)]
+
+    run_id = None
+    if store is not None:
+        run_id = store.newRun('AGM', os.path.dirname(os.path.abspath(str(store.path))), database = sqlite_current,
+                              analytes = analytes, start_yr = start_yr)
+
+    print('Calculating annual geometric means of ' + str(len(wbids)) + ' WBIDs')
+    frames = []
+    def collect(pending):
+        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in finished:
+            agm = future.result()
+            if store is not None:
+                # long format so the table keeps one schema whatever analytes a run asks for
+                long_agm = agm.melt(id_vars=['WBID', 'YEAR'], var_name='mastercode', value_name='AGM').dropna(subset=['AGM'])
+                store.write('iwr_agm', long_agm, run_id)
+            frames.append(agm)
+            print('Finished ' + str(len(frames)) + '/' + str(len(partitions)) + ' partitions')
+        return pending
+
+    # keep at most two partitions per worker in flight
+    window = 2*(processes or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=processes, initializer=_agmInit) as pool:
+        pending = set()
+        for wbid_partition in partitions:
+            if len(pending) >= window:
+                pending = collect(pending)
+            pending.add(pool.submit(_agmPartition, sqlite_current, wbid_partition, analytes, start_yr))
+        while pending:
+            pending = collect(pending)
+
+    if not frames:
+        return pd.DataFrame(columns=['WBID', 'YEAR'] + analytes)
+    return pd.concat(frames, ignore_index=True).sort_values(['WBID', 'YEAR']).reset_index(drop=True)
+
 # this class has waterbody characteristics
 class Waterbody:
     def __init__(self, wbid, start_yr, analyte):
@@ -46,31 +453,77 @@ class Waterbody:
 # waterbodies have data
 class sourceData(Waterbody):
     def __init__(self, wbid, start_yr, analyte,
-        sqlite_current = sqlite3.connect(r'C:\sqlite\IWR62.sqlite'),
-        color_sqlite = sqlite3.connect(r'C:\sqlite\Lake_Color_Classification_IWR_62.sqlite'),
-        derivationData = pd.read_csv(r'C:\development_2\NNC_data.csv')):
+        sqlite_current = IWR_DB,
+        color_sqlite = COLOR_DB,
+        derivationData = NNC_DATA):
         super().__init__(wbid, start_yr, analyte)
         # self.NNC = NNC
-        self.sqlite = sqlite_current
-        self.color_sqlite = color_sqlite
-        self.derivationData = derivationData
+        # databases and the NNC csv are only opened when first used, open connections can also be passed in
+        self.sqlite_path = sqlite_current
+        self.color_sqlite_path = color_sqlite
+        self.derivationData_path = derivationData
+
+    @property
+    def sqlite(self):
+        if isinstance(self.sqlite_path, sqlite3.Connection):
+            return self.sqlite_path
+        return sqliteConnections.get(self.sqlite_path)
+
+    @property
+    def color_sqlite(self):
+        if isinstance(self.color_sqlite_path, sqlite3.Connection):
+            return self.color_sqlite_path
+        return sqliteConnections.get(self.color_sqlite_path)
+
+    @property
+    def derivationData(self):
+        if isinstance(self.derivationData_path, pd.DataFrame):
+            return self.derivationData_path
+        if self.derivationData_path not in _derivationData:
+            _derivationData[self.derivationData_path] = pd.read_csv(self.derivationData_path)
+        return _derivationData[self.derivationData_path]
 
     def sqliteDestination(self, folder):
-        self.sqlite  = sqlite3.connect(folder)
+        self.sqlite_path = folder
         return self.sqlite
 
-    def dataExtraction(self):
-        SQLquery = '''SELECT * FROM RawData WHERE wbid in ('%s')
-        AND mastercode in (%s)
-        AND year >= (%s)''' %(self.wbid, self.analyte, self.start_yr) 
-        nutrients_df = pd.read_sql_query(SQLquery, self.sqlite)
+    def dataExtraction(self, columns = None, wbid = None, analyte = None, chunk = 900):
+        '''
+        RawData records of the WBID(s) and mastercode(s) (this waterbody's by default) from start_yr on. Only columns
+        are selected when given (QA_COLUMNS for qaFiltered()), values are bound parameters and long WBID lists are
+        queried chunk at a time.
+        '''
+        wbids = sqlValues(self.wbid if wbid is None else wbid)
+        analytes = sqlValues(self.analyte if analyte is None else analyte)
+        select = ', '.join('"%s"' % c for c in columns) if columns else '*'
+        iwrIndex(self.sqlite_path)
+
+        frames = []
+        for i in range(0, max(len(wbids), 1), chunk):
+            part = wbids[i:i + chunk]
+            SQLquery = '''SELECT %s FROM RawData WHERE wbid in (%s)
+            AND mastercode in (%s)
+            AND year >= ?''' % (select, ', '.join('?'*len(part)), ', '.join('?'*len(analytes)))
+            frames.append(pd.read_sql_query(SQLquery, self.sqlite, params=part + analytes + [int(self.start_yr)]))
+        nutrients_df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
         return nutrients_df
 
+    def wbidExists(self, wbid = None):
+        '''
+        WBIDs (this waterbody's by default) that have records in RawData, an index seek per WBID.
+        '''
+        wbids = sqlValues(self.wbid if wbid is None else wbid)
+        iwrIndex(self.sqlite_path)
+        query = 'SELECT EXISTS(SELECT 1 FROM RawData WHERE wbid = ? LIMIT 1)'
+        return [w for w in wbids if self.sqlite.execute(query, (w,)).fetchone()[0]]
+
 
 # This is more the interfacing side
 class dataPull:
-    def __init__(self, wbid, start_yr, analyte):
+    def __init__(self, wbid, start_yr, analyte, cache = True):
         self.nutrients =  sourceData(wbid, start_yr, analyte)
+        # True for the shared agmCache in the user's cache folder, an agmCache or False/None to always recalculate
+        self.cache = cache
 
     def iwrRUN(self, folder): #r'C:\sqlite\IWR62.sqlite'
         self.nutrients.sqliteDestination(str(folder))
@@ -81,33 +534,33 @@ class dataPull:
     def NNC_derivation(self):
         return self.nutrients.derivationData
     
-    def NNC_criteria(self):
-        NNC = {'Type': [1, 2, 3], 'Color_&_Alk': ['> 40 Platinum Colbalt Units',
-                           '≤ 40 Platinum Cobalt Units and > 20 mg/L CaCO3',
-                           '≤ 40 Platinum Cobalt Units and ≤ 20 mg/L CaCO3' ],
-                           'Min_TP_NNC_(mg/L)': [0.05, 0.03, 0.01],
-                           'Min_TN_NNC_(mg/L)': [1.27, 1.05, 0.51]}
-        NNC = pd.DataFrame.from_dict(NNC).set_index('Type')
-        return NNC
+    def catalog(self):
+        return loadCatalog(self.nutrients.sqlite_path, self.nutrients.color_sqlite_path)
+
+    def NNC_criteria(self, lake_type = False):
+        '''
+        NNC table by lake type, with lake_type = True only the row of this lake's type (None when it can't be typed).
+        '''
+        if not lake_type:
+            return NNC_TABLE.copy()
+        nnc_type = self.catalog().nncType(self.nutrients.wbid)
+        return NNC_TABLE.loc[nnc_type].copy() if nnc_type is not None else None
 
     def wbid(self):
         return self.nutrients.wbid
     
     def wbidCheck(self):
-        wbid_check = "SELECT * FROM RawData WHERE wbid in ('%s')" % (self.nutrients.wbid)
-        wbid_check = pd.read_sql_query(wbid_check, self.nutrients.sqlite)
-        if len(wbid_check) == 0:
+        exists = self.nutrients.wbid in self.catalog()
+        if not exists:
             error_string = "WBID " + "'" + self.nutrients.wbid + "' " + "does not exist or input is not formatted correctly!"
             print(error_string)
+        return exists
 
     def colorClass(self):
         # Performing Color Classification
-        color_class = "SELECT * FROM Lake_CLassification WHERE wbid in ('%s')" % (self.nutrients.wbid)
-        color_check = pd.read_sql_query(color_class, self.nutrients.color_sqlite)
-        
-        color_check.columns.values[[0, 1]] = ['WBID', 'COLOR']
-        color_check = color_check.reset_index()
-        color = color_check.loc[0, "COLOR"]
+        color = self.catalog().color(self.nutrients.wbid)
+        if color is None:
+            raise KeyError("WBID '" + str(self.nutrients.wbid) + "' has no color classification in Lake_CLassification.")
         
         if color == 1:
             clr_type = 'color'
@@ -118,42 +571,25 @@ class dataPull:
         return clr_type, color
         
     def qaFiltered(self):
-        nutrients_df = self.nutrients.dataExtraction()
-        nutrients_df = nutrients_df[nutrients_df.STA.str.contains("21FLKWAT") == False]
-        nutrients_df = nutrients_df[(nutrients_df['result'] > 0)]
-        # Filter qualifier codes
-        nutrients_df["mdl"] = pd.to_numeric(nutrients_df["mdl"])
-        square_2 = sqrt(2)
-        expression = nutrients_df["mdl"]/square_2
-        nutrients_df["result"] = np.where((nutrients_df["rcode"] == "U") | (nutrients_df["rcode"] == "T"), expression, nutrients_df["result"])
-        nutrients_df = nutrients_df.drop(nutrients_df[(nutrients_df["rcode"] == "G") | (nutrients_df["rcode"] == "V")].index)
-        # Creating unique ID to calculate daily average of results with same date, station ID, and mastercode
-        nutrients_df['date'] = pd.to_datetime(nutrients_df[['year','month', 'day']])
-        nutrients_df['date'] = nutrients_df['date'].dt.strftime('%Y-%m-%d')
-        nutrients_df['med_date'] = nutrients_df[['date', 'mastercode']].apply(lambda x: ''.join(x), axis=1)
-        avg_samples = nutrients_df.groupby('med_date', as_index=False).agg({"result": "median"})
-        # Creating dictionary of avg samples by station and date
-        avg_dict = avg_samples.set_index('med_date').to_dict()['result']
-        # Dropping duplicate Station Dates
-        nutrients_df = nutrients_df.drop_duplicates(subset=['med_date'])
-        # Replacinnutrients_dfg main dataframe with averages
-        nutrients_df['result'] = nutrients_df['med_date'].map(avg_dict)
-        # Filter results for calculating geomeans - must be >= 4 samples per year and at least 1 sample in wet season and at least 1 sample in dry
-        nutrients_df['result'] = nutrients_df.groupby(["year", "mastercode"])['result'].transform(lambda x: x if len(x) >= 4 else np.nan)
-        nutrients_df = nutrients_df.sort_values(["year"])
-        nutrients_df['Season'] = 'N'
-        nutrients_df.loc[(nutrients_df['month'].between(4,10, inclusive = False)), 'Season'] = 'G'
-        nutrients_df['Count_G'] = nutrients_df.groupby(['year', 'mastercode'])['Season'].transform(lambda x: x[x.str.contains('G')].count())
-        nutrients_df['Count_N'] = nutrients_df.groupby(['year', 'mastercode'])['Season'].transform(lambda x: x[x.str.contains('N')].count())
-        mask = ((nutrients_df['Count_G'] <= 0) | (nutrients_df['Count_N'] <= 0))
-        nutrients_df.loc[mask, ['result']] = np.nan
-        # Drop NaN values so that data is not lost to pivot table
-        nutrients_df = nutrients_df.dropna(subset=['result'])
-        # Calculate geometric means
-        nutrients_df = pd.pivot_table(nutrients_df, values = 'result', index=['wbid','year'], columns = 'mastercode',aggfunc={"result":[gmean]}).reset_index()
-        nutrients_df.columns = nutrients_df.columns.droplevel()
-        nutrients_df.columns.values[[0, 1]] = ['WBID', 'YEAR']
-        return nutrients_df
+        global _agmCache
+        cache = self.cache
+        if cache is True:
+            if _agmCache is None:
+                _agmCache = agmCache()
+            cache = _agmCache
+
+        key = None
+        if cache:
+            key = cache.key(self.nutrients.sqlite_path, self.nutrients.wbid, self.nutrients.analyte, self.nutrients.start_yr)
+            if key is not None:
+                agm = cache.get(key)
+                if agm is not None:
+                    return agm
+
+        agm = qaAGM(self.nutrients.dataExtraction(QA_COLUMNS))
+        if key is not None:
+            cache.put(key, self.nutrients.sqlite_path, agm)
+        return agm
 
 
 
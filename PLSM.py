@@ -17,35 +17,601 @@ Multi-faceted python script with multiple uses.
 
 '''
 import os
-import arcpy
+import glob
+import json
+import time
+import shutil
+import hashlib
+import uuid
+from datetime import datetime
 import pandas as pd
 import numpy as np
 import xlsxwriter
 from pathlib import Path
 from collections import OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 import sys
-from openpyxl import load_workbook
 
-from math import pi
+from math import pi, floor, ceil
 from bokeh.palettes import viridis
 from bokeh.plotting import figure, show
 from bokeh.transform import cumsum
 from bokeh.io import save, output_file, export_png
 from bokeh.layouts import column
 
-arcpy.env.overwriteOutput = True
+from Geometry import arcpy, geometryBackend, addWarning, addError, sourceVersion, MASTERLIST_CACHE
+from Results import resultsStore
+
+try:
+    import rasterio
+    from rasterio import features, windows
+    import shapely
+except ImportError:
+    # only needed for gridded rainfall (PLSM.rainfallRaster)
+    rasterio = None
+
+if arcpy is not None:
+    arcpy.env.overwriteOutput = True
+
+MASTERLIST = r"\\fldep1\WQETP\TMDL\GIS_Tools\Statewide_landuse_masterlist_harper.csv"
+
+# Masterlists already read this session, keyed by source path
+_masterlists = {}
+
+def masterlistIndex(joinfile):
+    '''
+    Indexes a landuse masterlist on LEVEL2_LANDUSE_CODE for keyed lookups (scenarios()). The code column is kept.
+    '''
+    joinfile = joinfile.copy()
+    joinfile.index = joinfile['LEVEL2_LANDUSE_CODE'].values
+    return joinfile
+
+def landuseMasterlist(source = MASTERLIST, cache_folder = MASTERLIST_CACHE):
+    '''
+    Reads the statewide landuse masterlist on first use and keeps it in memory for the rest of the session.
+    A local pickle of the indexed table is kept in cache_folder so later sessions skip the network read, it is
+    rebuilt whenever the size or modified time of the source csv changes.
+    '''
+    stat = os.stat(source)
+    stamp = (stat.st_mtime_ns, stat.st_size)
+
+    if source in _masterlists and _masterlists[source][0] == stamp:
+        return _masterlists[source][1]
+
+    cache_file = os.path.join(cache_folder, 'masterlist_' + hashlib.md5(str(source).encode()).hexdigest() + '.pkl')
+    joinfile = None
+    if os.path.exists(cache_file):
+        try:
+            cached_stamp, joinfile = pd.read_pickle(cache_file)
+            if tuple(cached_stamp) != stamp:
+                joinfile = None
+        except Exception:
+            joinfile = None
+
+    if joinfile is None:
+        print('Reading landuse masterlist')
+        joinfile = masterlistIndex(pd.read_csv(source))
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            pd.to_pickle((stamp, joinfile), cache_file)
+        except OSError:
+            addWarning('WARNING: Could not write the local landuse masterlist cache to ' + str(cache_folder))
+
+    _masterlists[source] = (stamp, joinfile)
+    return joinfile
+
+# Level 1/level 2 landuse hierarchies already built this session, keyed by landuse source version
+_hierarchies = {}
+
+def landuseHierarchy(landuse, geo, joinfile = None, cache_folder = MASTERLIST_CACHE):
+    '''
+    Level 1/level 2 landuse lookup (LEVEL1_LAN, LEVEL1_L_1, LEVEL2_LAN) with one row per level 2 code.
+    Taken from the masterlist when it has LEVEL1_LANDUSE_CODE and LEVEL1_LANDUSE_DESC columns, otherwise the code
+    pairs of the landuse source are read once (attributes only) and cached in cache_folder for that source version.
+    '''
+    columns = ['LEVEL1_LAN', 'LEVEL1_L_1', 'LEVEL2_LAN']
+    if joinfile is not None and {'LEVEL1_LANDUSE_CODE', 'LEVEL1_LANDUSE_DESC'} <= set(joinfile.columns):
+        hierarchy = joinfile[['LEVEL1_LANDUSE_CODE', 'LEVEL1_LANDUSE_DESC', 'LEVEL2_LANDUSE_CODE']]
+        return hierarchy.drop_duplicates('LEVEL2_LANDUSE_CODE').set_axis(columns, axis=1).reset_index(drop=True)
+
+    version = sourceVersion(landuse)
+    if version in _hierarchies:
+        return _hierarchies[version]
+
+    cache_file = os.path.join(cache_folder, 'hierarchy_' + hashlib.md5(version.encode()).hexdigest() + '.pkl')
+    hierarchy = None
+    if os.path.exists(cache_file):
+        try:
+            hierarchy = pd.read_pickle(cache_file)
+        except Exception:
+            hierarchy = None
+
+    if hierarchy is None:
+        print('Indexing landuse hierarchy')
+        hierarchy = geo.table(landuse, ['LEVEL1_LANDUSE_CODE', 'LEVEL1_LANDUSE_DESC', 'LEVEL2_LANDUSE_CODE'])
+        hierarchy = hierarchy.drop_duplicates('LEVEL2_LANDUSE_CODE').set_axis(columns, axis=1).reset_index(drop=True)
+        try:
+            os.makedirs(cache_folder, exist_ok=True)
+            pd.to_pickle(hierarchy, cache_file)
+        except OSError:
+            addWarning('WARNING: Could not write the local landuse hierarchy cache to ' + str(cache_folder))
+
+    _hierarchies[version] = hierarchy
+    return hierarchy
+
+# persistent store of Clip/Dissolve/calculateField outputs keyed by watershed geometry and landuse/NHD versions
+class dissolveCache:
+    def __init__(self, folder = os.path.join(MASTERLIST_CACHE, 'dissolve'), max_mb = 2048):
+        self.folder = folder
+        self.max_bytes = max_mb*1024*1024
+        self.index_file = os.path.join(folder, 'index.json')
+        self.lock_file = os.path.join(folder, 'index.lock')
+        # hits and misses of this session, the index keeps the running totals
+        self.hits = 0
+        self.misses = 0
+
+    @contextmanager
+    def lock(self, timeout = 600):
+        '''
+        Holds index.lock while the index is read and written and entries are copied or evicted, batch workers
+        share the cache folder. A lock older than timeout seconds is taken to be left by a crashed process.
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        while True:
+            try:
+                fd = os.open(self.lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self.lock_file) > timeout:
+                        os.remove(self.lock_file)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.close(fd)
+            os.remove(self.lock_file)
+
+    def key(self, geo, watershed, landuse, NHD_waterbody, clip_type):
+        parts = [geo.name, geo.geometryHash(watershed), sourceVersion(landuse), clip_type]
+        if clip_type == 'Analysis':
+            parts.append(sourceVersion(NHD_waterbody))
+        return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+    def readIndex(self):
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    return json.load(f)
+            except ValueError:
+                pass
+        return {'hits': 0, 'misses': 0, 'entries': {}}
+
+    def writeIndex(self, index):
+        os.makedirs(self.folder, exist_ok=True)
+        temp_file = self.index_file + '.' + str(os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(index, f)
+        os.replace(temp_file, self.index_file)
+
+    def get(self, key, temp_folder_path):
+        '''
+        Copies a cached dissolve shapefile, clip shapefile and wshed_landuse.csv into temp_folder_path.
+        Returns (dissolve_input, n_rows, clip_input) or None on a miss.
+        '''
+        with self.lock():
+            index = self.readIndex()
+            entry_folder = os.path.join(self.folder, key)
+            if key not in index['entries'] or not os.path.isdir(entry_folder):
+                self.misses += 1
+                index['misses'] += 1
+                self.writeIndex(index)
+                return None
+
+            if not os.path.exists(temp_folder_path):
+                os.makedirs(temp_folder_path)
+            for f in os.listdir(entry_folder):
+                shutil.copy2(os.path.join(entry_folder, f), temp_folder_path)
+
+            entry = index['entries'][key]
+            entry['last_used'] = time.time()
+            self.hits += 1
+            index['hits'] += 1
+            self.writeIndex(index)
+        return (os.path.join(temp_folder_path, entry['dissolve_input']), entry['n_rows'],
+                os.path.join(temp_folder_path, entry['clip_input']))
+
+    def put(self, key, temp_folder_path, dissolve_input, n_rows, clip_input):
+        entry_folder = os.path.join(self.folder, key)
+        # every file that makes up the two shapefiles
+        files = glob.glob(os.path.splitext(dissolve_input)[0] + '.*') + glob.glob(os.path.splitext(clip_input)[0] + '.*')
+        files.append(os.path.join(temp_folder_path, 'wshed_landuse.csv'))
+
+        with self.lock():
+            os.makedirs(entry_folder, exist_ok=True)
+            for f in files:
+                shutil.copy2(f, entry_folder)
+
+            index = self.readIndex()
+            index['entries'][key] = {'dissolve_input': os.path.basename(dissolve_input),
+                                     'clip_input': os.path.basename(clip_input),
+                                     'n_rows': n_rows,
+                                     'bytes': sum(os.path.getsize(f) for f in files),
+                                     'last_used': time.time()}
+            self.evict(index)
+            self.writeIndex(index)
+
+    def evict(self, index):
+        '''
+        Removes the least recently used entries until the cache fits in max_mb. Called with the lock held.
+        '''
+        entries = index['entries']
+        total = sum(e['bytes'] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['last_used']):
+            if total <= self.max_bytes:
+                break
+            total -= entries[key]['bytes']
+            shutil.rmtree(os.path.join(self.folder, key), ignore_errors=True)
+            del entries[key]
+
+    def report(self):
+        with self.lock():
+            index = self.readIndex()
+        report = {'session_hits': self.hits, 'session_misses': self.misses,
+                  'total_hits': index['hits'], 'total_misses': index['misses'],
+                  'entries': len(index['entries']),
+                  'size_mb': round(sum(e['bytes'] for e in index['entries'].values())/1024/1024, 1)}
+        print('Dissolve cache: %(session_hits)d hits, %(session_misses)d misses this session '
+              '(%(total_hits)d/%(total_misses)d overall), %(entries)d entries, %(size_mb)s MB' % report)
+        return report
+
+def zonalMean(src, shapes, chunk_rows = 1024):
+    '''
+    Mean of every band of an open rasterio dataset inside each of the shapes, returned as a bands x shapes array.
+    The shapes are burned into a label grid over the window they cover and read chunk_rows rows at a time, each chunk
+    is reduced for all bands and shapes with a single bincount. Shapes too small to hold a cell center get the mean of
+    the whole area, shapes entirely outside the raster get NaN (with a warning).
+    '''
+    n = len(shapes)
+    bands = src.count
+    sums = np.zeros(bands*(n + 1))
+    counts = np.zeros(bands*(n + 1))
+
+    if n == 0:
+        return np.zeros((bands, 0))
+    left, right = sorted([src.bounds.left, src.bounds.right])
+    bottom, top = sorted([src.bounds.bottom, src.bounds.top])
+    xmin, ymin, xmax, ymax = shapely.bounds(np.asarray(shapes, dtype=object)).T
+    outside = (xmax <= left) | (xmin >= right) | (ymax <= bottom) | (ymin >= top)
+    if outside.any():
+        addWarning(str(int(outside.sum())) + ' of ' + str(n) + ' shapes fall outside the raster, their mean is NaN.')
+
+    # floor the near edges and ceil the far ones so every cell a shape touches is read, then clip to the raster
+    bounds = windows.from_bounds(*shapely.total_bounds(shapes), transform=src.transform)
+    col_off, row_off = max(floor(bounds.col_off), 0), max(floor(bounds.row_off), 0)
+    col_end = min(ceil(bounds.col_off + bounds.width), src.width)
+    row_end = min(ceil(bounds.row_off + bounds.height), src.height)
+    area = windows.Window(col_off, row_off, max(col_end - col_off, 0), max(row_end - row_off, 0))
+    # label 0 is outside every shape, shape i is burned as i + 1
+    offsets = (np.arange(bands)*(n + 1))[:, None, None]
+
+    for row in range(int(area.row_off), int(area.row_off + area.height) if area.width > 0 else 0, chunk_rows):
+        window = windows.Window(area.col_off, row, area.width, min(chunk_rows, area.row_off + area.height - row))
+        labels = features.rasterize(((s, i + 1) for i, s in enumerate(shapes)), out_shape=(int(window.height), int(window.width)),
+                                    transform=src.window_transform(window), fill=0, dtype='int32')
+        data = src.read(window=window, masked=True).astype(float).filled(np.nan)
+        valid = (labels > 0)[None, :, :] & ~np.isnan(data)
+        index = (offsets + labels[None, :, :])[valid]
+        sums += np.bincount(index, weights=data[valid], minlength=bands*(n + 1))
+        counts += np.bincount(index, minlength=bands*(n + 1))
+
+    sums = sums.reshape(bands, n + 1)[:, 1:]
+    counts = counts.reshape(bands, n + 1)[:, 1:]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = sums/counts
+        overall = sums.sum(axis=1)/counts.sum(axis=1)
+    means = np.where(counts > 0, means, overall[:, None])
+    means[:, outside] = np.nan
+    return means
+
+def loadArray(rainfall_m, area, roc, emc_tn, emc_tp):
+    '''
+    Load engine for every rainfall year at once. Broadcasts the rainfall depth in meters (a vector of years, or a
+    years x landuse matrix) against the landuse area (sq m), ROC, EMC_TN and EMC_TP vectors.
+    Returns a years x landuse x 3 array holding Runoff_Volume_L, TN_Load_kg and TP_Load_kg.
+    '''
+    rainfall_m = np.asarray(rainfall_m, dtype=float)
+    if rainfall_m.ndim == 1:
+        rainfall_m = rainfall_m[:, None]
+    # Same order of operations as the original per year columns so results match to the last digit
+    runoff_L = rainfall_m*np.asarray(area, dtype=float)*1000*np.asarray(roc, dtype=float)
+
+    loads = np.empty(runoff_L.shape + (3,))
+    loads[..., 0] = runoff_L
+    loads[..., 1] = runoff_L*np.asarray(emc_tn, dtype=float)/1000000
+    loads[..., 2] = runoff_L*np.asarray(emc_tp, dtype=float)/1000000
+    return loads
+
+def _monteCarloChunk(rainfall_m, area, point, cv, size, seed):
+    '''
+    Samples size realizations of ROC, EMC_TN and EMC_TP per landuse (lognormal around the point values with the given
+    coefficients of variation, ROC capped at 1) and runs them through loadArray() as one realizations x years x landuse
+    batch. Returns the yearly runoff (m3)/TN/TP totals (size x years x 3) and long term average TN/TP per acre
+    (size x landuse x 2).
+    '''
+    rng = np.random.default_rng(seed)
+    with np.errstate(divide='ignore'):
+        sigma = np.sqrt(np.log1p(cv**2))
+        mu = np.log(point) - sigma**2/2
+    samples = np.exp(mu[:, None, :] + sigma[:, None, :]*rng.standard_normal((3, size, len(area))))
+    samples[0] = np.minimum(samples[0], 1)
+    return _realizationTotals(rainfall_m, area, samples[:, :, None, :])
+
+def _realizationTotals(rainfall_m, area, params):
+    '''
+    Yearly totals and long term average per acre loads of realizations x 1 x landuse ROC, EMC_TN and EMC_TP (params
+    stacked on the first axis), see _monteCarloChunk().
+    '''
+    loads = loadArray(rainfall_m, area, params[0], params[1], params[2])
+    yearly = loads.sum(axis=2)
+    yearly[..., 0] /= 1000
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lta = loads[..., 1:].mean(axis=1)/(area*0.00024711)[None, :, None]
+    return yearly, lta.astype(np.float32)
+
+class logHistogram:
+    '''
+    Fixed-bin histograms of many series at once, monteCarlo() reduces every chunk of realizations into one so memory
+    does not grow with the ensemble size. The bins of a series are evenly spaced in log between center*exp(-spread)
+    and center*exp(spread), values outside land in the end bins, zeros are counted apart and NaNs are skipped.
+    percentile() finds the bin holding the same rank np.percentile interpolates at, interpolates within it and clamps
+    to the exact minimum and maximum seen, so it is within a fraction of a bin width (2*spread/bins in log) of the
+    exact percentile.
+    '''
+    def __init__(self, center, spread, bins = 4096):
+        center = np.asarray(center, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_center = np.log(center).ravel()
+        self.shape = center.shape
+        self.bins = bins
+        self.lo = np.where(np.isfinite(log_center), log_center, 0.0) - spread
+        self.width = 2*spread/bins
+        # column 0 counts the zeros
+        self.counts = np.zeros((log_center.size, bins + 1), dtype=np.int32)
+        self.min = np.full(log_center.size, np.inf)
+        self.max = np.full(log_center.size, -np.inf)
+
+    def add(self, values):
+        '''
+        Adds a realizations x shape array.
+        '''
+        values = np.asarray(values, dtype=float).reshape(len(values), -1)
+        valid = ~np.isnan(values)
+        series = np.broadcast_to(np.arange(values.shape[1]), values.shape)[valid]
+        v = values[valid]
+        with np.errstate(divide='ignore'):
+            b = np.clip(np.floor((np.log(v) - self.lo[series])/self.width), 0, self.bins - 1)
+        b = np.where(v > 0, b + 1, 0).astype(np.int64)
+        self.counts += np.bincount(series*(self.bins + 1) + b, minlength=self.counts.size).reshape(self.counts.shape).astype(np.int32)
+        self.min = np.minimum(self.min, np.where(valid, values, np.inf).min(axis=0))
+        self.max = np.maximum(self.max, np.where(valid, values, -np.inf).max(axis=0))
+
+    def orderStatistic(self, cumulative, k):
+        '''
+        Estimate of the k-th smallest value of every series (k a float array of whole ranks), the values of a bin are
+        taken as evenly spread across it.
+        '''
+        series = np.arange(len(k))
+        b = np.minimum((cumulative <= k[:, None]).sum(axis=1), self.bins)
+        before = np.where(b > 0, cumulative[series, np.maximum(b - 1, 0)], 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            frac = np.clip((k - before + 0.5)/self.counts[series, b], 0, 1)
+        value = np.where(b > 0, np.exp(self.lo + (b - 1 + frac)*self.width), 0.0)
+        return np.clip(value, self.min, self.max)
+
+    def percentile(self, q):
+        '''
+        Percentiles q as a len(q) x shape array, NaN for a series without values. Interpolates linearly between the
+        two order statistics around the rank like np.percentile.
+        '''
+        q = np.asarray(q, dtype=float)
+        cumulative = np.cumsum(self.counts, axis=1, dtype=np.int64)
+        total = cumulative[:, -1]
+        out = np.full((len(q), len(total)), np.nan)
+        for i, p in enumerate(q):
+            rank = np.maximum(total - 1, 0)*p/100
+            low, high = np.floor(rank), np.ceil(rank)
+            low_value = self.orderStatistic(cumulative, low)
+            high_value = self.orderStatistic(cumulative, high)
+            with np.errstate(invalid='ignore'):
+                out[i] = np.where(total > 0, low_value + (rank - low)*(high_value - low_value), np.nan)
+        return out.reshape((len(q),) + self.shape)
+
+class annualLoads(Mapping):
+    '''
+    Output of PLSM.writeData(). Holds the years x landuse load array next to the merged landuse table (join1) and
+    behaves like the old dictionary of yearly dataframes, d[year] only builds the PLSM_raw sheet for that year when asked.
+    '''
+    fields = ['Runoff_Volume_L', 'TN_Load_kg', 'TP_Load_kg']
+
+    def __init__(self, join1, years, rainfall_in, loads, rainfall_grid_in = None):
+        self.join1 = join1.reset_index(drop=True)
+        self.years = list(years)
+        self.rainfall_in = np.asarray(rainfall_in, dtype=float)
+        self.rainfall_m = self.rainfall_in*0.0254
+        # years x landuse rainfall (inches) when it comes from a rainfall grid, see PLSM.rainfallRaster()
+        self.rainfall_grid_in = None if rainfall_grid_in is None else np.asarray(rainfall_grid_in, dtype=float)
+        self.loads = loads
+        self.area = self.join1['Area_sq_m'].to_numpy(dtype=float)
+        self.position = {k: i for i, k in enumerate(self.years)}
+        self._lta = None
+        self._join1_columns = None
+
+    def __getitem__(self, k):
+        return self.frame(k)
+
+    def __iter__(self):
+        return iter(self.years)
+
+    def __len__(self):
+        return len(self.years)
+
+    def rainfallMatrix(self):
+        '''
+        Rainfall depth in meters as a years x 1 column (basin rainfall) or years x landuse matrix (rainfall grid),
+        ready to broadcast through loadArray().
+        '''
+        if self.rainfall_grid_in is None:
+            return self.rainfall_m[:, None]
+        return self.rainfall_grid_in*0.0254
+
+    def field(self, name):
+        '''
+        Returns the years x landuse matrix of one load field.
+        '''
+        return self.loads[..., self.fields.index(name)]
+
+    def yearColumns(self, i):
+        '''
+        Rainfall, rainfall volume and load columns of the i-th year. With a single basin rainfall, Rainfall_in and
+        Rainfall_m are only written to the first row as before, with a rainfall grid every landuse has its own.
+        '''
+        if self.rainfall_grid_in is None:
+            rain_in = np.full(len(self.join1), np.nan)
+            rain_in[:1] = self.rainfall_in[i]
+            volume_m3 = self.rainfall_m[i]*self.area
+        else:
+            rain_in = self.rainfall_grid_in[i]
+            volume_m3 = rain_in*0.0254*self.area
+        return [rain_in, rain_in*0.0254, volume_m3, volume_m3*1000] + [self.loads[i, :, j] for j in range(len(self.fields))]
+
+    def frame(self, k):
+        '''
+        Builds the PLSM_raw sheet of year k.
+        '''
+        df = self.join1.copy()
+        for name, values in zip(self.sheetHeader()[len(self.join1.columns):], self.yearColumns(self.position[k])):
+            df[name] = values
+        return df
+
+    def sheetHeader(self):
+        return list(self.join1.columns) + ['Rainfall_in', 'Rainfall_m', 'Rainfall_Volume_m3', 'Rainfall_Volume_L'] + self.fields
+
+    def sheetRows(self, k):
+        '''
+        Rows of the PLSM_raw sheet of year k, same values as frame(k) but without building a dataframe.
+        '''
+        if self._join1_columns is None:
+            self._join1_columns = [self.join1[c].tolist() for c in self.join1.columns]
+        year_columns = self.yearColumns(self.position[k])
+        return zip(*(self._join1_columns + [c.tolist() for c in year_columns]))
+
+    def yearlyTotals(self):
+        '''
+        Sums runoff (m3), TN and TP (kg) over landuse for every year.
+        '''
+        Year = [str(k) for k in self.years]
+        Yearly_Runoff_Volume_m3 = (self.field('Runoff_Volume_L')/1000).sum(axis=1)
+        Yearly_TN_Load_kg = self.field('TN_Load_kg').sum(axis=1)
+        Yearly_TP_Load_kg = self.field('TP_Load_kg').sum(axis=1)
+        return Year, Yearly_Runoff_Volume_m3, Yearly_TN_Load_kg, Yearly_TP_Load_kg
+
+    def longTable(self):
+        '''
+        One record per year and level 2 landuse, the long format written to the results store.
+        '''
+        n_landuse = len(self.join1)
+        return pd.DataFrame({'Year': np.repeat([str(k) for k in self.years], n_landuse),
+                             'LEVEL2_LAN': np.tile(self.join1['LEVEL2_LAN'].to_numpy(), len(self.years)),
+                             'LEVEL2_L_1': np.tile(self.join1['LEVEL2_L_1'].to_numpy(), len(self.years)),
+                             'Area_sq_m': np.tile(self.area, len(self.years)),
+                             'Rainfall_m': (np.repeat(self.rainfall_m, n_landuse) if self.rainfall_grid_in is None
+                                            else self.rainfall_grid_in.ravel()*0.0254),
+                             'Runoff_Volume_L': self.field('Runoff_Volume_L').ravel(),
+                             'TN_Load_kg': self.field('TN_Load_kg').ravel(),
+                             'TP_Load_kg': self.field('TP_Load_kg').ravel()})
+
+    def bathtubTable(self):
+        '''
+        Yearly precipitation, runoff volume and TN/TP concentrations for the BATHTUB input, sorted by year like PLSM_summary.
+        '''
+        Year, Yearly_Runoff_Volume_m3, Yearly_TN_Load_kg, Yearly_TP_Load_kg = self.yearlyTotals()
+        bathtub = pd.DataFrame({'Year': Year,
+                                'Precipitation  (meters)': self.rainfall_m,
+                                'Runoff Volume (hm3)': Yearly_Runoff_Volume_m3/1000000,
+                                'TN (ppb)': Yearly_TN_Load_kg/Yearly_Runoff_Volume_m3*1000000,
+                                'TP (ppb)': Yearly_TP_Load_kg/Yearly_Runoff_Volume_m3*1000000})
+        return bathtub.sort_values('Year').reset_index(drop=True)
+
+    def annualTable(self):
+        '''
+        Wide landuse x years table of per acre loading with TN_<year> and TP_<year> columns, used by annualLoading().
+        '''
+        acres = self.area*0.00024711
+        with np.errstate(divide='ignore', invalid='ignore'):
+            TN = self.field('TN_Load_kg')/acres
+            TP = self.field('TP_Load_kg')/acres
+
+        columns = {}
+        for i, k in enumerate(self.years):
+            columns['TN_' + str(k)] = TN[i]
+            columns['TP_' + str(k)] = TP[i]
+        return pd.concat([self.join1[['LEVEL2_LAN', 'LEVEL2_L_1']], pd.DataFrame(columns)], axis=1)
+
+    def lta(self):
+        '''
+        Long term average loading of every level 2 landuse, reduced over the year axis once and shared by ltaLoading()
+        and pieChart(). TN_Acre/TP_Acre are the average loads per acre, TN_Kg/TP_Kg the average total loads.
+        '''
+        if self._lta is None:
+            yr_count = len(self.years)
+            # Convert sq^m to acre
+            acres = self.area*0.00024711
+            TN = self.field('TN_Load_kg')
+            TP = self.field('TP_Load_kg')
+
+            lta = self.join1[['LEVEL2_LAN', 'LEVEL2_L_1']].copy()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                lta['TN_Acre'] = (TN/acres).sum(axis=0)/yr_count
+                lta['TP_Acre'] = (TP/acres).sum(axis=0)/yr_count
+            lta['TN_Kg'] = TN.sum(axis=0)/yr_count
+            lta['TP_Kg'] = TP.sum(axis=0)/yr_count
+            self._lta = lta
+        return self._lta.copy()
 
 class PLSM:
     def __init__(self, watershed_input, rainfall_input, folder_location,
-                 joinfile = pd.read_csv(r"\\fldep1\WQETP\TMDL\GIS_Tools\Statewide_landuse_masterlist_harper.csv"),
+                 joinfile = None,
                  landuse_input = r"\\floridadep.net\GIS\GeoData\geopub\geopub.gdb\STATEWIDE_LANDUSE",
-                 NHD_waterbody = r"\\floridadep.net\\GIS\\geodata\\geopub\\NHD.gdb\\Hydrography\\NHDWaterbody"):
+                 NHD_waterbody = r"\\floridadep.net\\GIS\\geodata\\geopub\\NHD.gdb\\Hydrography\\NHDWaterbody",
+                 backend = None):
         self.watershed = watershed_input
         self.rainfall = rainfall_input
         self.folder = folder_location
-        self.joinfile = joinfile
+        # joinfile can be a dataframe, a csv path or None for the statewide masterlist, it is only read on first use
+        self._joinfile = joinfile
         self.landuse = landuse_input
         self.NHD_waterbody = NHD_waterbody
+        # 'arcpy' or 'shapely' geometry backend (see Geometry.py), arcpy when it is installed
+        self.geo = geometryBackend(backend)
+
+    @property
+    def joinfile(self):
+        '''
+        Landuse masterlist indexed on LEVEL2_LANDUSE_CODE, loaded on first use.
+        '''
+        if self._joinfile is None:
+            self._joinfile = landuseMasterlist()
+        elif isinstance(self._joinfile, (str, Path)):
+            self._joinfile = landuseMasterlist(str(self._joinfile))
+        elif not self._joinfile.index.equals(pd.Index(self._joinfile['LEVEL2_LANDUSE_CODE'])):
+            self._joinfile = masterlistIndex(self._joinfile)
+        return self._joinfile
 
     def rainfallQA(self):
         '''
@@ -61,12 +627,56 @@ class PLSM:
 
         for name in col_names:
             if name not in rainfall_df:
-                arcpy.AddError(''''The column names in the rainfall table you provided do not exist.
+                addError(''''The column names in the rainfall table you provided do not exist.
                                You should have columns labeled: Total and Year. Please check your column names and try again.''')
                 sys.exit()
 
         return rainfall_df
 
+    def rainfallRaster(self, raster, dissolve_input, years = None, chunk_rows = 1024):
+        '''
+        Takes a gridded annual rainfall stack (inches, one band per year, band descriptions or years giving the year of
+        each band) and the Dissolve() output, and computes the mean rainfall of every dissolved landuse polygon for every year.
+        Returns the rainfall_df (Year/Total, area weighted basin mean) and the year x landuse rainfall_grid for writeData(),
+        with a column per LEVEL2_LAN code (area weighted over the polygons of a code) so loadEngine() matches it to the
+        merged landuse table by code. Landuse outside the raster gets the area weighted basin rainfall.
+        '''
+        if rasterio is None:
+            addError('Gridded rainfall needs rasterio installed.')
+            sys.exit()
+
+        print('Calculating zonal rainfall per landuse')
+        with rasterio.open(raster) as src:
+            shapes = self.geo.shapes(dissolve_input, src.crs.to_wkt() if src.crs is not None else None)
+            if years is None:
+                years = [int(b) for b in src.descriptions] if all(src.descriptions) else list(range(1, src.count + 1))
+            rainfall = zonalMean(src, shapes, chunk_rows)
+
+        area = np.asarray(self.geo.values(dissolve_input, 'Area_sq_m'), dtype=float)
+        codes = np.asarray(self.geo.values(dissolve_input, 'LEVEL2_LAN'))
+        covered = ~np.isnan(rainfall).any(axis=0)
+        if not covered.any():
+            addError('The rainfall raster does not cover any landuse in the watershed.')
+            sys.exit()
+        basin = rainfall[:, covered] @ area[covered]/area[covered].sum()
+        if not covered.all():
+            addWarning('Landuse code(s) ' + str(sorted(set(codes[~covered].tolist()))) + ' fall outside the rainfall '
+                       'raster and get the area weighted basin rainfall.')
+            rainfall[:, ~covered] = basin[:, None]
+
+        # one column per level 2 code, area weighted when a code has more than one dissolved polygon
+        weighted = pd.DataFrame((rainfall*area).T, index=codes).groupby(level=0, sort=False).sum()
+        code_area = pd.Series(area, index=codes).groupby(level=0, sort=False).sum()
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rainfall_grid = weighted.div(code_area, axis=0).T.set_axis(list(years))
+        # codes without area have no weights
+        rainfall_grid = rainfall_grid.where(rainfall_grid.notna(), np.repeat(basin[:, None], rainfall_grid.shape[1], axis=1))
+        rainfall_grid.index.name = 'Year'
+        rainfall_grid.columns.name = 'LEVEL2_LAN'
+
+        rainfall_df = pd.DataFrame({'Year': list(years), 'Total': basin})
+        return rainfall_df, rainfall_grid
+
     def Clip(self, type = 'Model'):
         '''
         Takes watershed input and clips statewide landuse land cover to the watershed. The 'Analysis' dictates that intersecting waters
@@ -80,20 +690,21 @@ class PLSM:
         if not os.path.exists(temp_folder_path):
              os.mkdir(temp_folder_path)
 
-        temp_out_clip = temp_folder_path + "\landuse_clip.shp"
+        temp_out_clip = os.path.join(temp_folder_path, "landuse_clip.shp")
 
         print('Clipping landuse to watershed')
-        arcpy.Clip_analysis(self.landuse, self.watershed, temp_out_clip)
+        self.geo.clip(self.landuse, self.watershed, temp_out_clip)
 
         if type == 'Analysis':
-            intersect_waters = temp_folder_path + "\intersect.shp"
-            arcpy.analysis.Intersect([temp_out_clip, self.NHD_waterbody], intersect_waters)
+            intersect_waters = os.path.join(temp_folder_path, "intersect.shp")
+            self.geo.intersect([temp_out_clip, self.NHD_waterbody], intersect_waters)
 
-            layer_to_process = temp_folder_path + "\water_removed"
-            arcpy.analysis.Erase(temp_out_clip, intersect_waters, layer_to_process)
+            layer_to_process = os.path.join(temp_folder_path, "water_removed")
+            self.geo.erase(temp_out_clip, intersect_waters, layer_to_process)
 
         elif type == 'Model':
-            layer_to_process = temp_out_clip
+            # Dissolve() adds the extension back
+            layer_to_process = temp_out_clip[:-4]
 
         return layer_to_process, temp_folder_path
 
@@ -105,39 +716,58 @@ class PLSM:
         '''
         ## Define parameters for dissolve
         clip_input = layer_to_process + ".shp"
-        temp_out_dissolve = temp_folder_path + "\landuse_dissolve"
+        temp_out_dissolve = os.path.join(temp_folder_path, "landuse_dissolve")
 
         dissolve_fields = ["LEVEL2_LAN", "LEVEL2_L_1"] #names are truncated to 10 characters when converted to fc in the initial clip
 
         print('Dissolving by level-2 landuse')
-        arcpy.Dissolve_management(clip_input, temp_out_dissolve, dissolve_fields)
+        self.geo.dissolve(clip_input, temp_out_dissolve, dissolve_fields)
         ## Define parameters for addField and calculateField
         dissolve_input = temp_out_dissolve + ".shp"
 
         ## Get length of dissolve shapefile for later
-        rows = [row for row in arcpy.da.SearchCursor(dissolve_input,'LEVEL2_LAN')]
-        n_rows = len(rows)
+        n_rows = self.geo.count(dissolve_input)
 
         return dissolve_input, n_rows, clip_input
 
+    def clipDissolve(self, type = 'Model', cache = None):
+        '''
+        Runs Clip(), Dissolve(), calculateField() and attribute_to_CSV(). When a dissolveCache is given and the same
+        watershed geometry was already processed against the current landuse/NHD sources, their outputs are copied back
+        from the cache instead.
+        '''
+        temp_folder_path = os.path.join(self.folder, 'PLSM_shapefiles')
+        if cache is not None:
+            key = cache.key(self.geo, self.watershed, self.landuse, self.NHD_waterbody, type)
+            hit = cache.get(key, temp_folder_path)
+            if hit is not None:
+                print('Restoring clipped and dissolved landuse from cache')
+                dissolve_input, n_rows, clip_input = hit
+                return dissolve_input, n_rows, clip_input, temp_folder_path
+
+        layer_to_process, temp_folder_path = self.Clip(type)
+        dissolve_input, n_rows, clip_input = self.Dissolve(layer_to_process, temp_folder_path)
+        self.calculateField(dissolve_input)
+        self.attribute_to_CSV(dissolve_input, temp_folder_path)
+
+        if cache is not None:
+            cache.put(key, temp_folder_path, dissolve_input, n_rows, clip_input)
+        return dissolve_input, n_rows, clip_input, temp_folder_path
+
     def calculateField(self, dissolve_input):
         '''
         Takes dissolve output and calculates area in square meters for each level 2 landuse.
         '''
-        ## Run AddField
-        arcpy.AddField_management(dissolve_input, "Area_sq_m", "DOUBLE")
-
         print('Calculating landuse area')
-        ## Run CalculateField
-        exp = "!SHAPE.AREA@SQUAREMETERS!"
-        arcpy.CalculateField_management(dissolve_input, "Area_sq_m", exp, "PYTHON")
+        ## Add the field and calculate !SHAPE.AREA@SQUAREMETERS!
+        self.geo.area(dissolve_input, "Area_sq_m")
 
     def attribute_to_CSV(self, dissolve_input, temp_folder_path):
         '''
         Follwing the calculateField() function the attribte table in arcpro is converted to a csv file.
         '''
         # Execute TableToTable
-        arcpy.TableToTable_conversion(dissolve_input, temp_folder_path, "wshed_landuse.csv")
+        self.geo.tableToCSV(dissolve_input, temp_folder_path, "wshed_landuse.csv")
 
     def Merge(self, temp_folder_path, n_rows):
         '''
@@ -145,14 +775,15 @@ class PLSM:
         with each landuse type to the rest of the Statewide_landuse_masterlist_harper.csv dataset.
         '''
         print("Merging tables")
-        wshed_landuse = pd.read_csv(temp_folder_path + "\wshed_landuse.csv")
+        wshed_landuse = pd.read_csv(os.path.join(temp_folder_path, "wshed_landuse.csv"))
 
+        # same merge as always (overlapping columns get _x/_y suffixes), against the cached masterlist
         join1 = pd.merge(wshed_landuse, self.joinfile, left_on = 'LEVEL2_LAN', right_on = 'LEVEL2_LANDUSE_CODE')
         ## Check to make sure all of the dissolved statewide landuse codes matched with ROC and EMC landuse codes. If not, send error message to terminate script.
         merged_rows = len(join1.LEVEL2_LAN)
 
         if n_rows != merged_rows:
-            arcpy.AddError(''''Not all of the Statewide Landuse Codes in watershed matched with user-defined data.
+            addError(''''Not all of the Statewide Landuse Codes in watershed matched with user-defined data.
                            Please make sure all land use codes and/or descriptions match and try again.''')
             sys.exit()
         ## Check to make sure there are no missing values in ROC and EMC columns
@@ -160,24 +791,45 @@ class PLSM:
         if not missing_list:
             pass
         else:
-            arcpy.AddError("The following column(s) contain missing values: "+str(missing_list)+". Please check your data and try again.")
+            addError("The following column(s) contain missing values: "+str(missing_list)+". Please check your data and try again.")
             sys.exit()
 
         return join1
 
-    def writeData(self, rainfall_df, join1): # join1 for waterbody model, intersect_waters for nutrient analysis
+    def loadEngine(self, ordered_dict, join1, rainfall_grid = None):
         '''
-        Takes the output from rainfallQA() and Merge() and writes results of calculations to the PLSM_raw.xlsx excel file.
-        Within this function is nested function that will produce the PLSM_summary.xlsx file.
+        Takes the ordered year/rainfall (inches) pairs and the Merge() output and calculates the runoff, TN and TP loads
+        of every landuse for every year in a single numpy broadcast. With a rainfall_grid from rainfallRaster() each
+        landuse gets its own zonal rainfall instead of the basin-wide depth.
         '''
-        arcpy.env.workspace = self.folder + r"\landuseLoading.gdb"
+        years = list(ordered_dict.keys())
+        rainfall_in = np.array(list(ordered_dict.values()), dtype=float)
 
-        filepath_raw = Path(self.folder + "\PLSM_raw.xlsx")
-        if filepath_raw.is_file():
-            arcpy.AddWarning(''''WARNING: PLSM raw file (in chosen location) already exists. Previous file was overwritten!
-                             If you want to run this model for an additional watershed, please select another location.''')
+        if rainfall_grid is None:
+            rainfall_grid_in = None
+            rain = rainfall_in[:, None]
+        else:
+            # matched by level 2 code, the row order of join1 comes from the dissolve, masterlist and join
+            grid = rainfall_grid.loc[years].reindex(columns=join1['LEVEL2_LAN'])
+            missing = grid.columns[grid.isna().any()].tolist()
+            if missing:
+                addError('The rainfall grid has no rainfall for landuse code(s) ' + str(missing) + '. Run rainfallRaster() '
+                         'on the same dissolve output.')
+                sys.exit()
+            rainfall_grid_in = grid.to_numpy(dtype=float)
+            rain = rainfall_grid_in
 
-        writer_raw = pd.ExcelWriter(self.folder + "\PLSM_raw.xlsx", engine='xlsxwriter')
+        loads = loadArray(rain*0.0254, join1['Area_sq_m'], join1['ROC'], join1['EMC_TN'], join1['EMC_TP'])
+        return annualLoads(join1, years, rainfall_in, loads, rainfall_grid_in)
+
+    def writeData(self, rainfall_df, join1, excel = True, store = None, rainfall_grid = None): # join1 for waterbody model, intersect_waters for nutrient analysis
+        '''
+        Takes the output from rainfallQA() (or rainfallRaster()) and Merge() and writes results of calculations to the
+        results store (see storeResults()). With excel = True the PLSM_raw.xlsx excel file is exported as well, and a
+        nested function produces the PLSM_summary.xlsx file. rainfall_grid is the landuse x year rainfall from rainfallRaster().
+        '''
+        if arcpy is not None:
+            arcpy.env.workspace = self.folder + r"\landuseLoading.gdb"
 
         print("Calculating Nutrient Loads")
         ## Create dictionary to later extract values for each year provided
@@ -186,38 +838,31 @@ class PLSM:
         ## Then order it
         ordered_dict = OrderedDict((k,dic.get(k)) for k in rainfall_df.Year)
 
-        # Summary CSV - Has to be a better way of doing this
-        Year = []
-        Yearly_Runoff_Volume_m3 = []
-        Yearly_TN_Load_kg = []
-        Yearly_TP_Load_kg = []
-
-        d = {}
-        for k,v in ordered_dict.items():
-            d[k] = pd.DataFrame([v])
-            d[k].columns = ['Rainfall_in']
-            d[k] = pd.concat([join1,d[k]],axis=1)
-            d[k]['Rainfall_m'] = d[k]['Rainfall_in']*0.0254
-            d[k]['Rainfall_Volume_m3'] = d[k]['Rainfall_m'][0]*d[k]['Area_sq_m']
-            d[k]['Rainfall_Volume_L'] = d[k]['Rainfall_Volume_m3']*1000
-            d[k]['Runoff_Volume_L'] = d[k]['Rainfall_Volume_L']*d[k]['ROC']
-            d[k]['TN_Load_kg'] = d[k]['Runoff_Volume_L']*d[k]['EMC_TN']/1000000
-            d[k]['TP_Load_kg'] = d[k]['Runoff_Volume_L']*d[k]['EMC_TP']/1000000
-
-            d[k].to_excel(writer_raw, sheet_name = str(k))
-            Year.append(str(k))
-            Yearly_Runoff_Volume_m3.append(((d[k]['Runoff_Volume_L'])/1000).sum())
-            Yearly_TN_Load_kg.append(d[k]['TN_Load_kg'].sum())
-            Yearly_TP_Load_kg.append(d[k]['TP_Load_kg'].sum())
-
-        writer_raw.save()
+        # All years are computed in one broadcast, per year sheets are only built to be written out
+        d = self.loadEngine(ordered_dict, join1, rainfall_grid)
+        self.storeResults(d, store)
+
+        if not excel:
+            self.writeSidecar(d)
+            self.loads = d
+            return d
+
+        filepath_raw = Path(os.path.join(self.folder, "PLSM_raw.xlsx"))
+        if filepath_raw.is_file():
+            addWarning(''''WARNING: PLSM raw file (in chosen location) already exists. Previous file was overwritten!
+                             If you want to run this model for an additional watershed, please select another location.''')
+
+        self.writeRaw(d, os.path.join(self.folder, "PLSM_raw.xlsx"))
+
+        Year, Yearly_Runoff_Volume_m3, Yearly_TN_Load_kg, Yearly_TP_Load_kg = d.yearlyTotals()
+
         def writeSummary(Year, Yearly_Runoff_Volume_m3, Yearly_TN_Load_kg, Yearly_TP_Load_kg):
-            filepath_sum = Path(self.folder + "\PLSM_summary.xlsx")
+            filepath_sum = Path(os.path.join(self.folder, "PLSM_summary.xlsx"))
 
-            writer_sum = pd.ExcelWriter(self.folder + "\PLSM_summary.xlsx")
+            writer_sum = pd.ExcelWriter(os.path.join(self.folder, "PLSM_summary.xlsx"))
 
             if filepath_sum.is_file():
-                arcpy.AddWarning('''WARNING: PLSM summary file (in chosen location) already exists. Previous file was overwritten!
+                addWarning('''WARNING: PLSM summary file (in chosen location) already exists. Previous file was overwritten!
                                  If you want to run this model for an additional watershed, please select another location.''')
 
             summary_df = pd.DataFrame({'Year': Year,
@@ -269,50 +914,289 @@ class PLSM:
             writer_sum.save()
         writeSummary(Year, Yearly_Runoff_Volume_m3, Yearly_TN_Load_kg, Yearly_TP_Load_kg)
 
+        self.writeSidecar(d)
+        self.loads = d
         return d
 
-    def ltaLoading(self, dissolve_input, d):
+    def writeSidecar(self, d):
+        '''
+        Writes the small PLSM_bathtub_cache.csv read by plsm_data_extract() when it runs standalone. Written after the
+        workbooks, so it is only newer than them until someone edits them.
+        '''
+        d.bathtubTable().to_csv(os.path.join(self.folder, 'PLSM_bathtub_cache.csv'), index=False)
+
+    def writeRaw(self, d, path):
+        '''
+        Streams the PLSM_raw workbook one year sheet at a time with xlsxwriter's constant_memory mode, so memory stays
+        flat however many years there are. Sheets are laid out the same as DataFrame.to_excel: bold bordered header row
+        and index column, blank cells for missing values.
+        '''
+        workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+        header_fmt = workbook.add_format({'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'})
+        header = d.sheetHeader()
+
+        for k in d.keys():
+            worksheet = workbook.add_worksheet(str(k))
+            worksheet.write_row(0, 1, header, header_fmt)
+            for r, row in enumerate(d.sheetRows(k)):
+                worksheet.write_number(r + 1, 0, r, header_fmt)
+                for c, value in enumerate(row, 1):
+                    if value is None or value != value:
+                        continue
+                    if value in (np.inf, -np.inf):
+                        value = str(value)
+                    worksheet.write(r + 1, c, value)
+        workbook.close()
+
+    def storeResults(self, d, store = None):
+        '''
+        Writes the long-format year/landuse loads, yearly summary and long term average of writeData() to a resultsStore,
+        PLSM_results.sqlite in the output folder unless another store is given. Returns the run_id.
+        '''
+        if store is None:
+            store = resultsStore(os.path.join(self.folder, 'PLSM_results.sqlite'))
+        run_id = store.newRun('PLSM', self.folder, watershed = self.watershed, rainfall = self.rainfall,
+                              landuse = self.landuse, backend = self.geo.name)
+        store.write('plsm_loads', d.longTable(), run_id)
+        store.write('plsm_summary', d.bathtubTable(), run_id)
+        store.write('plsm_lta', d.lta(), run_id)
+
+        self.run_id = run_id
+        return run_id
+
+    def monteCarlo(self, d, n = 5000, cv = None, chunk = 250, processes = None, percentiles = (5, 50, 95), seed = None,
+                   store = None):
+        '''
+        Takes output from writeData() and runs an ensemble of n realizations of ROC, EMC_TN and EMC_TP per landuse to put
+        percentile bands on the yearly summary and long term average per acre loading.
+        cv gives the coefficient of variation of each parameter as {'ROC': ..., 'EMC_TN': ..., 'EMC_TP': ...}, a value is
+        either a number or the name of a per landuse column in the masterlist. Without cv the masterlist columns
+        ROC_CV, EMC_TN_CV and EMC_TP_CV are used. Realizations are computed chunk at a time across a process pool and
+        each chunk is reduced into log histograms (bins per series, see logHistogram) as it finishes, so memory is
+        bounded by chunk x years x landuse whatever n is. The bands are within a fraction of a bin width of the exact
+        percentiles of the ensemble, well inside its sampling error.
+        Returns the yearly bands (one row per year and percentile) and the LTA bands (one row per landuse and percentile).
+        '''
+        params = ['ROC', 'EMC_TN', 'EMC_TP']
+        if cv is None:
+            cv = {p: p + '_CV' for p in params}
+
+        cv_values = []
+        for p in params:
+            value = cv.get(p, 0)
+            if isinstance(value, str):
+                if value not in d.join1.columns:
+                    addError('The coefficient of variation column ' + value + ' does not exist in the landuse masterlist. '
+                             'Please provide cv values and try again.')
+                    sys.exit()
+                value = d.join1[value].to_numpy(dtype=float)
+            cv_values.append(np.broadcast_to(np.asarray(value, dtype=float), d.area.shape))
+        cv_values = np.array(cv_values)
+        point = d.join1[params].to_numpy(dtype=float).T
+
+        print('Running ' + str(n) + ' Monte Carlo realizations')
+        rain = d.rainfallMatrix()
+        sizes = [chunk]*(n//chunk) + ([n % chunk] if n % chunk else [])
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        args = [(rain, d.area, point, cv_values, size, sd) for size, sd in zip(sizes, seeds)]
+
+        # histograms centered on the point estimate, wide enough for the lognormal spread of the three parameters
+        point_yearly, point_lta = _realizationTotals(rain, d.area, point[:, None, None, :])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            point_ppb = point_yearly[..., 1:]/point_yearly[..., :1]*1000000
+            sigma = np.nan_to_num(np.sqrt(np.log1p(cv_values**2))).max(axis=1)
+        spread = max(6*np.sqrt((sigma**2).sum()), 0.5)
+        yearly_hist = logHistogram(point_yearly[0], spread)
+        ppb_hist = logHistogram(point_ppb[0], spread)
+        lta_hist = logHistogram(point_lta[0], spread)
+
+        def reduce(yearly, lta):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                ppb = yearly[..., 1:]/yearly[..., :1]*1000000
+            yearly_hist.add(yearly)
+            ppb_hist.add(ppb)
+            lta_hist.add(lta)
+
+        if processes == 1:
+            for a in args:
+                reduce(*_monteCarloChunk(*a))
+        else:
+            # keep at most two chunks per worker in flight
+            window = 2*(processes or os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=processes) as pool:
+                pending = set()
+                for a in args:
+                    if len(pending) >= window:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in finished:
+                            reduce(*future.result())
+                    pending.add(pool.submit(_monteCarloChunk, *a))
+                for future in as_completed(pending):
+                    reduce(*future.result())
+
+        # yearly summary bands, same units as PLSM_summary
+        yearly_q = yearly_hist.percentile(percentiles)
+        runoff = yearly_q[..., 0]
+        ppb_q = ppb_hist.percentile(percentiles)
+        TN_ppb = ppb_q[..., 0]
+        TP_ppb = ppb_q[..., 1]
+        n_years = len(d.years)
+        yearly_bands = pd.DataFrame({'Year': np.tile([str(k) for k in d.years], len(percentiles)),
+                                     'Percentile': np.repeat(percentiles, n_years),
+                                     'Runoff Volume (hm3)': runoff.ravel()/1000000,
+                                     'Yearly TN Load (kg)': yearly_q[..., 1].ravel(),
+                                     'Yearly TP Load (kg)': yearly_q[..., 2].ravel(),
+                                     'TN (ppb)': TN_ppb.ravel(),
+                                     'TP (ppb)': TP_ppb.ravel()}).sort_values(['Year', 'Percentile']).reset_index(drop=True)
+
+        lta_q = lta_hist.percentile(percentiles)
+        # long format like the yearly bands, so plsm_mc_lta keeps one schema whatever percentiles are asked for
+        n_landuse = len(d.join1)
+        lta_bands = pd.DataFrame({'LEVEL2_LAN': np.tile(d.join1['LEVEL2_LAN'].to_numpy(), len(percentiles)),
+                                  'LEVEL2_L_1': np.tile(d.join1['LEVEL2_L_1'].to_numpy(), len(percentiles)),
+                                  'Percentile': np.repeat(percentiles, n_landuse),
+                                  'TN_Acre': lta_q[..., 0].ravel(),
+                                  'TP_Acre': lta_q[..., 1].ravel()}).sort_values(['LEVEL2_LAN', 'Percentile'],
+                                                                                kind='stable').reset_index(drop=True)
+
+        if store is not None or getattr(self, 'run_id', None) is not None:
+            if store is None:
+                store = resultsStore(os.path.join(self.folder, 'PLSM_results.sqlite'))
+            run_id = getattr(self, 'run_id', None) or store.newRun('PLSM', self.folder, watershed = self.watershed)
+            store.write('plsm_mc_yearly', yearly_bands, run_id)
+            store.write('plsm_mc_lta', lta_bands, run_id)
+
+        return yearly_bands, lta_bands
+
+    def scenarios(self, d, scenarios, store = None):
+        '''
+        Takes output from writeData() and evaluates landuse what-if scenarios against it without rerunning Clip/Dissolve.
+        Each scenario is a dict with a 'name' and any of:
+            'convert': [(from_code, to_code, area_sq_m), ...]   moves area from one level 2 landuse code to another
+            'ROC', 'EMC_TN', 'EMC_TP': {code: factor, ...}       scales a coefficient, e.g. a BMP reduction {2100: 0.7}
+        All scenarios (and the baseline) are evaluated together as scenario x landuse coefficient matrices multiplied
+        against the year x landuse rainfall. Returns the scenario summary (long term average TN/TP and change from
+        baseline), the yearly loads per scenario and the long term average loads per scenario and landuse.
+        '''
+        landuse = d.join1[['LEVEL2_LAN', 'LEVEL2_L_1', 'Area_sq_m', 'ROC', 'EMC_TN', 'EMC_TP']].copy()
+        rain = d.rainfallMatrix()
+
+        # landuse converted to that is not in the watershed yet comes from the masterlist with no baseline area
+        new_codes = sorted({c[1] for sc in scenarios for c in sc.get('convert', [])} - set(landuse['LEVEL2_LAN']))
+        if new_codes:
+            missing = [c for c in new_codes if c not in self.joinfile.index]
+            if missing:
+                addError('Landuse code(s) ' + str(missing) + ' do not exist in the landuse masterlist.')
+                sys.exit()
+            extra = self.joinfile.loc[new_codes]
+            landuse = pd.concat([landuse, pd.DataFrame({'LEVEL2_LAN': new_codes,
+                                                        'LEVEL2_L_1': extra.get('LEVEL2_LANDUSE_DESC', pd.Series(new_codes, index=new_codes)).values,
+                                                        'Area_sq_m': 0.0,
+                                                        'ROC': extra['ROC'].values,
+                                                        'EMC_TN': extra['EMC_TN'].values,
+                                                        'EMC_TP': extra['EMC_TP'].values})], ignore_index=True)
+            if rain.shape[1] > 1:
+                # new landuse gets the area weighted basin rainfall
+                basin = (rain*d.area).sum(axis=1, keepdims=True)/d.area.sum()
+                rain = np.hstack([rain, np.repeat(basin, len(new_codes), axis=1)])
+
+        position = {code: i for i, code in enumerate(landuse['LEVEL2_LAN'])}
+        names = ['Baseline'] + [sc.get('name', 'Scenario ' + str(i + 1)) for i, sc in enumerate(scenarios)]
+        params = {p: np.tile(landuse[p].to_numpy(dtype=float), (len(names), 1)) for p in ['Area_sq_m', 'ROC', 'EMC_TN', 'EMC_TP']}
+
+        for s, sc in enumerate(scenarios, 1):
+            for from_code, to_code, area in sc.get('convert', []):
+                if from_code not in position or params['Area_sq_m'][s, position[from_code]] < area:
+                    addError('Scenario ' + names[s] + ' converts more area of landuse ' + str(from_code) + ' than the watershed has.')
+                    sys.exit()
+                params['Area_sq_m'][s, position[from_code]] -= area
+                params['Area_sq_m'][s, position[to_code]] += area
+            for p in ['ROC', 'EMC_TN', 'EMC_TP']:
+                for code, factor in sc.get(p, {}).items():
+                    if code not in position:
+                        addError('Scenario ' + names[s] + ' scales ' + p + ' of landuse ' + str(code) +
+                                 ' which is not in the watershed.')
+                        sys.exit()
+                    params[p][s, position[code]] *= factor
+
+        # every scenario x year x landuse at once, through the same load engine as the baseline run
+        loads = loadArray(rain, params['Area_sq_m'][:, None, :], params['ROC'][:, None, :],
+                          params['EMC_TN'][:, None, :], params['EMC_TP'][:, None, :])
+
+        n_years = len(d.years)
+        # same reductions as annualLoads.yearlyTotals()
+        yearly = pd.DataFrame({'Scenario': np.repeat(names, n_years),
+                               'Year': np.tile([str(k) for k in d.years], len(names)),
+                               'Yearly Runoff Volume (m^3)': (loads[..., 0]/1000).sum(axis=2).ravel(),
+                               'Yearly TN Load (kg)': loads[..., 1].sum(axis=2).ravel(),
+                               'Yearly TP Load (kg)': loads[..., 2].sum(axis=2).ravel()})
+        yearly['TN Change (kg)'] = yearly['Yearly TN Load (kg)'] - np.tile(yearly['Yearly TN Load (kg)'].values[:n_years], len(names))
+        yearly['TP Change (kg)'] = yearly['Yearly TP Load (kg)'] - np.tile(yearly['Yearly TP Load (kg)'].values[:n_years], len(names))
+
+        # same reduction as annualLoads.lta()
+        TN_lta = loads[..., 1].sum(axis=1)/n_years
+        TP_lta = loads[..., 2].sum(axis=1)/n_years
+        lta = pd.DataFrame({'Scenario': np.repeat(names, len(landuse)),
+                            'LEVEL2_LAN': np.tile(landuse['LEVEL2_LAN'].values, len(names)),
+                            'LEVEL2_L_1': np.tile(landuse['LEVEL2_L_1'].values, len(names)),
+                            'Area_sq_m': params['Area_sq_m'].ravel(),
+                            'TN_Kg': TN_lta.ravel(),
+                            'TP_Kg': TP_lta.ravel(),
+                            'TN_Change_Kg': (TN_lta - TN_lta[0]).ravel(),
+                            'TP_Change_Kg': (TP_lta - TP_lta[0]).ravel()})
+
+        TN_total = TN_lta.sum(axis=1)
+        TP_total = TP_lta.sum(axis=1)
+        # a baseline without load has no percent change
+        with np.errstate(divide='ignore', invalid='ignore'):
+            TN_pct = np.where(TN_total[0] == 0, np.nan, (TN_total - TN_total[0])/TN_total[0]*100)
+            TP_pct = np.where(TP_total[0] == 0, np.nan, (TP_total - TP_total[0])/TP_total[0]*100)
+        summary = pd.DataFrame({'Scenario': names,
+                                'LTA TN Load (kg)': TN_total,
+                                'LTA TP Load (kg)': TP_total,
+                                'TN Change (kg)': TN_total - TN_total[0],
+                                'TP Change (kg)': TP_total - TP_total[0],
+                                'TN Change (%)': TN_pct,
+                                'TP Change (%)': TP_pct})
+
+        if store is not None or getattr(self, 'run_id', None) is not None:
+            if store is None:
+                store = resultsStore(os.path.join(self.folder, 'PLSM_results.sqlite'))
+            run_id = getattr(self, 'run_id', None) or store.newRun('PLSM', self.folder, watershed = self.watershed)
+            store.write('plsm_scenario_summary', summary, run_id)
+            store.write('plsm_scenario_yearly', yearly, run_id)
+            store.write('plsm_scenario_lta', lta, run_id)
+
+        return summary, yearly, lta
+
+    def ltaLoading(self, dissolve_input, d, excel = True):
         '''
         Takes output from Dissolve() and writeData() to produce a long-term average per acre representation of level 2 landuse loading.
         Exports shapefiles landuse_dissolveLTA_Loading to import into arcpro for spatial analysis.
+        With excel = False the LTA_LVL_2_Loading.xlsx workbook is not written, the same loading is in the plsm_lta table
+        of the results store and the join table is written straight to the landuseLoading geodatabase.
         '''
-        # Create excel file path
-        writer_map = pd.ExcelWriter(self.folder + r"\LTA_LVL_2_Loading.xlsx", engine= 'xlsxwriter')
-        # Initialize blank  dataframe
-        lta_initial_df = pd.DataFrame()
-        # Set columns for formatting
-        lta = pd.DataFrame(columns= ['LEVEL2_LAN', 'LEVEL2_L_1', 'TN_Acre', 'TP_Acre'])
-        for k in d.keys():
-            # write loading per acre to lta dataframe
-            lta[['LEVEL2_LAN', 'LEVEL2_L_1']] = d[k][['LEVEL2_LAN', 'LEVEL2_L_1']]
-            # Convert sq^m to acree and calculate to get loading per acre of each landuse
-            lta['TN_Acre'] = d[k]['TN_Load_kg'] / (d[k]['Area_sq_m']*0.00024711)
-            lta['TP_Acre'] = d[k]['TP_Load_kg'] / (d[k]['Area_sq_m']*0.00024711)
-            if len(lta_initial_df) < 1:
-                # Copy first iteration of loading data to initialized dataframe
-                lta_initial_df[['LEVEL2_LAN', 'LEVEL2_L_1', 'TN_Acre', 'TP_Acre']] = lta[['LEVEL2_LAN', 'LEVEL2_L_1', 'TN_Acre', 'TP_Acre']]
-            else:
-                # With data already written to initialized dataframe, sum the following loading data to it
-                summed_columns = lta_initial_df[['TN_Acre', 'TP_Acre']] + lta[['TN_Acre', 'TP_Acre']]
-                # Update initialized dataframe with summed data, further iteration will continue to sum data to perform long term average
-                lta_initial_df.update(summed_columns, join= 'left', overwrite=True)
-        # Get count of years for average
-        yr_count = len(d.keys())
-        # Divide loading data columns by year count to obtain average
-        avg_loading = lta_initial_df[['TN_Acre', 'TP_Acre']] / yr_count
-        # Have to update initialized df with average loading
-        lta_initial_df.update(avg_loading, join= 'left', overwrite=True)
+        # Long term average loading per acre, shared with pieChart()
+        lta_initial_df = d.lta()[['LEVEL2_LAN', 'LEVEL2_L_1', 'TN_Acre', 'TP_Acre']]
         # Setting index for formatting of arcpy table entry
         lta_initial_df = lta_initial_df.set_index('LEVEL2_LAN')
         # Drop waters from table
         lta_initial_df = lta_initial_df[(lta_initial_df[['TN_Acre', 'TP_Acre']] != 0).all(axis=1)]
-        # Write the sheet to excel and save
-        lta_initial_df.to_excel(writer_map, sheet_name = 'LTA Loading per Landuse')
-        # Save excel file
-        writer_map.save()
+        if excel:
+            # Create excel file path
+            writer_map = pd.ExcelWriter(self.folder + r"\LTA_LVL_2_Loading.xlsx", engine= 'xlsxwriter')
+            # Write the sheet to excel and save
+            lta_initial_df.to_excel(writer_map, sheet_name = 'LTA Loading per Landuse')
+            # Save excel file
+            writer_map.save()
 
         lta_shp = arcpy.management.CopyFeatures(dissolve_input, dissolve_input[:-4] + 'LTA_Loading' + '.shp')
-        join_table = arcpy.ExcelToTable_conversion(self.folder + r"\LTA_LVL_2_Loading.xlsx", self.folder + r"\landuseLoading" + ".gdb", 'LTA Loading per Landuse')
+        if excel:
+            join_table = arcpy.ExcelToTable_conversion(self.folder + r"\LTA_LVL_2_Loading.xlsx", self.folder + r"\landuseLoading" + ".gdb", 'LTA Loading per Landuse')
+        else:
+            join_table = self.folder + r"\landuseLoading.gdb\LTA_Loading_per_Landuse"
+            records = lta_initial_df.reset_index().to_records(index=False, column_dtypes={'LEVEL2_L_1': 'U254'})
+            arcpy.da.NumPyArrayToTable(records, join_table)
         join_field = ['TN_Acre', 'TP_Acre']
         # Joining the level 2 landuse data back to the shapefile creates 0 values in-place for water features that have no data
         arcpy.management.JoinField(lta_shp, 'LEVEL2_L_1', join_table, 'LEVEL2_L_1', join_field)
@@ -327,66 +1211,30 @@ class PLSM:
 
         return lta_initial_df
 
-    def pieChart(self, d, clip_input, septic_loading = None, include_septic = False, remove_waters = False):
+    def pieChart(self, d, clip_input = None, septic_loading = None, include_septic = False, remove_waters = False,
+                 excel = True, store = None):
         '''
-        Takes output from PLSM class writeData(), Dissolve(), and Septic class runCalculation() to produce a pie chart
+        Takes output from PLSM class writeData() and Septic class runCalculation() to produce a pie chart
         of long term average lvl 1 landuse. Function arguements determine wheter to include septic or water in loading representation.
+        Level 2 landuse is rolled up to level 1 through landuseHierarchy(), clip_input is no longer scanned and only
+        kept for existing callers. The level 1 table goes to the plsm_lta_level1 table of the results store (store, or the
+        store of this run), and to LVL_1_Landuse.xlsx unless excel = False.
         '''
-        # long term average loading lvl 1 landuse
-        writer_pie = pd.ExcelWriter(self.folder + r"\LVL_1_Landuse.xlsx", engine='xlsxwriter')
-        # Initialize blank  dataframe
-        lta_initial_df = pd.DataFrame()
-        # Set columns for formatting
-        lta = pd.DataFrame(columns= ['LEVEL2_LAN', 'LEVEL2_L_1', 'TN_Acre', 'TP_Acre'])
-        for k in d.keys():
-            # write loading per acre to lta dataframe
-            lta[['LEVEL2_LAN', 'LEVEL2_L_1']] = d[k][['LEVEL2_LAN', 'LEVEL2_L_1']]
-            # Convert sq^m to acree and calculate to get loading per acre of each landuse
-            lta['TN_Acre'] = d[k]['TN_Load_kg']
-            lta['TP_Acre'] = d[k]['TP_Load_kg']
-            if len(lta_initial_df) < 1:
-                # Copy first iteration of loading data to initialized dataframe
-                lta_initial_df[['LEVEL2_LAN', 'LEVEL2_L_1', 'TN_Acre', 'TP_Acre']] = lta[['LEVEL2_LAN', 'LEVEL2_L_1', 'TN_Acre', 'TP_Acre']]
-            else:
-                # With data already written to initialized dataframe, sum the following loading data to it
-                summed_columns = lta_initial_df[['TN_Acre', 'TP_Acre']] + lta[['TN_Acre', 'TP_Acre']]
-                # Update initialized dataframe with summed data, further iteration will continue to sum data to perform long term average
-                lta_initial_df.update(summed_columns, join= 'left', overwrite=True)
-        # Get count of years for average
-        yr_count = len(d.keys())
-        #print(yr_count)
-        # Divide loading data columns by year count to obtain average
-        avg_loading = lta_initial_df[['TN_Acre', 'TP_Acre']] / yr_count
-        # Have to update initialized df with average loading
-        lta_initial_df.update(avg_loading, join= 'left', overwrite=True)
+        # Long term average total loading, shared with ltaLoading()
+        lta_initial_df = d.lta()[['LEVEL2_LAN', 'LEVEL2_L_1', 'TN_Kg', 'TP_Kg']]
         # Setting index for formatting of arcpy table entry
         lta_initial_df = lta_initial_df.set_index('LEVEL2_LAN')
 
-        def unique_values(table):
-            with arcpy.da.SearchCursor(table, ['LEVEL1_LAN', 'LEVEL1_L_1', 'LEVEL2_LAN', 'LEVEL2_L_1']) as cursor:
-                # with arcpy.da.SearchCursor(table, ['ESTUARY_SE']) as cursor: # i used this line to get the enr list csv to query my sqlite file
-                return sorted({row for row in cursor})
-        LU = unique_values(clip_input)
-
-        LU_list = []
-        for i in range(len(LU)):
-            LU_list.append(LU[i])
+        # Level 1 code and description of every dissolved level 2 landuse from the precomputed hierarchy index
+        landuse_df = landuseHierarchy(self.landuse, self.geo, self.joinfile)
 
-        LU_df = pd.DataFrame(LU_list)
+        lvl_LU_df = pd.merge(landuse_df, lta_initial_df, how= 'inner', on='LEVEL2_LAN')
 
-        landuse_df = LU_df.rename(columns={0:'LEVEL1_LAN', 1: 'LEVEL1_L_1',
-                                           2: 'LEVEL2_LAN', 3:'LEVEL2_L_1'})
-
-        lvl_LU_df = pd.merge(landuse_df, lta_initial_df, how= 'left', on=['LEVEL2_LAN', 'LEVEL2_L_1'])
-
-        lvl_LU_df = lvl_LU_df.groupby(['LEVEL1_LAN', 'LEVEL1_L_1'])[['TN_Acre', 'TP_Acre']].agg(['mean']).reset_index()
+        lvl_LU_df = lvl_LU_df.groupby(['LEVEL1_LAN', 'LEVEL1_L_1'])[['TN_Kg', 'TP_Kg']].agg(['mean']).reset_index()
 
         lvl_LU_df = lvl_LU_df.set_index('LEVEL1_LAN') # i hate working with pycharm for this reason
         lvl_LU_df = lvl_LU_df.droplevel(level=1, axis=1)
 
-        lvl_LU_df = lvl_LU_df.rename(columns={'TN_Acre': 'TN_Kg',
-                                              'TP_Acre': 'TP_Kg'})
-
         if include_septic == True:
             #lvl_LU_df.merge(septic_loading, left_on= 'LEVEL1_L_1', right_on= 'LEVEL1_L_1', how='inner') # this isnt merging the row
             dfs = [lvl_LU_df, septic_loading]
@@ -397,9 +1245,18 @@ class PLSM:
             # Drop waters from table
             lvl_LU_df = lvl_LU_df[(lvl_LU_df[['TN_Kg', 'TP_Kg']] != 0).all(axis=1)]
 
-        lvl_LU_df.to_excel(writer_pie, sheet_name='LVL 1 LTA Loading per Landuse')
-        # Save excel file
-        writer_pie.save()
+        if excel:
+            # long term average loading lvl 1 landuse
+            writer_pie = pd.ExcelWriter(self.folder + r"\LVL_1_Landuse.xlsx", engine='xlsxwriter')
+            lvl_LU_df.to_excel(writer_pie, sheet_name='LVL 1 LTA Loading per Landuse')
+            # Save excel file
+            writer_pie.save()
+
+        if store is not None or getattr(self, 'run_id', None) is not None:
+            if store is None:
+                store = resultsStore(os.path.join(self.folder, 'PLSM_results.sqlite'))
+            run_id = getattr(self, 'run_id', None) or store.newRun('PLSM', self.folder, watershed = self.watershed)
+            store.write('plsm_lta_level1', lvl_LU_df.rename_axis('LEVEL1_LAN').reset_index(), run_id)
 
         pies = []
         analytes = ['TN', 'TP']
@@ -430,11 +1287,17 @@ class PLSM:
         save(plots)
         #export_png(plots, dir)
 
-    def annualLoading(self, dissolve_input, d):
+    def annualLoading(self, dissolve_input, d, single_output = True):
         '''
         Takes output from Dissolve() and writeData() to produce an annual per acre representation of level 2 landuse loading.
-        Exports shapefiles landuse_dissolve for every year there was rainfall data.
+        By default the years x landuse table is joined to the dissolved landuse once and written to a single nutrientLoading
+        layer with TN_<year> and TP_<year> columns (file geodatabase with arcpy, GeoPackage with shapely).
+        With single_output = False a nutrientLoading<year> shapefile is exported for every year there was rainfall data.
         '''
+        if single_output:
+            print('Joining annual loading to landuse')
+            return self.geo.joinFields(dissolve_input, d.annualTable(), 'LEVEL2_L_1', self.folder, 'nutrientLoading')
+
         # for testing purposes i can write this in a way that creates the excel file
         # when either this function or the ltaloading function is performed
         writer_map = pd.ExcelWriter(self.folder + r"\nutrientMap.xlsx", engine= 'xlsxwriter')
@@ -448,8 +1311,6 @@ class PLSM:
             nutrientMap.to_excel(writer_map, sheet_name = str(k))
 
         writer_map.save()
-        # need to iterate over years and sheets of excel
-        wb = load_workbook(self.folder + r"\nutrientMap.xlsx")
 
 
         #fieldObjList = arcpy.ListFields(self.watershed) # this loop here is good if the join is being applied to a table with a lot of unnecessary fields
@@ -459,9 +1320,9 @@ class PLSM:
         #    if not field.required:
         #        fieldDelete.append(field.name)
 
-        for s in wb.worksheets:
+        # one sheet per year in nutrientMap.xlsx
+        for s in d.keys():
 
-            s = str(s)[12:-2]
             nutrientMap_shp = arcpy.management.CopyFeatures(dissolve_input, dissolve_input[:-4] + str(s) + '.shp')
 
             # keep this code in case of field deletion
@@ -483,47 +1344,374 @@ class PLSM:
             rename = 'nutrientLoading' + str(s) + '.shp'
             arcpy.management.Rename(nutrientMap_shp, rename)
 
-    def plsm_data_extract(self):
+    def plsm_data_extract(self, d = None):
         '''
-        Produces bathtub csv from PLSM_raw and PLSM_summary excel files. This function doesnt need to have specified
-        inputs for the excel files since they are being accessed from their file locations
+        Produces bathtub csv from the writeData() results. Uses the results of this instance (or d) when they are in memory,
+        otherwise the PLSM_bathtub_cache.csv sidecar written next to them as long as it is newer than the PLSM_raw and
+        PLSM_summary excel files, and those files when they were changed after it.
         '''
-        plsm_fl = self.folder +'\\PLSM_raw.xlsx'
-        plsm_summ = self.folder +'\\PLSM_summary.xlsx'
-
-        # Get sheetnames
-        plsm_excel = pd.ExcelFile(plsm_fl)
-        plsm_yr = plsm_excel.sheet_names
-
-        # Get rainfall
-        rain_value_list = []
-        for yrs in plsm_yr:
-            # Read the PLSM rawdata sheet
-            plsm_sheets =  pd.read_excel(plsm_fl, sheet_name = yrs)
-            # look up rainfall values
-            rain_value = plsm_sheets['Rainfall_m'].iloc[0]
-            # Append rain values to the list
-            rain_value_list.append(rain_value)
-
-        # Make a dataframe for rainfall only
-        plsm_rainfall = pd.DataFrame({'Year':plsm_yr,'Precipitation  (meters)':rain_value_list})
-        #plsm_rainfall.index = plsm_rainfall.Year
+        if d is None:
+            d = getattr(self, 'loads', None)
+        sidecar = os.path.join(self.folder, 'PLSM_bathtub_cache.csv')
+        plsm_fl = os.path.join(self.folder, 'PLSM_raw.xlsx')
+        plsm_summ = os.path.join(self.folder, 'PLSM_summary.xlsx')
+        workbooks = [f for f in (plsm_fl, plsm_summ) if os.path.exists(f)]
+
+        if d is not None:
+            plsm_join = d.bathtubTable()
+        elif os.path.exists(sidecar) and all(os.path.getmtime(f) <= os.path.getmtime(sidecar) for f in workbooks):
+            plsm_join = pd.read_csv(sidecar, dtype={'Year': str})
+        else:
+            if os.path.exists(sidecar):
+                print('PLSM_bathtub_cache.csv is older than the PLSM excel files, reading the excel files')
 
-        # Get PLSM summary
-        plsm_flows = pd.read_excel(plsm_summ)
+            # Read the first row of every year sheet in one pass over the workbook
+            plsm_sheets = pd.read_excel(plsm_fl, sheet_name = None, nrows = 1)
+            # Make a dataframe for rainfall only
+            plsm_rainfall = pd.DataFrame({'Year': [str(yrs) for yrs in plsm_sheets.keys()],
+                                          'Precipitation  (meters)': [sheet['Rainfall_m'].iloc[0] for sheet in plsm_sheets.values()]})
 
-        # Combine the dataframes
-        plsm_join = pd.concat([plsm_rainfall,plsm_flows],axis = 1 ) #, how = 'left',left_on = 'Year' )
+            # Get PLSM summary
+            plsm_flows = pd.read_excel(plsm_summ, dtype={'Year': str})
 
-        # remove duplicate columns - Year
-        plsm_join = plsm_join.loc[:,~plsm_join.columns.duplicated()]
+            # Combine the dataframes on year
+            plsm_join = pd.merge(plsm_rainfall, plsm_flows, on = 'Year').sort_values('Year').reset_index(drop=True)
 
         print("Getting PLSM results")
 
         # Get all PLSM data
-        plsm_join.round(3).to_csv(self.folder + '\\PLSM_Bathtub.csv', index= False)
+        plsm_join.round(3).to_csv(os.path.join(self.folder, 'PLSM_Bathtub.csv'), index= False)
 
         return plsm_join
 
 
 
+def frameHash(df):
+    '''
+    Content hash of a dataframe, used to fingerprint masterlists and septic tables passed in memory.
+    '''
+    return hashlib.sha1(pd.util.hash_pandas_object(df, index=True).values.tobytes()
+                        + ','.join(str(c) for c in df.columns).encode()).hexdigest()
+
+# checkpointed PLSM workflow, stages whose inputs did not change since the last run in the same folder are skipped
+class pipeline:
+    '''
+    Runs the PLSM methods as a dependency graph of stages (see self.stages):
+        Clip -> Dissolve -> calculateField -> attribute_to_CSV -> Merge
+        rainfallQA (or rainfallRaster after calculateField) + Merge -> writeData
+        writeData -> plsm_data_extract, ltaLoading, annualLoading and pieChart
+    Every stage gets a fingerprint from its own inputs (watershed geometry, landuse/NHD/rainfall/masterlist versions
+    and arguments) and the fingerprints and run stamps of the stages it depends on. A stage gets a new run stamp every
+    time it executes, so rerunning a stage always reruns everything downstream of it. After a stage finishes its result is pickled to
+    PLSM_checkpoints in the model folder together with its fingerprint. On the next run a stage is skipped and its
+    result restored when the fingerprint matches and the files it wrote still exist, so a run that failed late in the
+    chain (an Excel lock in writeData, say) resumes from the last good checkpoint without rerunning the geoprocessing.
+    With a rainfall_raster the rainfall stage is rainfallRaster() on the dissolved landuse instead of rainfallQA().
+    '''
+    def __init__(self, model, clip_type = 'Model', excel = True, store = None, rainfall_raster = None,
+                 septic_loading = None, include_septic = False, remove_waters = False, single_output = True):
+        self.model = model
+        self.clip_type = clip_type
+        self.excel = excel
+        self.store = store
+        self.rainfall_raster = rainfall_raster
+        self.septic_loading = septic_loading
+        self.include_septic = include_septic
+        self.remove_waters = remove_waters
+        self.single_output = single_output
+        self.folder = os.path.join(model.folder, 'PLSM_checkpoints')
+        self.index_file = os.path.join(self.folder, 'index.json')
+        # stage: stages it depends on
+        self.stages = OrderedDict([
+            ('Clip', []),
+            ('Dissolve', ['Clip']),
+            ('calculateField', ['Dissolve']),
+            ('attribute_to_CSV', ['calculateField']),
+            ('rainfall', ['calculateField'] if rainfall_raster is not None else []),
+            ('Merge', ['Dissolve', 'attribute_to_CSV']),
+            ('writeData', ['rainfall', 'Merge']),
+            ('plsm_data_extract', ['writeData']),
+            ('ltaLoading', ['calculateField', 'writeData']),
+            ('annualLoading', ['calculateField', 'writeData']),
+            ('pieChart', ['writeData']),
+        ])
+        self.results = {}
+        self.fingerprints = {}
+        self.stamps = {}
+        self.skipped = []
+        self.ran = []
+
+    def readIndex(self):
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    return json.load(f)
+            except ValueError:
+                pass
+        return {}
+
+    def writeIndex(self, index):
+        os.makedirs(self.folder, exist_ok=True)
+        temp_file = self.index_file + '.' + str(os.getpid())
+        with open(temp_file, 'w') as f:
+            json.dump(index, f, indent=1)
+        os.replace(temp_file, self.index_file)
+
+    def joinfileVersion(self):
+        joinfile = self.model._joinfile
+        if joinfile is None:
+            return sourceVersion(MASTERLIST)
+        if isinstance(joinfile, (str, Path)):
+            return sourceVersion(joinfile)
+        return frameHash(joinfile)
+
+    def inputs(self, stage):
+        '''
+        Inputs of a stage other than the stages it depends on.
+        '''
+        model = self.model
+        if stage == 'Clip':
+            parts = [model.geo.name, model.geo.geometryHash(model.watershed), sourceVersion(model.landuse), self.clip_type]
+            if self.clip_type == 'Analysis':
+                parts.append(sourceVersion(model.NHD_waterbody))
+            return parts
+        if stage == 'rainfall':
+            return [sourceVersion(self.rainfall_raster if self.rainfall_raster is not None else model.rainfall)]
+        if stage == 'Merge':
+            return [self.joinfileVersion()]
+        if stage == 'writeData':
+            return [self.excel, self.store.path if self.store is not None else None]
+        if stage == 'annualLoading':
+            return [self.single_output]
+        if stage == 'pieChart':
+            septic = frameHash(self.septic_loading) if self.septic_loading is not None else None
+            return [septic, self.include_septic, self.remove_waters]
+        return []
+
+    def fingerprint(self, stage):
+        parts = [stage] + [str(p) for p in self.inputs(stage)]
+        parts += [self.fingerprints[dep] + self.stamps[dep] for dep in self.stages[stage]]
+        return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+    def files(self, stage, result):
+        '''
+        Files written by a stage, a checkpoint is only reused while they all exist.
+        '''
+        folder = self.model.folder
+        if stage == 'Clip':
+            return [result[0] + '.shp']
+        if stage == 'Dissolve':
+            return [result[0], result[2]]
+        if stage == 'attribute_to_CSV':
+            return [os.path.join(self.results['Clip'][1], 'wshed_landuse.csv')]
+        if stage == 'writeData':
+            files = [os.path.join(folder, 'PLSM_bathtub_cache.csv')]
+            if self.excel:
+                files += [os.path.join(folder, 'PLSM_raw.xlsx'), os.path.join(folder, 'PLSM_summary.xlsx')]
+            return files
+        if stage == 'plsm_data_extract':
+            return [os.path.join(folder, 'PLSM_Bathtub.csv')]
+        if stage == 'ltaLoading':
+            # same path expression as ltaLoading() so the check matches the file it wrote
+            return [folder + r"\LTA_LVL_2_Loading.xlsx"] if self.excel else []
+        if stage == 'annualLoading':
+            return [result] if isinstance(result, str) else []
+        if stage == 'pieChart':
+            return [folder + r"\LVL_1_Landuse.xlsx"] if self.excel else []
+        return []
+
+    def execute(self, stage):
+        model = self.model
+        r = self.results
+        if stage == 'Clip':
+            return model.Clip(self.clip_type)
+        if stage == 'Dissolve':
+            return model.Dissolve(*r['Clip'])
+        if stage == 'calculateField':
+            return model.calculateField(r['Dissolve'][0])
+        if stage == 'attribute_to_CSV':
+            return model.attribute_to_CSV(r['Dissolve'][0], r['Clip'][1])
+        if stage == 'rainfall':
+            if self.rainfall_raster is not None:
+                return model.rainfallRaster(self.rainfall_raster, r['Dissolve'][0])
+            return model.rainfallQA(), None
+        if stage == 'Merge':
+            return model.Merge(r['Clip'][1], r['Dissolve'][1])
+        if stage == 'writeData':
+            rainfall_df, rainfall_grid = r['rainfall']
+            return model.writeData(rainfall_df, r['Merge'], self.excel, self.store, rainfall_grid)
+        if stage == 'plsm_data_extract':
+            return model.plsm_data_extract(r['writeData'])
+        if stage == 'ltaLoading':
+            return model.ltaLoading(r['Dissolve'][0], r['writeData'], self.excel)
+        if stage == 'annualLoading':
+            return model.annualLoading(r['Dissolve'][0], r['writeData'], self.single_output)
+        if stage == 'pieChart':
+            return model.pieChart(r['writeData'], None, self.septic_loading, self.include_septic, self.remove_waters,
+                                  self.excel, self.store)
+
+    def order(self, targets):
+        '''
+        Targets and every stage they depend on, in the order they have to run.
+        '''
+        needed = set()
+        def visit(stage):
+            if stage not in self.stages:
+                addError('Unknown PLSM stage ' + str(stage) + '. Stages are: ' + ', '.join(self.stages))
+                sys.exit()
+            if stage not in needed:
+                needed.add(stage)
+                for dep in self.stages[stage]:
+                    visit(dep)
+        for t in targets:
+            visit(t)
+        return [s for s in self.stages if s in needed]
+
+    def run(self, targets = ('plsm_data_extract',), force = False):
+        '''
+        Runs the targets (see the stage graph above), skipping every stage with a valid checkpoint unless force is True.
+        Returns the dict of stage results, writeData's annualLoads under 'writeData'.
+        '''
+        index = self.readIndex()
+        for stage in self.order(targets):
+            self.fingerprints[stage] = self.fingerprint(stage)
+            entry = index.get(stage)
+            checkpoint = os.path.join(self.folder, stage + '.pkl')
+            if (not force and entry is not None and entry['fingerprint'] == self.fingerprints[stage]
+                    and entry.get('stamp') and os.path.exists(checkpoint) and all(os.path.exists(f) for f in entry['files'])):
+                saved = pd.read_pickle(checkpoint)
+                self.results[stage] = saved['result']
+                self.stamps[stage] = entry['stamp']
+                # writeData leaves its results on the model for plsm_data_extract() and monteCarlo()
+                for attr, value in saved['state'].items():
+                    setattr(self.model, attr, value)
+                self.skipped.append(stage)
+                print('Skipping ' + stage + ' (unchanged since ' + entry['finished'] + ')')
+                continue
+
+            # a stage that reruns invalidates its old checkpoint until it finishes again
+            if index.pop(stage, None) is not None:
+                self.writeIndex(index)
+            result = self.execute(stage)
+            self.results[stage] = result
+            self.stamps[stage] = uuid.uuid4().hex
+
+            state = {a: getattr(self.model, a) for a in ['loads', 'run_id'] if stage == 'writeData' and hasattr(self.model, a)}
+            os.makedirs(self.folder, exist_ok=True)
+            pd.to_pickle({'result': result, 'state': state}, checkpoint)
+            index[stage] = {'fingerprint': self.fingerprints[stage],
+                            'stamp': self.stamps[stage],
+                            'files': self.files(stage, result),
+                            'finished': datetime.now().isoformat(timespec='seconds')}
+            self.writeIndex(index)
+            self.ran.append(stage)
+
+        return self.results
+
+
+
+# Landuse masterlist held by each batch worker process, loaded once by _batchInit()
+_batch_joinfile = None
+
+def _batchInit(joinfile):
+    '''
+    Process pool initializer for batchRun(). Reads the statewide landuse masterlist once per worker.
+    '''
+    global _batch_joinfile
+    if isinstance(joinfile, pd.DataFrame):
+        _batch_joinfile = masterlistIndex(joinfile)
+    else:
+        _batch_joinfile = landuseMasterlist(joinfile)
+
+def _batchBasin(name, watershed, name_field, rainfall_input, folder_location, clip_type, landuse_input, NHD_waterbody, cache,
+                backend, excel, store):
+    '''
+    Runs Clip -> Dissolve -> calculateField -> attribute_to_CSV -> Merge -> writeData for one basin in its own folder
+    and returns the yearly totals tagged with the basin name, and whether the dissolve cache had the basin (None
+    without a cache) so the parent can count the session's hits and misses.
+    '''
+    basin_folder = os.path.join(folder_location, str(name))
+    if not os.path.exists(basin_folder):
+        os.makedirs(basin_folder)
+
+    model = PLSM(watershed, rainfall_input, basin_folder, _batch_joinfile, landuse_input, NHD_waterbody, backend)
+    # Basins coming from one feature class are selected out into their own shapefile
+    if name_field is not None:
+        model.watershed = model.geo.selectValues(watershed, os.path.join(basin_folder, 'watershed.shp'), name_field, [name])
+    rainfall_df = model.rainfallQA()
+    hits = cache.hits if cache is not None else 0
+    dissolve_input, n_rows, clip_input, temp_folder_path = model.clipDissolve(clip_type, cache)
+    cache_hit = cache.hits > hits if cache is not None else None
+    join1 = model.Merge(temp_folder_path, n_rows)
+    d = model.writeData(rainfall_df, join1, excel, store)
+
+    Year, Yearly_Runoff_Volume_m3, Yearly_TN_Load_kg, Yearly_TP_Load_kg = d.yearlyTotals()
+    return pd.DataFrame({'Watershed': str(name),
+                         'Year': Year,
+                         'Yearly Runoff Volume (m^3)': Yearly_Runoff_Volume_m3,
+                         'Yearly TN Load (kg)': Yearly_TN_Load_kg,
+                         'Yearly TP Load (kg)': Yearly_TP_Load_kg}), cache_hit
+
+def batchRun(watersheds, rainfall_input, folder_location, name_field = None, processes = None, clip_type = 'Model',
+             joinfile = MASTERLIST,
+             landuse_input = r"\\floridadep.net\GIS\GeoData\geopub\geopub.gdb\STATEWIDE_LANDUSE",
+             NHD_waterbody = r"\\floridadep.net\\GIS\\geodata\\geopub\\NHD.gdb\\Hydrography\\NHDWaterbody",
+             cache = None, backend = None, excel = False):
+    '''
+    Runs the TMDL lake modeling chain for many watersheds across a process pool.
+    watersheds is either a list of watershed shapefiles (or a dict of name: shapefile) or a single feature class
+    holding every basin, in which case name_field identifies the basins. Each basin is written to its own folder
+    under folder_location and the yearly loads of all basins are written to PLSM_batch_summary.xlsx.
+    An optional dissolveCache skips the geoprocessing for basins that were already clipped and dissolved. With the
+    'shapely' backend the batch runs without arcpy. Results of every basin go to PLSM_results.sqlite in folder_location,
+    the per basin PLSM_raw/PLSM_summary workbooks are only exported with excel = True.
+
+    *Note: on Windows this has to be called from under an if __name__ == '__main__': guard.
+    '''
+    if isinstance(watersheds, str):
+        if name_field is None:
+            addError('A name field is required to split the watershed feature class into basins.')
+            sys.exit()
+        names = sorted(set(geometryBackend(backend).values(watersheds, name_field)))
+        basins = [(n, watersheds, name_field) for n in names]
+    elif isinstance(watersheds, dict):
+        basins = [(n, w, None) for n, w in watersheds.items()]
+    else:
+        basins = [(os.path.splitext(os.path.basename(str(w)))[0], w, None) for w in watersheds]
+
+    if not os.path.exists(folder_location):
+        os.makedirs(folder_location)
+
+    store = resultsStore(os.path.join(folder_location, 'PLSM_results.sqlite'))
+    summaries = []
+    failed = []
+    with ProcessPoolExecutor(max_workers=processes, initializer=_batchInit, initargs=(joinfile,)) as pool:
+        futures = {pool.submit(_batchBasin, name, watershed, field, rainfall_input, folder_location, clip_type,
+                               landuse_input, NHD_waterbody, cache, backend, excel, store): name for name, watershed, field in basins}
+        for i, future in enumerate(as_completed(futures), 1):
+            name = futures[future]
+            try:
+                summary, cache_hit = future.result()
+                summaries.append(summary)
+                # workers count on their own copy of the cache
+                if cache_hit is not None:
+                    cache.hits += cache_hit
+                    cache.misses += not cache_hit
+                print('Finished ' + str(name) + ' (' + str(i) + '/' + str(len(basins)) + ')')
+            # sys.exit() from the PLSM QA checks only stops the one basin
+            except (Exception, SystemExit) as e:
+                failed.append(name)
+                addWarning('WARNING: ' + str(name) + ' failed and was skipped: ' + str(e))
+
+    if cache is not None:
+        cache.report()
+
+    if failed:
+        addWarning('WARNING: ' + str(len(failed)) + ' basin(s) failed: ' + ', '.join(str(f) for f in failed))
+
+    if not summaries:
+        return pd.DataFrame()
+
+    batch_df = pd.concat(summaries, ignore_index=True).sort_values(['Watershed', 'Year'])
+    batch_df.to_excel(os.path.join(folder_location, "PLSM_batch_summary.xlsx"), sheet_name='PLSM Batch Summary', index=False)
+    return batch_df
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sat Oct 17 2026
+"""
+
+'''
+Results store shared by the PLSM and Septic classes.
+
+Every run is written to a single SQLite file as long-format tables (one row per year/landuse record) next to a runs
+table with the run metadata. Excel workbooks are an optional export on top of this, downstream tools can query the
+file directly (or memory map it through PRAGMA mmap_size) without parsing workbooks.
+
+Tables:
+    runs                    run_id, tool, created, folder, parameters (json)
+    plsm_loads              Year x LEVEL2 landuse area, rainfall, runoff, TN and TP loads
+    plsm_summary            yearly precipitation, runoff volume and TN/TP concentrations
+    plsm_lta                long term average loading per level 2 landuse
+    plsm_lta_level1         long term average loading per level 1 landuse, as in the pie charts
+    plsm_mc_yearly          Monte Carlo percentile bands of the yearly summary
+    plsm_mc_lta             Monte Carlo percentile bands of the long term average loading per acre
+    plsm_scenario_summary   long term average TN/TP and change from baseline per landuse scenario
+    plsm_scenario_yearly    yearly runoff, TN and TP loads and change from baseline per landuse scenario
+    plsm_scenario_lta       long term average loading per scenario and level 2 landuse
+    iwr_agm                 QA filtered annual geometric means per WBID, year and mastercode from Lake_Approach.statewideAGM()
+    septic_results          septic calculation parameters and results
+    septic_loading          septic TN loading (kg) added to the level 1 landuse pie chart
+    septic_batch            septic tank counts, flow and TN load/concentration per lake and buffer distance
+'''
+import os
+import json
+import uuid
+import sqlite3
+from datetime import datetime
+import pandas as pd
+
+class resultsStore:
+    def __init__(self, path):
+        self.path = str(path)
+
+    def connect(self):
+        # batch workers can write to the same file, wait on locks instead of failing
+        con = sqlite3.connect(self.path, timeout=60)
+        con.execute('PRAGMA mmap_size = 268435456')
+        return con
+
+    def append(self, con, table, df):
+        '''
+        Appends df to table, creating the table from the frame's schema first. Both happen in one BEGIN IMMEDIATE
+        transaction so batch workers writing to a new file never race each other to create the same table.
+        '''
+        con.execute('BEGIN IMMEDIATE')
+        try:
+            schema = pd.io.sql.get_schema(df, table, con=con)
+            con.execute(schema.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+            df.to_sql(table, con, if_exists='append', index=False, chunksize=50000)
+            con.execute('CREATE INDEX IF NOT EXISTS idx_%s_run ON %s (run_id)' % (table, table))
+            con.commit()
+        except BaseException:
+            con.rollback()
+            raise
+
+    def newRun(self, tool, folder, **parameters):
+        '''
+        Records a run and returns its run_id.
+        '''
+        run_id = uuid.uuid4().hex
+        runs = pd.DataFrame({'run_id': [run_id], 'tool': [tool], 'created': [datetime.now().isoformat(timespec='seconds')],
+                             'folder': [str(folder)], 'parameters': [json.dumps(parameters, default=str)]})
+        con = self.connect()
+        try:
+            self.append(con, 'runs', runs)
+        finally:
+            con.close()
+        return run_id
+
+    def write(self, table, df, run_id):
+        '''
+        Appends the records of a dataframe to table, tagged with run_id.
+        '''
+        df = df.reset_index(drop=True)
+        df.insert(0, 'run_id', run_id)
+        con = self.connect()
+        try:
+            self.append(con, table, df)
+        finally:
+            con.close()
+
+    def read(self, table, run_id = None, columns = None):
+        '''
+        Reads a table, optionally only the records of one run and only some columns.
+        '''
+        select = ', '.join('"%s"' % c for c in columns) if columns else '*'
+        query = 'SELECT %s FROM %s' % (select, table)
+        params = ()
+        if run_id is not None:
+            query += ' WHERE run_id = ?'
+            params = (run_id,)
+        con = self.connect()
+        try:
+            return pd.read_sql_query(query, con, params=params)
+        finally:
+            con.close()
+
+    def runs(self):
+        if not os.path.exists(self.path):
+            return pd.DataFrame(columns=['run_id', 'tool', 'created', 'folder', 'parameters'])
+        return self.read('runs')
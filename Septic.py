@@ -11,12 +11,16 @@ Created on Fri Feb  4 11:51:01 2022
     Output: Provides lake spetic load results and shapefiles of septic system within 200m of waterbody.
 '''
 import os
-import arcpy
+import json
+import shutil
+import hashlib
 import pandas as pd
 import numpy as np
 import xlsxwriter
 from pathlib import Path
 from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import sys
 from openpyxl import load_workbook
 
@@ -27,22 +31,226 @@ from bokeh.transform import cumsum
 from bokeh.io import save, output_file, export_png
 from bokeh.layouts import column
 
-arcpy.env.overwriteOutput = True
+try:
+    import pyproj
+except ImportError:
+    pyproj = None
+
+from Geometry import arcpy, shapely, geometryBackend, addMessage, addWarning, sourceVersion, MASTERLIST_CACHE
+from Results import resultsStore
+
+if arcpy is not None:
+    arcpy.env.overwriteOutput = True
+
+SEPTIC_INPUT = r"\\FLDEP1\giscloud\SepticTanks\DOH_FWMI\FWMI.gdb\Statewide_Septic_Centroids_2017_2018"
+# WW codes counted as septic: known, likely and somewhat likely
+SEPTIC_CODES = ['KnownSeptic', 'LikelySeptic', 'SWLSeptic']
+
+# septic loading coefficients
+WATER_USE = 70          # gal/day/person
+FLOW_LOSS = 0.85        # 15% of the flow is lost
+NITROGEN = 9.012        # lbs/person/yr
+ATTENUATION = 0.5
+
+def septicLoad(septic_tanks, people, water_use = WATER_USE, flow_loss = FLOW_LOSS, nitrogen = NITROGEN,
+               attenuation = ATTENUATION):
+    '''
+    Septic flow and nitrogen load for arrays of tank counts, people per household and coefficients. Inputs broadcast
+    against each other (e.g. lakes x 1 tank counts against 1 x parameter set coefficients), so thousands of lakes and
+    sensitivity combinations are evaluated in one pass.
+    Returns a dict of arrays: flow_rate_gal_day (per tank), flow_gal_yr, flow_L_yr, flow_hm3_yr, N_lbs, N_ug, N_kg and
+    concentration_ug_L (nan where there is no flow).
+    '''
+    septic_tanks = np.asarray(septic_tanks, dtype=float)
+    people = np.asarray(people, dtype=float)
+
+    flow_rate_gal_day = people*water_use*flow_loss
+    flow_gal_yr = septic_tanks*flow_rate_gal_day*365
+    flow_L_yr = flow_gal_yr*3.78541
+    N_lbs = people*nitrogen*septic_tanks*attenuation
+    N_ug = N_lbs*453600000
+    with np.errstate(divide='ignore', invalid='ignore'):
+        concentration_ug_L = np.where(flow_L_yr > 0, N_ug/flow_L_yr, np.nan)
+
+    return {'flow_rate_gal_day': flow_rate_gal_day,
+            'flow_gal_yr': flow_gal_yr,
+            'flow_L_yr': flow_L_yr,
+            'flow_hm3_yr': flow_L_yr*0.000000001,
+            'N_lbs': N_lbs,
+            'N_ug': N_ug,
+            'N_kg': N_lbs/2.205,
+            'concentration_ug_L': concentration_ug_L}
+
+@lru_cache(maxsize=None)
+def _metricTransformer(crs, utm):
+    return pyproj.Transformer.from_crs(pyproj.CRS.from_user_input(crs), utm, always_xy=True)
+
+def _utmZone(lon, lat):
+    '''
+    EPSG code of the WGS 84 UTM zone of a longitude/latitude, the local projection distances are measured in (the
+    shapely backend buffers geographic layers in the same zones).
+    '''
+    zone = int((lon + 180)//6) % 60 + 1
+    return (32600 if lat >= 0 else 32700) + zone
+
+@lru_cache(maxsize=None)
+def _unitFactor(crs):
+    crs = pyproj.CRS.from_user_input(crs)
+    return None if crs.is_geographic else crs.axis_info[0].unit_conversion_factor
+
+def metricDistance(geom, x, y, crs = None):
+    '''
+    Distance in meters from a (multi)polygon to points x, y (0 inside it), both in crs. Layers in a geographic crs
+    are measured in the UTM zone of the polygon's centroid.
+    '''
+    points = shapely.points(np.asarray(x, dtype=float), np.asarray(y, dtype=float))
+    factor = 1.0
+    if pyproj is not None and crs is not None:
+        factor = _unitFactor(crs)
+        if factor is None:
+            center = shapely.centroid(geom)
+            transformer = _metricTransformer(crs, _utmZone(shapely.get_x(center), shapely.get_y(center)))
+            project = lambda c: np.column_stack(transformer.transform(c[:, 0], c[:, 1]))
+            points = shapely.transform(points, project)
+            geom = shapely.transform(geom, project)
+            factor = 1.0
+    shapely.prepare(geom)
+    return shapely.distance(geom, points)*factor
+
+# local copy of the septic centroids with a grid index, rebuilt whenever the source layer changes
+class tankIndex:
+    '''
+    Columnar copy of the statewide septic centroids (x, y, WW) kept in cache_folder as .npy files that are memory
+    mapped on load. Only tanks with one of the septic WW codes are kept, WW is stored as a category (int8 codes into
+    self.categories). Tanks are sorted by the cell of a regular grid over their extent and cell_start holds where the
+    tanks of every cell start, so the tanks under a polygon's bounding box are one contiguous slice per grid row.
+    query() trims those to the bounding box and then does a vectorized point in polygon test.
+    '''
+    def __init__(self, septic_input = SEPTIC_INPUT, backend = None, codes = SEPTIC_CODES,
+                 cache_folder = os.path.join(MASTERLIST_CACHE, 'septic'), cells = 512):
+        self.septic = septic_input
+        self.geo = geometryBackend(backend)
+        self.categories = list(codes)
+        self.cells = cells
+        # the backend reads the coordinates and crs, indexes built by one are not reused by the other
+        key = '\n'.join([sourceVersion(septic_input), self.geo.name, str(cells)] + self.categories)
+        self.folder = os.path.join(cache_folder, hashlib.md5(key.encode()).hexdigest())
+        if not os.path.exists(os.path.join(self.folder, 'meta.json')):
+            self.build()
+        self.load()
+
+    def build(self):
+        print('Indexing septic tanks')
+        x, y, ww, crs = self.geo.points(self.septic, 'WW')
+        codes = pd.Categorical(ww, categories=self.categories).codes
+        keep = codes >= 0
+        x = np.asarray(x, dtype=float)[keep]
+        y = np.asarray(y, dtype=float)[keep]
+        codes = codes[keep].astype(np.int8)
+
+        # square cells, cells of them along the longer side of the extent
+        origin = [float(x.min()), float(y.min())] if len(x) else [0.0, 0.0]
+        extent = max(float(x.max()) - origin[0], float(y.max()) - origin[1]) if len(x) else 0.0
+        cell_size = extent/self.cells if extent > 0 else 1.0
+        nx = int((x.max() - origin[0])//cell_size) + 1 if len(x) else 1
+        ny = int((y.max() - origin[1])//cell_size) + 1 if len(x) else 1
+        cell = ((y - origin[1])//cell_size).astype(np.int64)*nx + ((x - origin[0])//cell_size).astype(np.int64)
+        order = np.argsort(cell, kind='stable')
+
+        # written next to the index and moved in place so other processes never see half an index
+        temp_folder = self.folder + '.' + str(os.getpid())
+        os.makedirs(temp_folder, exist_ok=True)
+        np.save(os.path.join(temp_folder, 'x.npy'), x[order])
+        np.save(os.path.join(temp_folder, 'y.npy'), y[order])
+        np.save(os.path.join(temp_folder, 'ww.npy'), codes[order])
+        np.save(os.path.join(temp_folder, 'cell_start.npy'), np.searchsorted(cell[order], np.arange(nx*ny + 1)))
+        with open(os.path.join(temp_folder, 'meta.json'), 'w') as f:
+            json.dump({'source': self.septic, 'crs': crs, 'origin': origin, 'cell_size': cell_size, 'nx': nx, 'ny': ny,
+                       'categories': self.categories, 'count': int(len(x))}, f)
+        try:
+            os.replace(temp_folder, self.folder)
+        except OSError:
+            # another process finished the same index first
+            shutil.rmtree(temp_folder, ignore_errors=True)
+
+    def load(self):
+        with open(os.path.join(self.folder, 'meta.json')) as f:
+            meta = json.load(f)
+        self.crs = meta['crs']
+        self.origin = meta['origin']
+        self.cell_size = meta['cell_size']
+        self.nx = meta['nx']
+        self.ny = meta['ny']
+        self.x = np.load(os.path.join(self.folder, 'x.npy'), mmap_mode='r')
+        self.y = np.load(os.path.join(self.folder, 'y.npy'), mmap_mode='r')
+        self.ww = np.load(os.path.join(self.folder, 'ww.npy'), mmap_mode='r')
+        self.cell_start = np.load(os.path.join(self.folder, 'cell_start.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.x)
+
+    def codes(self, idx):
+        '''
+        WW codes of the tanks at positions idx.
+        '''
+        return np.asarray(self.categories, dtype=object)[self.ww[idx]]
+
+    def query(self, layer):
+        '''
+        Positions of the tanks inside (or on the boundary of) the polygons of layer.
+        '''
+        geom = shapely.union_all(self.geo.shapes(layer, self.crs))
+        idx = self.window(*shapely.bounds(geom))
+        shapely.prepare(geom)
+        return idx[shapely.intersects_xy(geom, self.x[idx], self.y[idx])]
+
+    def window(self, xmin, ymin, xmax, ymax):
+        '''
+        Positions of the tanks inside a bounding box.
+        '''
+        ix0 = max(int((xmin - self.origin[0])//self.cell_size), 0)
+        ix1 = min(int((xmax - self.origin[0])//self.cell_size), self.nx - 1)
+        iy0 = max(int((ymin - self.origin[1])//self.cell_size), 0)
+        iy1 = min(int((ymax - self.origin[1])//self.cell_size), self.ny - 1)
+        if len(self) == 0 or ix0 > ix1 or iy0 > iy1:
+            return np.empty(0, dtype=np.int64)
+
+        rows = np.arange(iy0, iy1 + 1)*self.nx
+        idx = np.concatenate([np.arange(self.cell_start[r + ix0], self.cell_start[r + ix1 + 1]) for r in rows])
+        x = self.x[idx]
+        y = self.y[idx]
+        return idx[(x >= xmin) & (x <= xmax) & (y >= ymin) & (y <= ymax)]
 
 #  the folder path should prob be a class variable
 class Septic:
     def __init__(self, watershed_input, waterbody_input, people, folder_location,
-    septic_input = r"\\FLDEP1\giscloud\SepticTanks\DOH_FWMI\FWMI.gdb\Statewide_Septic_Centroids_2017_2018"):
+    septic_input = SEPTIC_INPUT,
+    backend = None, tank_index = None):
         self.watershed = watershed_input
         self.waterbody = waterbody_input
         self.septic = septic_input
         self.people = people
         self.folder = folder_location
+        # 'arcpy' or 'shapely' geometry backend (see Geometry.py), arcpy when it is installed
+        self.geo = geometryBackend(backend)
+        # tankIndex shared between instances, None builds/loads the local index on first use, False clips the source layer
+        self._tanks = tank_index
+
+    @property
+    def tanks(self):
+        '''
+        tankIndex of septic_input, or None when clipTanks() has to geoprocess the source layer.
+        '''
+        if self._tanks is None:
+            self._tanks = tankIndex(self.septic, self.geo) if shapely is not None else False
+        return self._tanks if self._tanks is not False else None
 
     def clipTanks(self):
         '''
         Clips septic tanks to watershed input and selects tanks by query of Known Septic, Likely Septic, or
         Somewhat likely septic. The selected tanks are then copied to another variable and a count is performed.
+        With a tankIndex the selection is a grid/point in polygon query against the local copy of the tanks (kept in
+        self.selected as positions into the index) instead of a clip of the statewide layer.
         '''
         temp_folder_path = os.path.join(self.folder, 'Septic_shapefiles')
 
@@ -50,19 +258,26 @@ class Septic:
         if not os.path.exists(temp_folder_path):
              os.mkdir(temp_folder_path)
 
+        if self.tanks is not None:
+            self.selected = self.tanks.query(self.watershed)
+            selectionTanks = self.geo.writePoints(self.tanks.x[self.selected], self.tanks.y[self.selected],
+                                                  pd.DataFrame({'WW': self.tanks.codes(self.selected)}), self.tanks.crs,
+                                                  os.path.join(temp_folder_path, "known_likely_wshed_septic.shp"))
+            septic_count = len(self.selected)
+            addMessage("There are approximately " + str(septic_count) +
+                             " septic tanks in the watershed.")
+            return selectionTanks, temp_folder_path
+
         # Clip septic tanks to watershed
-        watershed_clip = temp_folder_path + "\watershed_septic.shp"
-        arcpy.Clip_analysis(self.septic, self.watershed, watershed_clip)
+        watershed_clip = os.path.join(temp_folder_path, "watershed_septic.shp")
+        self.geo.clip(self.septic, self.watershed, watershed_clip)
 
         ##Select only known, likely, and somewhat likely septic tanks
-        query_septic = "WW = 'KnownSeptic' OR WW = 'LikelySeptic'  OR WW = 'SWLSeptic'"
-        arcpy.MakeFeatureLayer_management(watershed_clip, "watershed_septic_lyr")
-        wshed_septic = arcpy.SelectLayerByAttribute_management("watershed_septic_lyr", "NEW_SELECTION", query_septic)
-
-        selectionTanks = arcpy.CopyFeatures_management(wshed_septic, temp_folder_path + "\known_likely_wshed_septic") # why does this not work here???
+        selectionTanks = self.geo.selectValues(watershed_clip, os.path.join(temp_folder_path, "known_likely_wshed_septic"),
+                                               'WW', SEPTIC_CODES)
 
-        septic_count = int(arcpy.GetCount_management(selectionTanks).getOutput(0))
-        arcpy.AddMessage("There are approximately " + str(septic_count) +
+        septic_count = self.geo.count(selectionTanks)
+        addMessage("There are approximately " + str(septic_count) +
                          " septic tanks in the watershed.")
         return selectionTanks, temp_folder_path
 
@@ -72,53 +287,80 @@ class Septic:
         to show how many spetic tanks are within the buffered 200 meters.
         '''
         ##Create buffer zone around waterbody
-        path_for_buffer = temp_folder_path + "\waterbody_buffer_zone.shp"
-        arcpy.Buffer_analysis(self.waterbody, path_for_buffer, "200 meters")
+        path_for_buffer = os.path.join(temp_folder_path, "waterbody_buffer_zone.shp")
+        self.geo.buffer(self.waterbody, path_for_buffer, 200)
 
         ##Clip watershed septic tanks to buffer zone
-        path_for_clip = temp_folder_path + r"\buffer_septic.shp"
-        arcpy.Clip_analysis(selectionTanks, path_for_buffer, path_for_clip)
+        path_for_clip = os.path.join(temp_folder_path, "buffer_septic.shp")
+        self.geo.clip(selectionTanks, path_for_buffer, path_for_clip)
         ##Get number of septic tanks within buffer
-        septic_buffer_count = int(arcpy.GetCount_management(path_for_clip).getOutput(0))
-        arcpy.AddMessage("There are approximately " + str(septic_buffer_count) +
+        septic_buffer_count = self.geo.count(path_for_clip)
+        addMessage("There are approximately " + str(septic_buffer_count) +
                          " septic tanks within 200m of the waterbody.")
         return septic_buffer_count
 
-    def runCalculation(self, septic_buffer_count):
+    def tankDistances(self, selectionTanks):
+        '''
+        Takes output from clipTanks() and returns the distance in meters from every selected tank to the nearest
+        waterbody polygon (0 for tanks inside one), in one vectorized query against the merged waterbody.
+        '''
+        if self.tanks is not None and getattr(self, 'selected', None) is not None:
+            x, y, crs = self.tanks.x[self.selected], self.tanks.y[self.selected], self.tanks.crs
+        else:
+            x, y, ww, crs = self.geo.points(selectionTanks, 'WW')
+        return metricDistance(shapely.union_all(self.geo.shapes(self.waterbody, crs)), x, y, crs)
+
+    def bufferDistances(self, selectionTanks, distances = (100, 200, 300, 500)):
         '''
-        Takes output from Buffer() and performs septic calculations.
+        Multi-distance version of Buffer(). Takes output from clipTanks(), measures every tank's distance to the
+        waterbody once and counts the tanks within each buffer distance (meters) from the cumulative histogram of those
+        distances. runCalculation() is applied to every count.
+        Returns a table of tank counts and septic TN load (kg) per distance and a dict of distance: runCalculation() output.
+        '''
+        distance = np.sort(self.tankDistances(selectionTanks))
+        counts = np.searchsorted(distance, np.asarray(distances, dtype=float), side='right')
+
+        results = OrderedDict()
+        for d, count in zip(distances, counts):
+            addMessage("There are approximately " + str(count) + " septic tanks within " + str(d) + "m of the waterbody.")
+            results[d] = self.runCalculation(int(count))
+
+        buffer_df = pd.DataFrame({'Buffer (m)': list(distances),
+                                  'Septic Tanks': counts,
+                                  'Septic Load (Kg)': [results[d][0]['TN_Kg'].iloc[0] for d in distances]})
+        return buffer_df, results
+
+    def runCalculation(self, septic_buffer_count, water_use = WATER_USE, flow_loss = FLOW_LOSS, nitrogen = NITROGEN,
+                       attenuation = ATTENUATION):
+        '''
+        Takes output from Buffer() and performs septic calculations (see septicLoad()), laid out as the formatted
+        parameter/value table written by to_excel().
 
         *Note: This function creates the optional septic_loading for the pieChart() function in the PLSM class.
         '''
+        load = septicLoad(septic_buffer_count, self.people, water_use, flow_loss, nitrogen, attenuation)
+        concentration = float(load['concentration_ug_L'])
 
         septic_DF = pd.DataFrame(columns=["Parameter", "Value"])
 
-        water_use = 70
-        flow_loss = 0.85
-        nitrogen = 9.012
-        attenuation = 0.5
-
         septic_DF['Parameter'] = ["", "Septic Tanks", "Avg. People", "Water Use (gal/day)", "Flow Loss (15%)",
                                   "Nitrogen per person (lbs)", "Attenuation", "", "", "", "Flow Rate (gal/day/tank)",
                                   "Total Flow Rate (gal/yr)", "Total Flow Rate (L/yr)", "Total Flow Rate (hm3/yr)",
                                   "Nitrogen load (lbs)", "Nitrogen load (ug)", "", "", "Concentration (ug/L)"]
 
-        septic_DF.loc[[1], 'Value'] = septic_buffer_count
-        septic_DF.loc[[2], 'Value'] = self.people
-        septic_DF.loc[[3], 'Value'] = water_use
-        septic_DF.loc[[4], 'Value'] = flow_loss
-        septic_DF.loc[[5], 'Value'] = nitrogen
-        septic_DF.loc[[6], 'Value'] = attenuation
-        septic_DF.loc[[10], 'Value'] = self.people*water_use*flow_loss
-        septic_DF.loc[[11], 'Value'] = septic_buffer_count*float(septic_DF.loc[[10], 'Value'])*365
-        septic_DF.loc[[12], 'Value'] = float(septic_DF.loc[[11], 'Value'])*3.78541
-        septic_DF.loc[[13], 'Value'] = float(septic_DF.loc[[12], 'Value']*0.000000001)
-        septic_DF.loc[[14], 'Value'] = self.people*nitrogen*septic_buffer_count*attenuation # this value
-        septic_DF.loc[[15], 'Value'] = float(septic_DF.loc[[14], 'Value'])*453600000
-        septic_DF.loc[[18], 'Value'] = int(float(septic_DF.loc[[15], 'Value']/float(septic_DF.loc[[12], 'Value'])))
+        septic_DF['Value'] = pd.Series([np.nan, septic_buffer_count, self.people, water_use, flow_loss, nitrogen, attenuation,
+                                        np.nan, np.nan, np.nan,
+                                        float(load['flow_rate_gal_day']),
+                                        float(load['flow_gal_yr']),
+                                        float(load['flow_L_yr']),
+                                        float(load['flow_hm3_yr']),
+                                        float(load['N_lbs']),
+                                        float(load['N_ug']),
+                                        np.nan, np.nan,
+                                        int(concentration) if np.isfinite(concentration) else np.nan], dtype=object)
 
         # convert lbs to kg
-        septic_loading_Kg = [(self.people*nitrogen*septic_buffer_count*attenuation/2.205)]
+        septic_loading_Kg = [float(load['N_kg'])]
         col_head = ['LEVEL1_L_1', "TN_Kg"]
         septic_list = ["Septic Load (Kg)"]
 
@@ -129,18 +371,37 @@ class Septic:
 
         return septic_loading, septic_DF
 
+    def storeResults(self, septic_DF, septic_loading, store = None):
+        '''
+        Takes output from runCalculation() and writes the septic parameters/results and septic loading to a resultsStore,
+        PLSM_results.sqlite in the output folder unless another store is given. Returns the run_id.
+        '''
+        if store is None:
+            store = resultsStore(os.path.join(self.folder, 'PLSM_results.sqlite'))
+        run_id = store.newRun('Septic', self.folder, watershed = self.watershed, waterbody = self.waterbody,
+                              septic = self.septic, people = self.people, backend = self.geo.name)
+
+        # the formatted table has blank header and spacer rows
+        results = pd.DataFrame({'Parameter': septic_DF.iloc[:, 0].values, 'Value': septic_DF.iloc[:, 1].values})
+        results = results[results['Parameter'] != '']
+        results['Value'] = pd.to_numeric(results['Value'])
+        store.write('septic_results', results, run_id)
+        store.write('septic_loading', septic_loading, run_id)
+        return run_id
+
     def to_excel(self, septic_DF):
         '''
-        Takes input from runCalculation() sends septic loading to produce and format Septic_Calculations.xlsx
+        Takes input from runCalculation() sends septic loading to produce and format Septic_Calculations.xlsx, an optional
+        export next to storeResults().
         '''
         #write dataframe to excel spreadsheet
-        filepath = Path(self.folder + "\Septic_Calculations.xlsx")
+        filepath = Path(os.path.join(self.folder, "Septic_Calculations.xlsx"))
 
-        writer = pd.ExcelWriter(self.folder + "\Septic_Calculations.xlsx", engine='xlsxwriter')
+        writer = pd.ExcelWriter(os.path.join(self.folder, "Septic_Calculations.xlsx"), engine='xlsxwriter')
         septic_DF.to_excel(writer, sheet_name='Results', index=False, header=False)
 
         if filepath.is_file():
-            arcpy.AddWarning("WARNING: Septic Calculation spreadsheet (in chosen location) already exists. Previous file was " +
+            addWarning("WARNING: Septic Calculation spreadsheet (in chosen location) already exists. Previous file was " +
                      "overwritten! If you want to run this for an additional watershed, please select another folder " +
                      "location.")
 
@@ -159,3 +420,88 @@ class Septic:
 
         writer.save()
 
+
+# tank index held by each septic batch worker, loaded once by _septicInit()
+_batch_tanks = None
+
+def _septicInit(septic_input, backend, cache_folder):
+    '''
+    Process pool initializer for septicBatch(). Memory maps the tank index built by the parent process.
+    '''
+    global _batch_tanks
+    _batch_tanks = tankIndex(septic_input, backend, cache_folder=cache_folder)
+
+def _septicLakes(start, wkbs, distances):
+    '''
+    Counts the tanks within each buffer distance (meters) of every lake of one chunk. Returns the position of the
+    chunk and a lakes x distances array of counts.
+    '''
+    tanks = _batch_tanks
+    distances = np.asarray(distances, dtype=float)
+    counts = np.zeros((len(wkbs), len(distances)), dtype=np.int64)
+    geographic = pyproj is not None and tanks.crs is not None and _unitFactor(tanks.crs) is None
+    for i, geom in enumerate(shapely.from_wkb(wkbs)):
+        xmin, ymin, xmax, ymax = shapely.bounds(geom)
+        # grow the bounding box by the largest buffer, in degrees for a geographic crs
+        if geographic:
+            pad = distances.max()/111320
+            pad_x = pad/max(np.cos(np.radians(max(abs(ymin), abs(ymax)) + pad)), 0.01)
+        else:
+            pad = pad_x = distances.max()/(_unitFactor(tanks.crs) if pyproj is not None and tanks.crs is not None else 1.0)
+        idx = tanks.window(xmin - pad_x, ymin - pad, xmax + pad_x, ymax + pad)
+        distance = np.sort(metricDistance(geom, tanks.x[idx], tanks.y[idx], tanks.crs))
+        counts[i] = np.searchsorted(distance, distances, side='right')
+    return start, counts
+
+def septicBatch(waterbodies, people, folder_location, name_field, distances = (200,), processes = None, chunk = 100,
+                septic_input = SEPTIC_INPUT, backend = None, cache_folder = os.path.join(MASTERLIST_CACHE, 'septic')):
+    '''
+    Septic loading of every lake of a waterbody feature class, counted from the tanks within each buffer distance
+    (meters) of the lake. The tank index is built (or loaded) once and memory mapped by every worker process,
+    lakes are sent to the workers chunk at a time. people is the people per household for every lake or the name of a
+    field of the waterbodies holding it.
+    Returns one table of tank counts, flow and septic TN load/concentration per lake and distance, also written to
+    PLSM_results.sqlite and Septic_batch_summary.xlsx in folder_location.
+
+    *Note: on Windows this has to be called from under an if __name__ == '__main__': guard.
+    '''
+    geo = geometryBackend(backend)
+    tanks = tankIndex(septic_input, geo, cache_folder=cache_folder)
+
+    names = geo.values(waterbodies, name_field)
+    wkbs = shapely.to_wkb(np.asarray(geo.shapes(waterbodies, tanks.crs), dtype=object))
+    if isinstance(people, str):
+        people = geo.values(waterbodies, people)
+    people = np.broadcast_to(np.asarray(people, dtype=float), (len(names),))
+
+    if not os.path.exists(folder_location):
+        os.makedirs(folder_location)
+
+    print('Counting septic tanks around ' + str(len(names)) + ' lakes')
+    septic_tanks = np.zeros((len(names), len(distances)), dtype=np.int64)
+    done = 0
+    with ProcessPoolExecutor(max_workers=processes, initializer=_septicInit,
+                             initargs=(septic_input, backend if isinstance(backend, str) else geo.name, cache_folder)) as pool:
+        futures = [pool.submit(_septicLakes, i, wkbs[i:i + chunk], distances) for i in range(0, len(names), chunk)]
+        for future in as_completed(futures):
+            start, counts = future.result()
+            septic_tanks[start:start + len(counts)] = counts
+            done += len(counts)
+            print('Finished ' + str(done) + '/' + str(len(names)) + ' lakes')
+
+    load = septicLoad(septic_tanks, people[:, None])
+
+    batch_df = pd.DataFrame({'Waterbody': np.repeat([str(n) for n in names], len(distances)),
+                             'Buffer (m)': np.tile(list(distances), len(names)),
+                             'Septic Tanks': septic_tanks.ravel(),
+                             'Avg. People': np.repeat(people, len(distances)),
+                             'Total Flow Rate (hm3/yr)': load['flow_hm3_yr'].ravel(),
+                             'Septic Load (Kg)': load['N_kg'].ravel(),
+                             'Concentration (ug/L)': load['concentration_ug_L'].ravel()})
+
+    store = resultsStore(os.path.join(folder_location, 'PLSM_results.sqlite'))
+    run_id = store.newRun('SepticBatch', folder_location, waterbodies = waterbodies, septic = septic_input,
+                          distances = list(distances), backend = geo.name)
+    store.write('septic_batch', batch_df, run_id)
+    batch_df.to_excel(os.path.join(folder_location, "Septic_batch_summary.xlsx"), sheet_name='Septic Batch Summary', index=False)
+    return batch_df
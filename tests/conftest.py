@@ -0,0 +1,73 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import PLSM
+
+
+@pytest.fixture
+def landuse():
+    '''
+    Merged landuse table (the join1 of writeData()) of 12 synthetic level 2 landuses, one without area and one
+    without TP.
+    '''
+    rng = np.random.default_rng(0)
+    n = 12
+    join1 = pd.DataFrame({'LEVEL2_LAN': np.arange(1, n + 1)*100,
+                          'LEVEL2_L_1': ['landuse %d' % i for i in range(n)],
+                          'Area_sq_m': rng.uniform(1e3, 1e6, n),
+                          'ROC': rng.uniform(0.05, 0.9, n),
+                          'EMC_TN': rng.uniform(0.5, 3, n),
+                          'EMC_TP': rng.uniform(0.01, 0.6, n)})
+    join1.loc[3, 'Area_sq_m'] = 0.0
+    join1.loc[5, 'EMC_TP'] = 0.0
+    return join1
+
+
+@pytest.fixture
+def loads(landuse):
+    '''
+    writeData() output of the synthetic landuse for 8 years of basin rainfall.
+    '''
+    rainfall_in = np.array([48.2, 55.1, 39.7, 61.3, 50.0, 44.4, 52.8, 58.6])
+    area = landuse['Area_sq_m']
+    array = PLSM.loadArray(rainfall_in*0.0254, area, landuse['ROC'], landuse['EMC_TN'], landuse['EMC_TP'])
+    return PLSM.annualLoads(landuse, list(range(2010, 2018)), rainfall_in, array)
+
+
+@pytest.fixture
+def model(tmp_path):
+    return PLSM.PLSM(None, None, str(tmp_path), joinfile=None, backend='shapely')
+
+
+@pytest.fixture
+def basin(tmp_path):
+    '''
+    Landuse, watershed, NHD waterbody, rainfall and masterlist files of a small synthetic basin for the shapely
+    backend. Returns a function that builds a PLSM model of it writing to folder.
+    '''
+    gpd = pytest.importorskip('geopandas')
+    shapely = pytest.importorskip('shapely')
+    data = tmp_path / 'data'
+    data.mkdir()
+    gpd.GeoDataFrame({'LEVEL2_LANDUSE_CODE': [1100, 1100, 2100, 5200], 'LEVEL2_LANDUSE_DESC': ['a', 'a', 'b', 'w']},
+                     geometry=[shapely.box(0, 0, 10, 10), shapely.box(10, 0, 20, 10), shapely.box(0, 10, 20, 20),
+                               shapely.box(50, 50, 60, 60)], crs=3086).to_file(data / 'landuse.gpkg', layer='landuse')
+    gpd.GeoDataFrame({'NAME': ['x']}, geometry=[shapely.box(5, 5, 15, 15)], crs=3086).to_file(data / 'watershed.shp')
+    gpd.GeoDataFrame({'FTYPE': [1]}, geometry=[shapely.box(5, 5, 8, 8)], crs=3086).to_file(data / 'waters.shp')
+    pd.DataFrame({'YEAR': [2000, 2001], 'Rain': [50, 40]}).to_csv(data / 'rain.csv', index=False)
+    pd.DataFrame({'LEVEL2_LANDUSE_CODE': [1100, 2100], 'ROC': [0.3, 0.1], 'EMC_TN': [2.0, 1.0],
+                  'EMC_TP': [0.3, 0.1]}).to_csv(data / 'masterlist.csv', index=False)
+
+    def build(folder):
+        os.makedirs(folder, exist_ok=True)
+        return PLSM.PLSM(str(data / 'watershed.shp'), str(data / 'rain.csv'), str(folder),
+                         joinfile=str(data / 'masterlist.csv'), landuse_input=str(data / 'landuse.gpkg'),
+                         NHD_waterbody=str(data / 'waters.shp'), backend='shapely')
+    build.data = data
+    return build
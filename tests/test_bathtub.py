@@ -0,0 +1,40 @@
+import os
+
+import pandas as pd
+
+import PLSM
+
+
+def test_bathtub_extract_from_memory_and_sidecar(model, landuse):
+    rainfall_df = pd.DataFrame({'Year': [2010, 2011, 2012], 'Total': [50.0, 40.0, 60.0]})
+    d = model.writeData(rainfall_df, landuse, excel=False)
+    expected = d.bathtubTable()
+    pd.testing.assert_frame_equal(model.plsm_data_extract(), expected)
+
+    # a fresh instance over the same folder only has the sidecar
+    standalone = PLSM.PLSM(None, None, model.folder, backend='shapely')
+    extract = standalone.plsm_data_extract()
+    pd.testing.assert_frame_equal(extract, expected.assign(Year=expected['Year'].astype(str)), check_dtype=False)
+    assert os.path.exists(os.path.join(model.folder, 'PLSM_Bathtub.csv'))
+
+
+def test_bathtub_extract_rereads_edited_workbooks(model, landuse):
+    rainfall_df = pd.DataFrame({'Year': [2010, 2011], 'Total': [50.0, 40.0]})
+    d = model.writeData(rainfall_df, landuse, excel=False)
+    expected = d.bathtubTable()
+
+    # workbooks edited after the run, with every value doubled
+    raw = os.path.join(model.folder, 'PLSM_raw.xlsx')
+    summary = os.path.join(model.folder, 'PLSM_summary.xlsx')
+    with pd.ExcelWriter(raw) as writer:
+        for year, rain in zip(expected['Year'], expected['Precipitation  (meters)']):
+            pd.DataFrame({'Rainfall_m': [rain*2]}).to_excel(writer, sheet_name=str(year), index=False)
+    (expected.drop(columns='Precipitation  (meters)').assign(**{c: expected[c]*2 for c in ['Runoff Volume (hm3)', 'TN (ppb)', 'TP (ppb)']})
+     .to_excel(summary, index=False))
+    sidecar = os.stat(os.path.join(model.folder, 'PLSM_bathtub_cache.csv'))
+    for f in (raw, summary):
+        os.utime(f, ns=(sidecar.st_atime_ns, sidecar.st_mtime_ns + 10**9))
+
+    extract = PLSM.PLSM(None, None, model.folder, backend='shapely').plsm_data_extract()
+    pd.testing.assert_series_equal(extract['Precipitation  (meters)'], expected['Precipitation  (meters)']*2)
+    pd.testing.assert_series_equal(extract['TN (ppb)'], expected['TN (ppb)']*2)
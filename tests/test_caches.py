@@ -0,0 +1,97 @@
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import Lake_Approach
+import PLSM
+
+
+def test_dissolve_cache_restores_the_same_outputs(basin, tmp_path):
+    cache = PLSM.dissolveCache(str(tmp_path / 'cache'))
+    first = basin(tmp_path / 'a').clipDissolve(cache=cache)
+    restored = basin(tmp_path / 'b').clipDissolve(cache=cache)
+    assert (cache.hits, cache.misses) == (1, 1)
+    assert restored[1] == first[1]
+    assert os.path.dirname(restored[0]) == os.path.join(str(tmp_path / 'b'), 'PLSM_shapefiles')
+    pd.testing.assert_frame_equal(pd.read_csv(os.path.join(restored[3], 'wshed_landuse.csv')),
+                                  pd.read_csv(os.path.join(first[3], 'wshed_landuse.csv')))
+
+
+def test_dissolve_cache_misses_after_the_landuse_changes(basin, tmp_path):
+    cache = PLSM.dissolveCache(str(tmp_path / 'cache'))
+    basin(tmp_path / 'a').clipDissolve(cache=cache)
+    landuse = basin.data / 'landuse.gpkg'
+    st = os.stat(landuse)
+    os.utime(landuse, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    basin(tmp_path / 'b').clipDissolve(cache=cache)
+    basin(tmp_path / 'c').clipDissolve(cache=cache, type='Analysis')
+    assert (cache.hits, cache.misses) == (0, 3)
+    assert cache.report()['entries'] == 3
+
+
+def test_dissolve_cache_evicts_the_least_recently_used(basin, tmp_path):
+    cache = PLSM.dissolveCache(str(tmp_path / 'cache'))
+    basin(tmp_path / 'a').clipDissolve(cache=cache)
+    (old, entry), = cache.readIndex()['entries'].items()
+    # room for about one entry
+    cache.max_bytes = entry['bytes']*1.5
+    model = basin(tmp_path / 'b')
+    model.clipDissolve(cache=cache, type='Analysis')
+    new = cache.key(model.geo, model.watershed, model.landuse, model.NHD_waterbody, 'Analysis')
+    assert list(cache.readIndex()['entries']) == [new]
+    assert not os.path.exists(os.path.join(cache.folder, old))
+
+
+@pytest.fixture
+def iwr(tmp_path):
+    rng = np.random.default_rng(24)
+    n = 2000
+    raw = pd.DataFrame({'wbid': rng.choice(['1', '2'], n), 'STA': '21FLA_1', 'year': rng.integers(2010, 2014, n),
+                        'month': rng.integers(1, 13, n), 'day': rng.integers(1, 29, n),
+                        'mastercode': rng.choice(['TN', 'TP'], n), 'result': rng.lognormal(-1, 1, n),
+                        'rcode': '', 'mdl': '0.01'})
+    path = str(tmp_path / 'IWR.sqlite')
+    con = sqlite3.connect(path)
+    raw.to_sql('RawData', con, index=False)
+    con.close()
+    yield path, raw
+    Lake_Approach.sqliteConnections.close()
+
+
+def pull(path, cache):
+    lake = Lake_Approach.dataPull('1', 2011, ['TN', 'TP'], cache=cache)
+    lake.iwrRUN(path)
+    return lake.qaFiltered()
+
+
+def test_agm_cache_hits_until_the_database_changes(iwr, tmp_path):
+    path, raw = iwr
+    cache = Lake_Approach.agmCache(str(tmp_path / 'agm.sqlite'))
+    first = pull(path, cache)
+    pd.testing.assert_frame_equal(pull(path, cache), first)
+    assert (cache.hits, cache.misses) == (1, 1)
+    pd.testing.assert_frame_equal(first, pull(path, False))
+
+    con = sqlite3.connect(path)
+    raw.head(50).assign(year=2013).to_sql('RawData', con, index=False, if_exists='append')
+    con.commit()
+    con.close()
+    changed = pull(path, cache)
+    assert cache.misses == 2
+    pd.testing.assert_frame_equal(changed, pull(path, False))
+    # the results of the old release are gone
+    con = cache.connect()
+    assert con.execute('SELECT COUNT(*) FROM agm').fetchone()[0] == 1
+    con.close()
+
+
+def test_agm_cache_evicts_the_least_recently_used(iwr, tmp_path):
+    path, _ = iwr
+    cache = Lake_Approach.agmCache(str(tmp_path / 'agm.sqlite'), max_mb=0)
+    pull(path, cache)
+    con = cache.connect()
+    assert con.execute('SELECT COUNT(*) FROM agm').fetchone()[0] == 0
+    con.close()
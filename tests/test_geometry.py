@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+pyproj = pytest.importorskip('pyproj')
+shapely = pytest.importorskip('shapely')
+
+import Geometry
+import Septic
+
+GEOD = pyproj.Geod(ellps='WGS84')
+# a small lake near Orlando, in longitude/latitude
+LAKE = shapely.box(-81.40, 28.50, -81.39, 28.51)
+
+
+def east_of(lon, lat, meters):
+    meters = np.asarray(meters, dtype=float)
+    x, y, _ = GEOD.fwd(np.full(meters.shape, lon), np.full(meters.shape, lat), np.full(meters.shape, 90.0), meters)
+    return x, y
+
+
+def test_metric_distance_in_geographic_crs():
+    distances = np.array([50.0, 200.0, 1000.0])
+    x, y = east_of(-81.39, 28.505, distances)
+    measured = Septic.metricDistance(LAKE, x, y, 'EPSG:4326')
+    np.testing.assert_allclose(measured, distances, rtol=2e-3)
+    assert Septic.metricDistance(LAKE, [-81.395], [28.505], 'EPSG:4326')[0] == 0
+
+
+def test_buffer_in_geographic_crs(tmp_path):
+    backend = Geometry.shapelyBackend()
+    lake = tmp_path / 'lake.gpkg'
+    gpd.GeoDataFrame({'name': ['lake']}, geometry=[LAKE], crs='EPSG:4326').to_file(lake)
+    out = backend.buffer(str(lake), str(tmp_path / 'buffer.gpkg'), 200)
+    ring = gpd.read_file(out).to_crs(4326).geometry.iloc[0]
+    # the buffer edge due east of the lake is 200 m from it
+    east = shapely.intersection(ring.exterior, shapely.LineString([(-81.39, 28.505), (-81.37, 28.505)]))
+    _, _, meters = GEOD.inv(-81.39, 28.505, east.x, east.y)
+    assert meters == pytest.approx(200, rel=2e-3)
+
+
+def test_area_in_geographic_crs(tmp_path):
+    backend = Geometry.shapelyBackend()
+    lake = tmp_path / 'lake.gpkg'
+    gpd.GeoDataFrame({'name': ['lake']}, geometry=[LAKE], crs='EPSG:4326').to_file(lake)
+    backend.area(str(lake), 'Area_sq_m')
+    area, _ = GEOD.geometry_area_perimeter(LAKE)
+    assert gpd.read_file(lake)['Area_sq_m'].iloc[0] == pytest.approx(abs(area), rel=1e-4)
@@ -0,0 +1,54 @@
+import os
+
+import pandas as pd
+import pytest
+
+import PLSM
+
+
+@pytest.fixture
+def masterlist():
+    return pd.DataFrame({'LEVEL2_LANDUSE_CODE': [1100, 2100, 3100],
+                         'LEVEL2_L_1': ['Residential low', 'Cropland', 'Rangeland'],
+                         'ROC': [0.3, 0.1, 0.05],
+                         'EMC_TN': [2.0, 1.0, 0.8],
+                         'EMC_TP': [0.3, 0.1, 0.05]})
+
+
+@pytest.fixture
+def watershed_csv(tmp_path):
+    pd.DataFrame({'LEVEL2_LAN': [2100, 1100], 'LEVEL2_L_1': ['b', 'a'], 'Area_sq_m': [50.0, 41.0]}).to_csv(
+        tmp_path / 'wshed_landuse.csv', index=False)
+    return str(tmp_path)
+
+
+def test_merge_matches_plain_merge(tmp_path, masterlist, watershed_csv):
+    model = PLSM.PLSM(None, None, str(tmp_path), joinfile=masterlist, backend='shapely')
+    join1 = model.Merge(watershed_csv, 2)
+    expected = pd.merge(pd.read_csv(os.path.join(watershed_csv, 'wshed_landuse.csv')), masterlist,
+                        left_on='LEVEL2_LAN', right_on='LEVEL2_LANDUSE_CODE')
+    pd.testing.assert_frame_equal(join1, expected)
+    # the description both tables have keeps the suffixes of the original merge
+    assert {'LEVEL2_L_1_x', 'LEVEL2_L_1_y'} <= set(join1.columns)
+
+
+def test_merge_stops_on_unmatched_codes(tmp_path, masterlist, watershed_csv):
+    model = PLSM.PLSM(None, None, str(tmp_path), joinfile=masterlist[masterlist['LEVEL2_LANDUSE_CODE'] != 2100],
+                      backend='shapely')
+    with pytest.raises(SystemExit):
+        model.Merge(watershed_csv, 2)
+
+
+def test_masterlist_cache_follows_the_source(tmp_path, masterlist):
+    source = tmp_path / 'masterlist.csv'
+    masterlist.to_csv(source, index=False)
+    cache = tmp_path / 'cache'
+    first = PLSM.landuseMasterlist(str(source), str(cache))
+    assert list(first.index) == [1100, 2100, 3100]
+    assert PLSM.landuseMasterlist(str(source), str(cache)) is first
+
+    changed = masterlist.assign(ROC=[0.4, 0.2, 0.1])
+    changed.to_csv(source, index=False)
+    os.utime(source, ns=(os.stat(source).st_atime_ns, os.stat(source).st_mtime_ns + 10**9))
+    second = PLSM.landuseMasterlist(str(source), str(cache))
+    assert list(second['ROC']) == [0.4, 0.2, 0.1]
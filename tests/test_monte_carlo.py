@@ -0,0 +1,75 @@
+import warnings
+
+import numpy as np
+import pandas as pd
+
+import PLSM
+
+CV = {'ROC': 0.2, 'EMC_TN': 0.4, 'EMC_TP': 0.3}
+PERCENTILES = (5, 50, 95)
+
+
+def direct(loads, n, chunk, seed):
+    '''
+    Every realization kept in memory and np.percentile over the ensemble, the way monteCarlo() used to reduce them.
+    '''
+    landuse = loads.join1
+    point = landuse[['ROC', 'EMC_TN', 'EMC_TP']].to_numpy(dtype=float).T
+    cv = np.array([np.full(len(landuse), CV[p]) for p in ['ROC', 'EMC_TN', 'EMC_TP']])
+    sizes = [chunk]*(n//chunk) + ([n % chunk] if n % chunk else [])
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    results = [PLSM._monteCarloChunk(loads.rainfallMatrix(), loads.area, point, cv, size, sd) for size, sd in zip(sizes, seeds)]
+    yearly = np.concatenate([r[0] for r in results])
+    lta = np.concatenate([r[1] for r in results])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        TN_ppb = np.percentile(yearly[..., 1]/yearly[..., 0]*1000000, PERCENTILES, axis=0)
+    with warnings.catch_warnings():
+        # the landuse without area is NaN in every realization
+        warnings.simplefilter('ignore', RuntimeWarning)
+        lta_q = np.nanpercentile(lta, PERCENTILES, axis=0)
+    return np.percentile(yearly, PERCENTILES, axis=0), TN_ppb, lta_q
+
+
+def test_bands_match_direct_percentiles(model, loads):
+    yearly, lta = model.monteCarlo(loads, n=1100, cv=CV, chunk=200, seed=42, processes=1)
+    yearly_q, TN_ppb, lta_q = direct(loads, 1100, 200, 42)
+
+    assert list(yearly['Percentile'].unique()) == list(PERCENTILES)
+    # bands are sorted by year then percentile, the direct percentiles are percentile x year
+    np.testing.assert_allclose(yearly['Yearly TN Load (kg)'], yearly_q[..., 1].T.ravel(), rtol=2e-3)
+    np.testing.assert_allclose(yearly['Runoff Volume (hm3)'], yearly_q[..., 0].T.ravel()/1000000, rtol=2e-3)
+    np.testing.assert_allclose(yearly['TN (ppb)'], TN_ppb.T.ravel(), rtol=2e-3)
+    np.testing.assert_allclose(lta['TN_Acre'], lta_q[..., 0].T.ravel(), rtol=2e-3)
+    np.testing.assert_allclose(lta['TP_Acre'], lta_q[..., 1].T.ravel(), rtol=2e-3, atol=1e-12)
+    # the landuse without area has no per acre load
+    assert lta.loc[lta['LEVEL2_LAN'] == 400, 'TN_Acre'].isna().all()
+
+
+def test_bands_do_not_depend_on_processes(model, loads):
+    serial = model.monteCarlo(loads, n=600, cv=CV, chunk=100, seed=3, processes=1)
+    pooled = model.monteCarlo(loads, n=600, cv=CV, chunk=100, seed=3, processes=2)
+    for a, b in zip(serial, pooled):
+        pd.testing.assert_frame_equal(a, b)
+
+
+def test_no_variation_gives_point_estimate(model, loads):
+    yearly, lta = model.monteCarlo(loads, n=300, cv={'ROC': 0, 'EMC_TN': 0, 'EMC_TP': 0}, chunk=100, seed=1,
+                                   processes=1)
+    totals = loads.loads.sum(axis=1)
+    for q in PERCENTILES:
+        band = yearly[yearly['Percentile'] == q]
+        np.testing.assert_allclose(band['Yearly TN Load (kg)'], totals[:, 1], rtol=1e-12)
+        np.testing.assert_allclose(band['Yearly TP Load (kg)'], totals[:, 2], rtol=1e-12)
+
+
+def test_log_histogram_percentiles():
+    rng = np.random.default_rng(5)
+    values = rng.lognormal(1.0, 0.5, size=(5000, 3))
+    values[:100, 1] = 0.0
+    values[:, 2] = np.nan
+    histogram = PLSM.logHistogram(np.exp([1.0, 1.0, 1.0]), 3.0)
+    for part in np.array_split(values, 7):
+        histogram.add(part)
+    result = histogram.percentile([1, 25, 50, 99])
+    np.testing.assert_allclose(result[:, :2], np.percentile(values[:, :2], [1, 25, 50, 99], axis=0), rtol=1e-3)
+    assert np.isnan(result[:, 2]).all()
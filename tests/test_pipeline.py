@@ -0,0 +1,56 @@
+import os
+
+import pandas as pd
+import pytest
+
+import PLSM
+
+TARGETS = ('plsm_data_extract', 'annualLoading')
+
+
+def run(basin, folder, **kwargs):
+    stages = PLSM.pipeline(basin(folder), excel=False, **kwargs)
+    return stages, stages.run(TARGETS)
+
+
+def touch(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def test_unchanged_run_is_restored_from_checkpoints(basin, tmp_path):
+    first, results = run(basin, tmp_path / 'model')
+    assert first.skipped == []
+    second, restored = run(basin, tmp_path / 'model')
+    assert second.ran == []
+    pd.testing.assert_frame_equal(restored['plsm_data_extract'], results['plsm_data_extract'])
+    # writeData's results are back on the model for monteCarlo()
+    assert (second.model.loads.loads == results['writeData'].loads).all()
+
+
+def test_new_rainfall_reruns_only_what_depends_on_it(basin, tmp_path):
+    run(basin, tmp_path / 'model')
+    touch(basin.data / 'rain.csv')
+    stages, _ = run(basin, tmp_path / 'model')
+    assert stages.ran == ['rainfall', 'writeData', 'plsm_data_extract', 'annualLoading']
+    assert stages.skipped == ['Clip', 'Dissolve', 'calculateField', 'attribute_to_CSV', 'Merge']
+
+
+def test_new_masterlist_reruns_the_merge(basin, tmp_path):
+    run(basin, tmp_path / 'model')
+    touch(basin.data / 'masterlist.csv')
+    stages, _ = run(basin, tmp_path / 'model')
+    assert stages.ran == ['Merge', 'writeData', 'plsm_data_extract', 'annualLoading']
+
+
+def test_missing_output_reruns_its_stage_and_everything_after(basin, tmp_path):
+    first, _ = run(basin, tmp_path / 'model')
+    os.remove(os.path.join(first.results['Clip'][1], 'wshed_landuse.csv'))
+    stages, _ = run(basin, tmp_path / 'model')
+    assert stages.ran == ['attribute_to_CSV', 'Merge', 'writeData', 'plsm_data_extract', 'annualLoading']
+
+
+def test_other_clip_type_reruns_everything(basin, tmp_path):
+    run(basin, tmp_path / 'model')
+    stages, _ = run(basin, tmp_path / 'model', clip_type='Analysis')
+    assert stages.skipped == ['rainfall']
@@ -0,0 +1,93 @@
+import warnings
+from math import sqrt
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.stats.mstats import gmean
+
+import Lake_Approach
+
+WBIDS = ['%04dA' % i for i in range(86)]
+ANALYTES = [['TN', 'TP', 'CHLAC'], ['TN']]
+START_YEARS = [2006, 2010]
+
+
+@pytest.fixture(scope='module')
+def raw():
+    '''
+    Synthetic RawData records: repeated samples on a day, 21FLKWAT stations, zero/negative results, every qualifier
+    code and WBID/years on both sides of the sample count and season rules.
+    '''
+    rng = np.random.default_rng(22)
+    n = 10000
+    return pd.DataFrame({'wbid': rng.choice(WBIDS, n),
+                         'STA': rng.choice(['21FLKWAT_1', '21FLA_2', '21FLB_3', '112WRD_4'], n),
+                         'year': rng.integers(2006, 2014, n),
+                         'month': rng.integers(1, 13, n),
+                         'day': rng.integers(1, 4, n),
+                         'mastercode': rng.choice(['TN', 'TP', 'CHLAC', 'COLOR'], n),
+                         'result': np.round(rng.lognormal(-1, 1, n), 4)*rng.choice([1, 1, 1, 1, 0, -1], n),
+                         'rcode': rng.choice(['', 'U', 'T', 'G', 'V', 'I', 'A'], n, p=[.6, .1, .1, .05, .05, .05, .05]),
+                         'mdl': rng.choice(['0.01', '0.02', '0.005'], n)})
+
+
+def loop_agm(nutrients_df):
+    '''
+    QA filtering of one WBID the way dataPull.qaFiltered() did it before qaAGM(): string date keys, len() and
+    str.contains() lambdas per group and a gmean pivot table.
+    '''
+    nutrients_df = nutrients_df[nutrients_df.STA.str.contains("21FLKWAT") == False]
+    nutrients_df = nutrients_df[(nutrients_df['result'] > 0)]
+    nutrients_df["mdl"] = pd.to_numeric(nutrients_df["mdl"])
+    expression = nutrients_df["mdl"]/sqrt(2)
+    nutrients_df["result"] = np.where((nutrients_df["rcode"] == "U") | (nutrients_df["rcode"] == "T"), expression, nutrients_df["result"])
+    nutrients_df = nutrients_df.drop(nutrients_df[(nutrients_df["rcode"] == "G") | (nutrients_df["rcode"] == "V")].index)
+    nutrients_df['date'] = pd.to_datetime(nutrients_df[['year', 'month', 'day']])
+    nutrients_df['date'] = nutrients_df['date'].dt.strftime('%Y-%m-%d')
+    nutrients_df['med_date'] = nutrients_df[['date', 'mastercode']].apply(lambda x: ''.join(x), axis=1)
+    avg_samples = nutrients_df.groupby('med_date', as_index=False).agg({"result": "median"})
+    avg_dict = avg_samples.set_index('med_date').to_dict()['result']
+    nutrients_df = nutrients_df.drop_duplicates(subset=['med_date'])
+    nutrients_df['result'] = nutrients_df['med_date'].map(avg_dict)
+    nutrients_df['result'] = nutrients_df.groupby(["year", "mastercode"])['result'].transform(lambda x: x if len(x) >= 4 else np.nan)
+    nutrients_df = nutrients_df.sort_values(["year"])
+    nutrients_df['Season'] = 'N'
+    nutrients_df.loc[(nutrients_df['month'].between(4, 10, inclusive="neither")), 'Season'] = 'G'
+    nutrients_df['Count_G'] = nutrients_df.groupby(['year', 'mastercode'])['Season'].transform(lambda x: x[x.str.contains('G')].count())
+    nutrients_df['Count_N'] = nutrients_df.groupby(['year', 'mastercode'])['Season'].transform(lambda x: x[x.str.contains('N')].count())
+    mask = ((nutrients_df['Count_G'] <= 0) | (nutrients_df['Count_N'] <= 0))
+    nutrients_df.loc[mask, ['result']] = np.nan
+    nutrients_df = nutrients_df.dropna(subset=['result'])
+    nutrients_df = pd.pivot_table(nutrients_df, values='result', index=['wbid', 'year'], columns='mastercode', aggfunc={"result": [gmean]}).reset_index()
+    nutrients_df.columns = nutrients_df.columns.droplevel()
+    nutrients_df.columns.values[[0, 1]] = ['WBID', 'YEAR']
+    return nutrients_df
+
+
+def assert_same_agm(vectorized, loop):
+    loop = loop.rename_axis(columns=None)
+    vectorized = vectorized.rename_axis(columns=None)
+    pd.testing.assert_frame_equal(vectorized, loop, check_dtype=False, check_column_type=False, rtol=1e-12)
+
+
+def test_qa_agm_matches_the_loop_for_every_combination(raw):
+    combinations = 0
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for wbid in WBIDS:
+            for analytes in ANALYTES:
+                for start_yr in START_YEARS:
+                    records = raw[(raw['wbid'] == wbid) & raw['mastercode'].isin(analytes) & (raw['year'] >= start_yr)]
+                    assert_same_agm(Lake_Approach.qaAGM(records), loop_agm(records))
+                    combinations += 1
+    assert combinations == 344
+
+
+def test_qa_agm_of_many_wbids_at_once(raw):
+    records = raw[raw['mastercode'].isin(ANALYTES[0])]
+    statewide = Lake_Approach.qaAGM(records)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        loop = pd.concat([loop_agm(records[records['wbid'] == wbid]) for wbid in WBIDS], ignore_index=True)
+    assert_same_agm(statewide, loop[statewide.columns])
@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import PLSM
+
+rasterio = pytest.importorskip('rasterio')
+shapely = pytest.importorskip('shapely')
+from rasterio.features import geometry_mask
+from rasterio.io import MemoryFile
+from rasterio.transform import from_origin
+
+HEIGHT, WIDTH = 40, 50
+TRANSFORM = from_origin(1000.0, 2000.0, 10.0, 10.0)
+
+
+@pytest.fixture
+def raster():
+    data = np.random.default_rng(1).random((2, HEIGHT, WIDTH)).astype('float32')*100
+    with MemoryFile() as memfile:
+        with memfile.open(driver='GTiff', height=HEIGHT, width=WIDTH, count=2, dtype='float32',
+                          transform=TRANSFORM) as dst:
+            dst.write(data)
+        with memfile.open() as src:
+            yield src, data
+
+
+# off the cell grid, one past the raster edge and one a single cell wide
+SHAPES = [shapely.box(1003.7, 1601.2, 1048.3, 1637.9), shapely.box(1412.5, 1903.3, 1499.9, 1999.2),
+          shapely.Point(1250.3, 1802.1).buffer(33.3), shapely.box(1470.1, 1580.1, 1530.0, 1620.0)]
+
+
+@pytest.mark.parametrize('chunk_rows', [3, 7, 1024])
+def test_zonal_mean_matches_geometry_mask(raster, chunk_rows):
+    src, data = raster
+    means = PLSM.zonalMean(src, SHAPES, chunk_rows)
+    for i, shape in enumerate(SHAPES):
+        inside = ~geometry_mask([shape], (HEIGHT, WIDTH), TRANSFORM)
+        np.testing.assert_allclose(means[:, i], data[:, inside].mean(axis=1), rtol=1e-6)
+        # one shape at a time has a window of its own
+        np.testing.assert_allclose(PLSM.zonalMean(src, [shape], chunk_rows)[:, 0], data[:, inside].mean(axis=1), rtol=1e-6)
+
+
+def test_zonal_mean_of_shapes_outside_the_raster(raster):
+    src, data = raster
+    outside = shapely.box(5000.0, 5000.0, 5100.0, 5100.0)
+    means = PLSM.zonalMean(src, [SHAPES[0], outside])
+    assert np.isnan(means[:, 1]).all()
+    inside = ~geometry_mask([SHAPES[0]], (HEIGHT, WIDTH), TRANSFORM)
+    np.testing.assert_allclose(means[:, 0], data[:, inside].mean(axis=1), rtol=1e-6)
+    assert np.isnan(PLSM.zonalMean(src, [outside])).all()
+
+
+def test_rainfall_grid_is_matched_by_landuse_code(model, landuse):
+    years = [2010, 2011, 2012]
+    rainfall = dict(zip(years, [50.0, 40.0, 60.0]))
+    grid = pd.DataFrame(np.arange(3*len(landuse), dtype=float).reshape(3, -1) + 30, index=years,
+                        columns=landuse['LEVEL2_LAN'])
+    forward = model.loadEngine(rainfall, landuse, grid)
+    shuffled = landuse.sample(frac=1, random_state=4).reset_index(drop=True)
+    backward = model.loadEngine(rainfall, shuffled, grid)
+
+    order = pd.Index(shuffled['LEVEL2_LAN']).get_indexer(landuse['LEVEL2_LAN'])
+    np.testing.assert_array_equal(backward.loads[:, order], forward.loads)
+    np.testing.assert_array_equal(forward.rainfall_grid_in, grid.to_numpy())
+
+
+def test_rainfall_grid_missing_a_landuse_code(model, landuse):
+    grid = pd.DataFrame([[50.0]*(len(landuse) - 1)], index=[2010], columns=landuse['LEVEL2_LAN'][1:])
+    with pytest.raises(SystemExit):
+        model.loadEngine({2010: 50.0}, landuse, grid)
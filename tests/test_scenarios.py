@@ -0,0 +1,60 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import PLSM
+
+
+def loop_lta(landuse, rainfall_in):
+    '''
+    Long term average TN/TP loads per landuse the way the yearly PLSM_raw columns used to be filled, one year at a time.
+    '''
+    TN, TP = np.zeros(len(landuse)), np.zeros(len(landuse))
+    for rain in rainfall_in:
+        runoff = rain*0.0254*landuse['Area_sq_m']*1000*landuse['ROC']
+        TN += runoff*landuse['EMC_TN']/1000000
+        TP += runoff*landuse['EMC_TP']/1000000
+    return TN/len(rainfall_in), TP/len(rainfall_in)
+
+
+def test_baseline_reproduces_the_loads(model, loads):
+    unchanged = {'name': 'unchanged', 'ROC': {100: 1.0}, 'EMC_TN': {200: 1.0}, 'EMC_TP': {300: 1.0}}
+    summary, yearly, lta = model.scenarios(loads, [unchanged])
+
+    base = loads.lta()
+    for name in ['Baseline', 'unchanged']:
+        rows = lta[lta['Scenario'] == name]
+        np.testing.assert_array_equal(rows['TN_Kg'], base['TN_Kg'])
+        np.testing.assert_array_equal(rows['TP_Kg'], base['TP_Kg'])
+        totals = yearly[yearly['Scenario'] == name]
+        np.testing.assert_array_equal(totals['Yearly TN Load (kg)'], loads.loads[..., 1].sum(axis=1))
+    assert (summary[['TN Change (kg)', 'TP Change (kg)', 'TN Change (%)', 'TP Change (%)']] == 0).all().all()
+
+
+def test_scenario_matches_the_yearly_loop(model, loads, landuse):
+    bmp = {'name': 'bmp', 'convert': [(100, 700, 2000.0)], 'EMC_TN': {200: 0.7}, 'ROC': {800: 0.5}}
+    summary, yearly, lta = model.scenarios(loads, [bmp])
+
+    changed = landuse.copy()
+    changed.loc[0, 'Area_sq_m'] -= 2000.0
+    changed.loc[6, 'Area_sq_m'] += 2000.0
+    changed.loc[1, 'EMC_TN'] *= 0.7
+    changed.loc[7, 'ROC'] *= 0.5
+    TN, TP = loop_lta(changed, loads.rainfall_in)
+    rows = lta[lta['Scenario'] == 'bmp']
+    np.testing.assert_allclose(rows['TN_Kg'], TN, rtol=1e-12)
+    np.testing.assert_allclose(rows['TP_Kg'], TP, rtol=1e-12)
+
+    TN_base, _ = loop_lta(landuse, loads.rainfall_in)
+    expected = (TN.sum() - TN_base.sum())/TN_base.sum()*100
+    assert summary.loc[1, 'TN Change (%)'] == pytest.approx(expected, rel=1e-9)
+
+
+def test_change_without_baseline_load(model, landuse):
+    landuse['EMC_TP'] = 0.0
+    rainfall_in = np.array([50.0, 40.0])
+    array = PLSM.loadArray(rainfall_in*0.0254, landuse['Area_sq_m'], landuse['ROC'], landuse['EMC_TN'], landuse['EMC_TP'])
+    d = PLSM.annualLoads(landuse, [2010, 2011], rainfall_in, array)
+    summary, _, _ = model.scenarios(d, [{'name': 'more TP', 'EMC_TP': {100: 2.0}}])
+    assert summary['TP Change (%)'].isna().all()
+    assert np.isfinite(summary['TN Change (%)']).all()
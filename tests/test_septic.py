@@ -0,0 +1,71 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+gpd = pytest.importorskip('geopandas')
+shapely = pytest.importorskip('shapely')
+
+import Septic
+
+
+def loop_calculation(septic_buffer_count, people, water_use=70, flow_loss=0.85, nitrogen=9.012, attenuation=0.5):
+    '''
+    Parameter/value cells of the septic calculation the way runCalculation() used to fill them, one cell at a time.
+    '''
+    values = {}
+    values[10] = people*water_use*flow_loss
+    values[11] = septic_buffer_count*values[10]*365
+    values[12] = values[11]*3.78541
+    values[13] = values[12]*0.000000001
+    values[14] = people*nitrogen*septic_buffer_count*attenuation
+    values[15] = values[14]*453600000
+    values[18] = int(values[15]/values[12])
+    return values, people*nitrogen*septic_buffer_count*attenuation/2.205
+
+
+@pytest.mark.parametrize('count', [1, 37, 250])
+def test_run_calculation_matches_the_cell_loop(tmp_path, count):
+    septic = Septic.Septic(None, None, 2.4, str(tmp_path), backend='shapely', tank_index=False)
+    septic_loading, septic_DF = septic.runCalculation(count)
+    values, kg = loop_calculation(count, 2.4)
+    column = septic_DF.iloc[:, 1]
+    for row, value in values.items():
+        assert column.iloc[row] == value
+    assert septic_loading['TN_Kg'].iloc[0] == kg
+
+
+def test_septic_load_broadcasts_like_single_calls():
+    tanks = np.array([[0], [3], [120]])
+    people = np.array([[1.5, 2.4, 3.0]])
+    load = Septic.septicLoad(tanks, people)
+    for i, t in enumerate(tanks[:, 0]):
+        for j, p in enumerate(people[0]):
+            single = Septic.septicLoad(t, p)
+            for name, value in load.items():
+                np.testing.assert_array_equal(np.broadcast_to(value, (3, 3))[i, j], single[name])
+    assert np.isnan(load['concentration_ug_L'][0]).all()
+
+
+def test_buffer_distances_count_like_buffer(tmp_path):
+    # a lake in UTM 17N with tanks scattered around it, none within 5 m of a buffer edge
+    lake = shapely.Polygon([(500000, 3150000), (500600, 3150000), (500900, 3150400), (500300, 3150700), (499900, 3150300)])
+    rng = np.random.default_rng(2)
+    x = rng.uniform(499300, 501500, 3000)
+    y = rng.uniform(3149400, 3151300, 3000)
+    distance = shapely.distance(lake, shapely.points(x, y))
+    keep = np.all([np.abs(distance - d) > 5 for d in (100, 200, 300, 500)], axis=0)
+    tanks = gpd.GeoDataFrame({'WW': ['KnownSeptic']*int(keep.sum())}, geometry=shapely.points(x[keep], y[keep]),
+                             crs='EPSG:32617')
+    tanks.to_file(tmp_path / 'tanks.shp')
+    gpd.GeoDataFrame({'name': ['lake']}, geometry=[lake], crs='EPSG:32617').to_file(tmp_path / 'lake.shp')
+
+    septic = Septic.Septic(None, str(tmp_path / 'lake.shp'), 2.4, str(tmp_path), backend='shapely', tank_index=False)
+    buffer_df, results = septic.bufferDistances(str(tmp_path / 'tanks.shp'))
+    for d in (100, 200, 300, 500):
+        assert buffer_df.loc[buffer_df['Buffer (m)'] == d, 'Septic Tanks'].iloc[0] == (distance[keep] <= d).sum()
+    # Buffer() only ever measured the 200 m zone
+    temp = tmp_path / 'Septic_shapefiles'
+    temp.mkdir()
+    count = septic.Buffer(str(tmp_path / 'tanks.shp'), str(temp))
+    assert buffer_df.loc[buffer_df['Buffer (m)'] == 200, 'Septic Tanks'].iloc[0] == count
+    pd.testing.assert_frame_equal(results[200][0], septic.runCalculation(count)[0])
@@ -0,0 +1,69 @@
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import Lake_Approach
+
+
+@pytest.fixture
+def databases(tmp_path):
+    iwr = str(tmp_path / 'IWR.sqlite')
+    con = sqlite3.connect(iwr)
+    pd.DataFrame({'wbid': ['1', '1', '2', '3', '4'], 'mastercode': ['TN']*5, 'year': [2010]*5}).to_sql('RawData', con, index=False)
+    con.close()
+    color = str(tmp_path / 'color.sqlite')
+    con = sqlite3.connect(color)
+    # a flag column that merely mentions alkalinity must not be read as the alkalinity
+    pd.DataFrame({'WBID': ['1', '2', '3'], 'Color': [1, 0, 0], 'ALK_FLAG': [99, 99, 0],
+                  'Alkalinity': [5.0, 35.0, 12.0]}).to_sql('Lake_CLassification', con, index=False)
+    con.close()
+    yield iwr, color
+    Lake_Approach._catalogs.clear()
+    Lake_Approach.sqliteConnections.close()
+
+
+def test_catalog_lookups(databases, tmp_path):
+    catalog = Lake_Approach.loadCatalog(*databases, cache_folder=str(tmp_path / 'cache'))
+    assert '4' in catalog and '5' not in catalog
+    assert [catalog.nncType(w) for w in ['1', '2', '3', '4']] == [1, 2, 3, None]
+    bulk = catalog.lookup(['3', '5'])
+    assert bulk['EXISTS'].tolist() == [True, False]
+    assert bulk['Min_TP_NNC_(mg/L)'].iloc[0] == 0.01
+
+
+def test_catalog_of_a_connection_is_keyed_by_its_file(databases, tmp_path):
+    iwr, color = databases
+    by_path = Lake_Approach.loadCatalog(iwr, color, cache_folder=str(tmp_path / 'cache'))
+    con = sqlite3.connect(iwr)
+    try:
+        assert Lake_Approach.loadCatalog(con, color, cache_folder=str(tmp_path / 'cache')) is by_path
+    finally:
+        con.close()
+
+    memory = sqlite3.connect(':memory:')
+    pd.DataFrame({'wbid': ['9']}).to_sql('RawData', memory, index=False)
+    try:
+        first = Lake_Approach.loadCatalog(memory, color, cache_folder=str(tmp_path / 'cache'))
+        assert '9' in first
+        assert Lake_Approach.loadCatalog(memory, color, cache_folder=str(tmp_path / 'cache')) is not first
+    finally:
+        memory.close()
+
+
+def test_connections_are_read_only_with_unusual_paths(tmp_path):
+    folder = tmp_path / 'IWR data #62'
+    folder.mkdir()
+    path = str(folder / 'IWR 62%.sqlite')
+    con = sqlite3.connect(path)
+    con.execute('CREATE TABLE RawData (wbid TEXT)')
+    con.commit()
+    con.close()
+    manager = Lake_Approach.connectionManager()
+    try:
+        shared = manager.get(path)
+        assert shared.execute('SELECT COUNT(*) FROM RawData').fetchone()[0] == 0
+        with pytest.raises(sqlite3.OperationalError):
+            shared.execute("INSERT INTO RawData VALUES ('1')")
+    finally:
+        manager.close()